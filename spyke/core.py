@@ -10,6 +10,7 @@ import hashlib
 import time
 from datetime import timedelta
 import os
+import struct
 
 import random
 import string
@@ -44,6 +45,11 @@ MU = '\xb5' # greek mu symbol
 MICRO = 'u'
 
 DEFNSXFILTMETH = 'BW' # default .nsx filter method: None, 'BW', 'WMLDR'
+# default .nsx filter mode: 'padded' refilters NSXXSPOINTS of excess data on either side of
+# every read. 'streaming' makes output independent of read boundaries by filtering fixed
+# chunks aligned to sample=0, each independently with its own warm-up, and reusing them across
+# sequential reads:
+DEFNSXFILTMODE = 'padded'
 BWF0 = 300 # low-frequency butterworth filter cutoff, Hz
 BWORDER = 4 # butterworth filter order
 
@@ -60,13 +66,28 @@ KERNELSIZE = 12
 assert KERNELSIZE % 2 == 0 # kernel size needs to be even, otherwise there's a slight but
                            # undesireable time shift, perhaps because sampfreq always
                            # needs to be an integer multiple of rawsampfreq
+RESAMPLEBLOCKSIZE = 2**12 # number of raw points per chan to resample per matrix multiply
+RESAMPLEROWSIZE = 8 # number of consecutive raw points per row of each resample matrix multiply
 NSXXSPOINTS = 200 # number of xs raw datapoints to include on either side of each NXSStream
                   # slice call, separate for NSXStream because filtering requires more
                   # excess
+BWCHUNKSIZE = 2**16 # number of raw points per independently filtered chunk in streaming
+                    # butterworth filtering
+WMLDRCHUNKSIZE = 2**13 # number of raw points per chunk in chunked WMLDR filtering
+WMLDROVERLAP = 2**10 # number of raw points on either side of each chunk in chunked WMLDR
 NCHANSPERBOARD = 32 # TODO: stop hard coding this
+BLOCKCACHEDT = 100000 # duration of each block in the stream block cache, us
+BLOCKCACHENBYTES = 2**27 # byte budget of the stream block cache, 128 MB
+MATERIALIZECHUNKDT = 5000000 # duration of each chunk of stream to materialize at a time, us
+EXPORTCHUNKDT = 5000000 # duration of each chunk of stream to export at a time, us
+DATCHUNKNT = 2**16 # max number of raw timepoints to copy to a .dat file at a time
+PREFETCHDEPTH = 2 # max number of blocks of stream data to read ahead of the one in use
+SHMPATH = '/dev/shm' # shared memory dir for SimpleStream wavedata, falls back to temp dir
+                     # if it doesn't exist or is too full
 
 MAXLONGLONG = 2**63-1
 MAXNBYTESTOFILE = 2**31 # max array size safe to call .tofile() on in Numpy 1.5.0 on Windows
+NPYCHUNKNBYTES = 2**26 # max number of bytes of .npy file rows to copy or process at a time
 
 MAXNSPIKEPLOTS = 200
 
@@ -1671,6 +1692,19 @@ def filterord(data, sampfreq=1000, f0=300, f1=None, order=4, rp=None, rs=None,
     data = scipy.signal.lfilter(b, a, data)
     return data, b, a
 
+def sosfilterord(data, sampfreq=1000, f0=300, f1=None, order=4, btype='highpass',
+                 ftype='butter'):
+    """Like filterord, but filter along the last axis using second-order sections, starting
+    from zero filter state. Return filtered data"""
+    if f1 != None:
+        fn = np.array([f0, f1])
+    else:
+        fn = f0
+    wn = fn / (sampfreq / 2)
+    sos = scipy.signal.iirfilter(order, wn, btype=btype, analog=0, ftype=ftype,
+                                 output='sos')
+    return scipy.signal.sosfilt(sos, data)
+
 def WMLDR(data, wname="db4", maxlevel=6, mode='sym'):
     """Perform wavelet multi-level decomposition and reconstruction (WMLDR) on multichannel
     data. See Wiltschko2008. Default to Daubechies(4) wavelet. Modifies data in-place, at
@@ -1732,9 +1766,127 @@ def WMLDR(data, wname="db4", maxlevel=6, mode='sym'):
         recsignal = pywt.waverec(cs, wname, mode=mode)
         ntrec = len(recsignal)
         data[chani] = recsignal[:ntrec-isodd]
-    
+
     return data
 
+def chunkedWMLDR(data, chunksize=WMLDRCHUNKSIZE, overlap=WMLDROVERLAP, nthreads=None,
+                 wname="db4", maxlevel=6, mode='sym'):
+    """Perform WMLDR on multichannel data in fixed chunks of chunksize points, using
+    overlap-save: each chunk is decomposed and reconstructed along with overlap points of
+    data on either side, which are then discarded. data should therefore have overlap
+    points of padding at either end, and a whole number of chunks in between. Both
+    chunksize and overlap should be multiples of 2**maxlevel, so that chunk boundaries
+    align with the coarsest decomposition level. Return float64 filtered data without the
+    padding. Channels are filtered in parallel in nthreads threads (defaults to number of
+    cores), since pywt releases the GIL"""
+    import multiprocessing as mp
+    import threading
+    import pywt
+
+    assert chunksize % 2**maxlevel == 0 and overlap % 2**maxlevel == 0
+    nchans, ntxs = data.shape
+    nt = ntxs - 2*overlap
+    assert nt >= 0 and nt % chunksize == 0
+    nchunks = nt // chunksize
+    filtdata = np.empty((nchans, nt))
+    errors = []
+
+    def filterchans(chanis):
+        try:
+            for chani in chanis:
+                for chunki in range(nchunks):
+                    ti = chunki * chunksize
+                    cs = pywt.wavedec(data[chani, ti:ti+chunksize+2*overlap], wname,
+                                      mode=mode, level=maxlevel)
+                    cs[0] = None # destroy approximation coefficients to get highpass data
+                    recsignal = pywt.waverec(cs, wname, mode=mode)
+                    filtdata[chani, ti:ti+chunksize] = recsignal[overlap:overlap+chunksize]
+        except Exception as err:
+            errors.append(err)
+
+    nthreads = min(nthreads or mp.cpu_count(), nchans)
+    if nthreads <= 1 or nchunks == 0: # not worth starting any threads
+        filterchans(range(nchans))
+    else:
+        # interleave chans across threads:
+        threads = [ threading.Thread(target=filterchans, args=(range(i, nchans, nthreads),))
+                    for i in range(nthreads) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return filtdata
+
+def polyphase_resample(rawdata, kernels, blocksize=RESAMPLEBLOCKSIZE,
+                       rowsize=RESAMPLEROWSIZE):
+    """Resample all chans and all resample points of multichannel rawdata in one batched
+    blocked polyphase filter. kernels is a (nchans, resamplex, N+1) array of int32 kernels
+    (as returned per chan by Stream.get_kernels), scaled by 2**16. Returns int32 data of
+    nrawts*resamplex - resamplex + 1 points per chan, with kernel scaling already undone.
+
+    Output is bit-identical to convolving each chan with each of its kernels using
+    np.convolve(mode='same') and interleaving the results: raw 16 bit values times 16 bit
+    kernels summed over N+1 taps are represented exactly in float64, and the int64 sums are
+    wrapped to int32 before the scaling shift, just as np.convolve's integer output is.
+
+    Each output raw point i and resample point q is the dot product of the N+2 zero-padded raw
+    points starting at i with the time-reversed kernel for q, which for q > 0 is shifted one
+    point later, since interpolated points are bounded on both sides by raw points. Splitting
+    each chan's raw data into rows of rowsize consecutive points, each with the N+1 points
+    that follow it, turns all of its kernels into a single banded (rowsize+N+1,
+    rowsize*resamplex) matrix, whose product with the rows is already interleaved in time.
+    This also multiplies by the zeros outside the band, but in large enough matrix multiplies
+    for BLAS to run them at full speed. Rows are multiplied a block of blocksize raw points at
+    a time, for all chans at once, to stay in cache"""
+    rawdata = np.atleast_2d(rawdata)
+    nchans, nrawts = rawdata.shape
+    resamplex, nkt = kernels.shape[1:] # nkt == N+1
+    assert kernels.shape[0] == nchans
+    nt = nrawts*resamplex - resamplex + 1
+    # weights of all N+2 taps for each resample point, per chan:
+    w = np.zeros((nchans, nkt+1, resamplex))
+    w[:, :nkt, 0] = kernels[:, 0, ::-1] # raw points, not shifted
+    for q in range(1, resamplex):
+        # kernel of the point q resample points after each raw point:
+        w[:, 1:, q] = kernels[:, resamplex-q, ::-1]
+    # banded matrix per chan, each raw point of a row gets the weights of its N+2 taps:
+    rowsize = max(min(rowsize, nrawts), 1)
+    ncols = rowsize + nkt # raw points per row, including the N+1 that follow it
+    band = np.zeros((nchans, ncols, rowsize, resamplex))
+    for i in range(rowsize):
+        band[:, i:i+nkt+1, i] = w
+    band.shape = nchans, ncols, rowsize*resamplex
+    # zero pad rawdata the same as np.convolve(mode='same') does, and up to a whole number of
+    # rows:
+    nrows = -(-nrawts // rowsize) # round up
+    lpad = nkt - 1 - (nkt - 1) // 2
+    rawxs = np.zeros((nchans, nrows*rowsize+nkt), dtype=rawdata.dtype)
+    rawxs[:, lpad:lpad+nrawts] = rawdata
+    # overlapping rows, as a view into rawxs:
+    cstride, tstride = rawxs.strides
+    rows = np.lib.stride_tricks.as_strided(rawxs, shape=(nchans, nrows, ncols),
+                                           strides=(cstride, rowsize*tstride, tstride))
+    data = np.empty((nchans, nrows, rowsize*resamplex), dtype=np.int32)
+    # preallocate per block buffers:
+    nbrows = max(min(blocksize // rowsize, nrows), 1) # number of rows per block
+    xblock = np.empty((nchans, nbrows, ncols))
+    fblock = np.empty((nchans, nbrows, rowsize*resamplex))
+    iblock = np.empty((nchans, nbrows, rowsize*resamplex), dtype=np.int64)
+    for ri0 in range(0, nrows, nbrows):
+        nr = min(nbrows, nrows-ri0)
+        x = xblock[:, :nr]
+        x[:] = rows[:, ri0:ri0+nr] # contiguous float64 copy, for BLAS
+        y = np.matmul(x, band, out=fblock[:, :nr])
+        iy = iblock[:, :nr]
+        iy[:] = y # exact, float64 to int64
+        d = data[:, ri0:ri0+nr]
+        d[:] = iy # wraps int64 to int32, like np.convolve
+        d >>= 16 # undo kernel scaling, shift 16 bits right in place, same as //= 2**16
+    # drop the resample points past the last raw point, and any row padding:
+    return data.reshape(nchans, nrows*rowsize*resamplex)[:, :nt]
+
 def updatenpyfilerows(fname, rows, arr):
     """Given a numpy formatted binary file (usually with .npy extension,
     but not necessarily), update 0-based rows (first dimension) of the
@@ -1759,6 +1911,91 @@ def updatenpyfilerows(fname, rows, arr):
         f.write(arr[row])
     f.close()
 
+def freenbytes(path):
+    """Return number of bytes free to unprivileged users on the file system that holds path,
+    or None if that can't be determined on this platform"""
+    try:
+        st = os.statvfs(path)
+    except AttributeError: # no os.statvfs, e.g. on Windows
+        return None
+    return st.f_bavail * st.f_frsize
+
+def ismemmapof(arr, fname):
+    """Check if arr is memory-mapped from file fname"""
+    try:
+        return os.path.abspath(arr.filename) == os.path.abspath(fname)
+    except (AttributeError, TypeError): # not a memmap, or one without a filename
+        return False
+
+
+class NpyFileWriter(object):
+    """Numpy formatted binary file that grows as rows are appended to it, without holding
+    all of them in memory. The .npy header is padded to a fixed length, and rewritten in
+    place with the final number of rows on close(). All rows must have the same dtype and
+    subshape"""
+    def __init__(self, fname, dtype, subshape=()):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.subshape = tuple(subshape)
+        self.nrows = 0
+        # pad header to fit the longest possible number of rows:
+        self.headerlen = len(self.header(10**19))
+        self.f = open(fname, 'wb')
+        self.f.write(self.header(0))
+
+    def header(self, nrows):
+        """Return .npy version 1.0 header for nrows, padded with spaces to
+        self.headerlen, if it exists yet"""
+        shape = (nrows,) + self.subshape
+        shapestr = '(%s)' % ''.join([ '%d, ' % n for n in shape ])
+        shapestr = shapestr.replace(', )', ',)' if len(shape) == 1 else ')')
+        d = ("{'descr': %r, 'fortran_order': False, 'shape': %s, }"
+             % (np.lib.format.dtype_to_descr(self.dtype), shapestr))
+        magic = np.lib.format.magic(1, 0)
+        # total length must be a multiple of 64 bytes, including magic, header length
+        # field and trailing newline:
+        headerlen = getattr(self, 'headerlen', None)
+        if headerlen is None:
+            headerlen = len(magic) + 2 + len(d) + 1
+            headerlen += -headerlen % 64
+        d = d.ljust(headerlen - len(magic) - 2 - 1) + '\n'
+        return magic + struct.pack('<H', len(d)) + d
+
+    def append(self, arr):
+        """Append rows in arr to end of file"""
+        if arr.dtype != self.dtype:
+            raise TypeError("array has dtype %r instead of %r" % (arr.dtype, self.dtype))
+        if arr.shape[1:] != self.subshape:
+            raise TypeError("array has subshape %r instead of %r"
+                            % (arr.shape[1:], self.subshape))
+        np.ascontiguousarray(arr).tofile(self.f)
+        self.nrows += len(arr)
+
+    def appendfile(self, fname, chunknbytes=NPYCHUNKNBYTES):
+        """Append rows of the array in .npy file fname to end of file, a chunk of rows at
+        a time. Return the number of rows appended"""
+        with open(fname, 'rb') as f:
+            major, minor = np.lib.format.read_magic(f)
+            assert (major == 1 and minor == 0)
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            assert not fortran_order
+            nrows, subshape = shape[0], shape[1:]
+            rowsize = int(np.prod(subshape)) # number of items per row
+            chunknrows = max(chunknbytes // (rowsize * dtype.itemsize), 1)
+            for rowi in range(0, nrows, chunknrows):
+                n = min(chunknrows, nrows - rowi)
+                arr = np.fromfile(f, dtype=dtype, count=n*rowsize)
+                arr.shape = (n,) + subshape
+                self.append(arr)
+        return nrows
+
+    def close(self):
+        """Write final number of rows to header, and close file"""
+        self.f.seek(0)
+        self.f.write(self.header(self.nrows))
+        self.f.close()
+
+
 def unpickler_find_global_0_7_to_0_8(oldmod, oldcls):
     """Required for unpickling .sort version 0.7 files and upgrading them to version 0.8.
     Rename class names that changed between the two versions. Unfortunately, you can't check
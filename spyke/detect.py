@@ -12,6 +12,9 @@ pyximport.install(build_in_temp=False, inplace=True)
 import util # .pyx file
 
 import sys
+import os
+import glob
+import hashlib
 import time
 import logging
 import datetime
@@ -19,6 +22,7 @@ import multiprocessing as mp
 from multiprocessing import Process
 ps = mp.current_process
 from copy import deepcopy
+from itertools import izip
 
 '''
 NOTE: as of Ubuntu 10.10, for some reason often get:
@@ -42,6 +46,7 @@ IOError: [Errno 4] Interrupted system call
 which has to be caught and retried using _eintr_retry_call.
 '''
 from core import eucd, dist, issorted, concatenate_destroy, intround, g2, cauchy2
+from core import NpyFileWriter, NPYCHUNKNBYTES, PREFETCHDEPTH
 import stream
 
 #DMURANGE = 0, 500 # allowed time difference between peaks of modelled spike
@@ -56,6 +61,18 @@ info = logger.info
 
 DEBUG = False # print detection debug messages to log file? slows down detection
 MPMETHOD = 'detectionprocess' #'singleprocess', 'detectionprocess', 'pool'
+AUTOTUNE = False # pick blocksize and number of processes to fit within DETECTNBYTES?
+DETECTNBYTES = 2**32 # memory budget of all detection processes together when AUTOTUNE, 4 GB
+MINAUTOBLOCKSIZE = 1000000 # us, smallest block AUTOTUNE picks, keeps blockexcess overlap small
+MAXAUTOBLOCKSIZE = 60000000 # us, biggest block AUTOTUNE picks
+NBLOCKSPERPROCESS = 4 # min number of blocks per process AUTOTUNE aims for, to balance load
+# estimated peak bytes of memory per chan per raw timepoint of a block being read: int16 raw
+# data, and float64 scaled and filtered copies of it:
+RAWNBYTES = 2 + 2*8
+# estimated peak bytes of memory per chan per resampled timepoint of a block being searched:
+# int32 resampled data, its int16 copy, float32 sharpness, and int16 data of blocks being
+# read ahead:
+RESAMPLEDNBYTES = 4 + 2 + 4 + 2*PREFETCHDEPTH
 
 import errno
 def _eintr_retry_call(func, *args):
@@ -74,6 +91,31 @@ def callsearchblock(blockrange):
     detector = ps().detector
     return detector.searchblock(blockrange)
 
+def callsearchblocks(blockranges):
+    """Run current process' Detector on a sequence of blockranges"""
+    detector = ps().detector
+    return detector.searchblocks(blockranges)
+
+def callsearchblockstockpt(args):
+    """Run current process' Detector on a sequence of blockranges, saving each block's
+    results to the checkpoint in ckptpath"""
+    blockis, blockranges, ckptpath = args
+    detector = ps().detector
+    return detector.searchblockstockpt(blockis, blockranges, ckptpath)
+
+def callsearchblockstofile(args):
+    """Run current process' Detector on a sequence of blockranges, writing results to .spike
+    and .wave files starting with fname"""
+    blockranges, fname = args
+    detector = ps().detector
+    return detector.searchblockstofile(blockranges, fname)
+
+def callgetnoisestats(blockranges):
+    """Run current process' Detector on a sequence of blockranges, reducing them to noise
+    statistics"""
+    detector = ps().detector
+    return detector.get_noisestats(blockranges)
+
 def initializer(detector):
     """Save pickled copy of the Detector to the current process"""
     # not exactly sure why, but deepcopy is crucial to prevent artefactual spikes!
@@ -151,10 +193,21 @@ class DistanceMatrix(object):
 
 class DetectionProcess(mp.Process):
     """A temporary child process for doing some detection"""
+    fname = None # start of .spike and .wave filenames to write results to, if any
+    ckptpath = None # checkpoint directory to save each block's results to, if any
+
     def run(self):
-        for blocki, blockrange in zip(self.blockis, self.blockranges):
-            blockspikes, blockwavedata = self.detector.searchblock(blockrange)
+        if self.ckptpath: # save results to checkpoint instead of to the queue
+            self.detector.searchblockstockpt(self.blockis, self.blockranges, self.ckptpath)
+            return
+        if self.fname: # write results to .spike and .wave files instead of to the queue
+            self.detector.searchblockstofile(self.blockranges, self.fname)
+            return
+        waves = stream.Prefetcher(self.detector.sort.stream, self.blockranges)
+        for blocki, blockrange, wave in izip(self.blockis, self.blockranges, waves):
+            blockspikes, blockwavedata = self.detector.searchblock(blockrange, wave)
             self.q.put((blocki, blockspikes, blockwavedata))
+        self.detector.logmetrics()
 
 
 class Detector(object):
@@ -186,10 +239,15 @@ class Detector(object):
 
     srffnames = property(get_srffnames)
 
-    def detect(self):
+    def detect(self, fname=None, ckptpath=None, keepthresh=False):
         """Search for spikes. Divides large searches into more manageable
         blocks of (slightly overlapping) multichannel waveform data, and
-        then combines the results"""
+        then combines the results. If fname is given, write spikes and wavedata to
+        fname.spike and fname.wave files as they're found instead of collecting them in
+        memory, and return them memory-mapped from those files. If ckptpath is given,
+        save each block's results to a checkpoint in that directory as soon as it's done,
+        and skip blocks already done by an interrupted run with identical parameters. If
+        keepthresh, reuse the thresholds of the last run instead of calculating new ones"""
         self.calc_chans()
         self.SPIKEDTYPE = calc_SPIKEDTYPE(self.maxnchansperspike)
         sort = self.sort
@@ -200,20 +258,38 @@ class Detector(object):
 
         print('Detection trange: %r' % (self.trange,))
 
-        t0 = time.time()
+        if AUTOTUNE: # pick self.blocksize and max number of processes
+            maxnprocesses = self.autotune()
+        else:
+            maxnprocesses = mp.cpu_count()
+
         # convert from numpy.int64 to normal int for inline C:
         self.dti = int(self.dt // sort.stream.tres)
-        self.thresh = self.get_thresh() # abs, in AD units, one per chan in self.chans
-        self.ppthresh = np.int16(np.round(self.thresh * self.ppthreshmult)) # abs, in AD units
-        AD2uV = sort.converter.AD2uV
-        info('thresh calcs took %.3f sec' % (time.time()-t0))
-        info('thresh   = %s' % AD2uV(self.thresh))
-        info('ppthresh = %s' % AD2uV(self.ppthresh))
+        # also set by get_thresh(), but needed by searchblock() even when it isn't called:
+        self.fixedthresh = sort.converter.uV2AD(self.fixedthreshuV) # convert to AD units
 
         bs = self.blocksize
         bx = self.blockexcess
         blockranges = self.get_blockranges(bs, bx)
         nblocks = len(blockranges)
+        blockis = None
+        if ckptpath: # only search blocks that weren't done by an interrupted run
+            blockis = self.loadckpt(ckptpath, blockranges) # also restores its thresholds
+        if blockis is None: # no checkpoint to resume from
+            t0 = time.time()
+            if not (keepthresh and hasattr(self, 'thresh')):
+                # abs, in AD units, one per chan in self.chans:
+                self.thresh = self.get_thresh(maxnprocesses)
+                # abs, in AD units:
+                self.ppthresh = np.int16(np.round(self.thresh * self.ppthreshmult))
+            info('thresh calcs took %.3f sec' % (time.time()-t0))
+            if ckptpath:
+                self.newckpt(ckptpath)
+            blockis = np.arange(nblocks)
+        AD2uV = sort.converter.AD2uV
+        info('thresh   = %s' % AD2uV(self.thresh))
+        info('ppthresh = %s' % AD2uV(self.ppthresh))
+        nsearchblocks = len(blockis)
 
         self.nchans = len(self.chans) # number of enabled chans
         # total num spikes found across all chans so far by this Detector,
@@ -226,25 +302,42 @@ class Detector(object):
         ycoords = np.asarray([ xycoord[1] for xycoord in xycoords ])
         self.siteloc = np.asarray([xcoords, ycoords]).T # index into with chani to get (x, y)
 
-        # prevent out of memory errors due to copying of large stream.wavedata array
-        # when spawning multiple processes
-        if type(self.sort.stream) == stream.SimpleStream:
-            self.mpmethod = 'singleprocess'
-
-        ncores = mp.cpu_count()
         t0 = time.time()
 
         # mp.Pool is slightly faster than my own DetectionProcess
-        if not DEBUG and self.mpmethod == 'pool': # use a pool of processes
-            nprocesses = min(ncores, nblocks)
+        if nsearchblocks == 0: # all blocks were done by an interrupted run
+            pass
+        elif not DEBUG and self.mpmethod == 'pool': # use a pool of processes
+            nprocesses = min(maxnprocesses, nsearchblocks)
             # send pickled copy of self to each process
             pool = mp.Pool(nprocesses, initializer, (self,))
-            results = pool.map(callsearchblock, blockranges, chunksize=1)
+            # split blocks into contiguous groups, a few per process, so that each
+            # process can read ahead the blocks in its current group:
+            groups = np.array_split(blockis, min(4*nprocesses, nsearchblocks))
+            if ckptpath: # each block is saved to the checkpoint as soon as it's done
+                args = [ (group, blockranges[group], ckptpath) for group in groups ]
+                pool.map(callsearchblockstockpt, args, chunksize=1)
+            elif fname: # each group writes to its own part files
+                partfnames = [ '%s_part%d' % (fname, gi) for gi in range(len(groups)) ]
+                args = [ (blockranges[group], partfname)
+                         for group, partfname in zip(groups, partfnames) ]
+                pool.map(callsearchblockstofile, args, chunksize=1)
+            else:
+                results = pool.map(callsearchblocks,
+                                   [ blockranges[group] for group in groups ], chunksize=1)
             pool.close()
-            # results is a list of (spikes, wavedata) tuples, and needs to be unzipped
-            spikes, wavedata = zip(*results)
+            pool.join()
+            if ckptpath: # results are gathered from the checkpoint below
+                pass
+            elif fname:
+                self.joinfiles(fname, partfnames)
+            else:
+                # results is a list of lists of (spikes, wavedata) tuples, one list per
+                # group, and needs to be flattened and unzipped
+                results = [ result for group in results for result in group ]
+                spikes, wavedata = [ list(x) for x in zip(*results) ]
         elif not DEBUG and self.mpmethod == 'detectionprocess':
-            nprocesses = min(ncores, nblocks)
+            nprocesses = min(maxnprocesses, nsearchblocks)
             dps = []
             q = mp.Queue()
             spikes = [None] * nblocks
@@ -254,12 +347,21 @@ class Detector(object):
                 # not exactly sure why, but deepcopy is crucial to prevent artefactual spikes!
                 dp.detector = deepcopy(self)
                 dp.detector.sort.stream.open()
-                dp.blockis = range(dpi, nblocks, nprocesses)
+                # contiguous blocks per process, for sequential reads that can be read ahead:
+                dp.blockis = np.array_split(blockis, nprocesses)[dpi]
                 dp.blockranges = blockranges[dp.blockis]
                 dp.q = q
+                if ckptpath: # each block is saved to the checkpoint as soon as it's done
+                    dp.ckptpath = ckptpath
+                elif fname: # each process writes to its own part files
+                    dp.fname = '%s_part%d' % (fname, dpi)
                 dp.start()
                 dps.append(dp)
-            for i in range(nblocks):
+            if ckptpath or fname: # processes only report their results by way of files
+                nblockresults = 0
+            else:
+                nblockresults = nblocks
+            for i in range(nblockresults):
                 #blocki, blockspikes, blockwavedata = dp.q.get() # defaults to block=True
                 blocki, blockspikes, blockwavedata = _eintr_retry_call(dp.q.get)
                 #print('got block %d results' % blocki)
@@ -268,7 +370,11 @@ class Detector(object):
             for dp in dps:
                 dp.join()
                 #_eintr_retry_call(dp.join) # eintr isn't raised anymore it seems
-        else: # use a single process, useful for debugging or for .tsf files
+            if ckptpath: # results are gathered from the checkpoint below
+                pass
+            elif fname:
+                self.joinfiles(fname, [ dp.fname for dp in dps ])
+        else: # use a single process, useful for debugging
             if DEBUG:
                 # print detection info and debug msgs to file, and info msgs to screen
                 dt = str(datetime.datetime.now()) # get a timestamp
@@ -283,27 +389,107 @@ class Detector(object):
                 logger.addHandler(fhandler)
                 self.logger = logger
                 self.logger.debug('Log created %s' % dt)
-            spikes = []
-            wavedata = []
-            for blockrange in blockranges:
-                blockspikes, blockwavedata = self.searchblock(blockrange)
-                spikes.append(blockspikes)
-                wavedata.append(blockwavedata)
-
-        spikes = concatenate_destroy(spikes)
-        wavedata = concatenate_destroy(wavedata) # along sid axis, other dims are identical
+            if ckptpath:
+                self.searchblockstockpt(blockis, blockranges[blockis], ckptpath)
+            elif fname:
+                self.searchblockstofile(blockranges, fname)
+            else:
+                results = self.searchblocks(blockranges)
+                spikes, wavedata = [ list(x) for x in zip(*results) ]
+
+        if ckptpath: # gather all blocks from the checkpoint, in temporal order
+            ckptfnames = [ self.ckptfname(ckptpath, blocki) for blocki in range(nblocks) ]
+            if fname:
+                self.joinfiles(fname, ckptfnames, delete=False)
+            else:
+                spikes = [ np.load(ckptfname + '.spike') for ckptfname in ckptfnames ]
+                wavedata = [ np.load(ckptfname + '.wave') for ckptfname in ckptfnames ]
+        if fname:
+            spikes = np.load(fname + '.spike', mmap_mode='r+')
+            wavedata = np.load(fname + '.wave', mmap_mode='r+')
+        else:
+            spikes = concatenate_destroy(spikes)
+            # along sid axis, other dims are identical:
+            wavedata = concatenate_destroy(wavedata)
         self.nspikes = len(spikes)
         assert len(wavedata) == self.nspikes
-        # default -1 indicates no nid is set as of yet, reserve 0 for actual ids
-        spikes['nid'] = 0
         info('\nfound %d spikes in total' % self.nspikes)
         info('inside .detect() took %.3f sec' % (time.time()-t0))
-        if not issorted(spikes['t']):
-            raise RuntimeError("spikes aren't sorted for some reason")
-        spikes['id'] = np.arange(self.nspikes) # assign ids (should be in temporal order)
+        # go a chunk of spikes at a time, so as not to load all of them into memory if
+        # they're memory-mapped:
+        chunknspikes = NPYCHUNKNBYTES // spikes.dtype.itemsize
+        lastt = None
+        for spikei in range(0, self.nspikes, chunknspikes):
+            chunk = spikes[spikei:spikei+chunknspikes]
+            ts = chunk['t']
+            if not issorted(ts) or (lastt is not None and ts[0] < lastt):
+                raise RuntimeError("spikes aren't sorted for some reason")
+            lastt = ts[-1]
+            # default -1 indicates no nid is set as of yet, reserve 0 for actual ids
+            chunk['nid'] = 0
+            # assign ids (should be in temporal order):
+            chunk['id'] = np.arange(spikei, spikei+len(chunk))
+        if ckptpath: # run is complete, nothing left to resume
+            self.clearckpt(ckptpath)
         self.datetime = datetime.datetime.now()
         return spikes, wavedata
 
+    def follow(self):
+        """Search for spikes in data recorded to a still growing stream since the last call,
+        or since the last call to detect(). Spikes within self.blockexcess of the current
+        end of the stream are left for the next call, by which time more data will have
+        been recorded after them. Each search starts self.blockexcess before where the last
+        one left off, for the usual overlap between blocks. Return the new spikes and their
+        wavedata, with ids continuing on from the last spike in the sort. Thresholds are
+        kept from the last run, so that fixed thresholds don't depend on only the newly
+        recorded data"""
+        sort = self.sort
+        stream = sort.stream
+        if not hasattr(stream, 'update'):
+            raise RuntimeError("can't follow %s, it isn't a growing .nsx file" % stream.fname)
+        stream.update()
+        trange = self.trange
+        t0 = trange[1] # where the last search left off
+        tfollow = intround(stream.t1 - self.blockexcess) # where this one will leave off
+        if tfollow <= t0: # not enough new data yet
+            spikes = np.zeros(0, self.SPIKEDTYPE)
+            wavedata = np.zeros((0, self.maxnchansperspike, self.maxnt), dtype=np.int16)
+            return spikes, wavedata
+        self.trange = max(t0 - self.blockexcess, stream.t0), stream.t1
+        try:
+            spikes, wavedata = self.detect(keepthresh=True)
+        finally:
+            self.trange = trange
+        # discard spikes that were kept by the last search, or are left for the next one:
+        sids, = np.where((t0 < spikes['t']) & (spikes['t'] <= tfollow))
+        spikes, wavedata = spikes[sids], wavedata[sids]
+        self.nspikes = len(spikes)
+        spikes['id'] = np.arange(sort.nspikes, sort.nspikes+self.nspikes)
+        self.trange = trange[0], tfollow
+        info('kept %d new spikes up to t=%d' % (self.nspikes, tfollow))
+        return spikes, wavedata
+
+    def redetect(self):
+        """Search for spikes only within self.trange, a window of an existing sort, say with
+        different thresholds or chans than the rest of it. The search extends
+        self.blockexcess beyond either end of the window, for the usual overlap between
+        blocks. Return the spikes and wavedata of only those spikes within the window, to
+        be spliced into the sort by Sort.splice_spikes()"""
+        stream = self.sort.stream
+        trange = self.trange
+        t0, t1 = trange
+        self.trange = (max(t0 - self.blockexcess, stream.t0),
+                       min(t1 + self.blockexcess, stream.t1))
+        try:
+            spikes, wavedata = self.detect()
+        finally:
+            self.trange = trange
+        sids, = np.where((t0 <= spikes['t']) & (spikes['t'] <= t1))
+        spikes, wavedata = spikes[sids], wavedata[sids]
+        self.nspikes = len(spikes)
+        info('kept %d spikes within trange %r' % (self.nspikes, trange))
+        return spikes, wavedata
+
     def log(self, msg):
         """Write message to debugger log"""
         self.logger.debug(msg)
@@ -327,9 +513,156 @@ class Detector(object):
             maxnchansperspike = max(maxnchansperspike, len(inclchanis))
         self.maxnchansperspike = maxnchansperspike
 
-    def searchblock(self, blockrange):
+    def searchblocks(self, blockranges):
+        """Search a sequence of blocks of data, reading ahead the data of upcoming blocks
+        while searching the current one. Return a list of (spikes, wavedata) tuples, one
+        per block"""
+        waves = stream.Prefetcher(self.sort.stream, blockranges)
+        results = [ self.searchblock(blockrange, wave)
+                    for blockrange, wave in izip(blockranges, waves) ]
+        self.logmetrics()
+        return results
+
+    def searchblockstofile(self, blockranges, fname):
+        """Search a sequence of blocks of data like searchblocks(), but append each block's
+        spikes and wavedata to fname.spike and fname.wave files as soon as they're found,
+        instead of returning them. Return the number of spikes found"""
+        spikef = NpyFileWriter(fname + '.spike', self.SPIKEDTYPE)
+        wavef = NpyFileWriter(fname + '.wave', np.int16, (self.maxnchansperspike, self.maxnt))
+        waves = stream.Prefetcher(self.sort.stream, blockranges)
+        for blockrange, wave in izip(blockranges, waves):
+            blockspikes, blockwavedata = self.searchblock(blockrange, wave)
+            spikef.append(blockspikes)
+            wavef.append(blockwavedata)
+        spikef.close()
+        wavef.close()
+        self.logmetrics()
+        return spikef.nrows
+
+    def joinfiles(self, fname, partfnames, delete=True):
+        """Concatenate .spike and .wave files starting with partfnames, in order, into
+        fname.spike and fname.wave files. Optionally delete each part file once it's been
+        copied"""
+        for ext, dtype, subshape in [('.spike', self.SPIKEDTYPE, ()),
+                                     ('.wave', np.int16, (self.maxnchansperspike,
+                                                          self.maxnt))]:
+            f = NpyFileWriter(fname + ext, dtype, subshape)
+            for partfname in partfnames:
+                f.appendfile(partfname + ext)
+                if delete:
+                    os.remove(partfname + ext)
+            f.close()
+
+    def searchblockstockpt(self, blockis, blockranges, ckptpath):
+        """Search a sequence of blocks of data like searchblocks(), but save each block's
+        spikes and wavedata to checkpoint directory ckptpath as soon as it's done, instead
+        of returning them. blockis are the indices of blockranges in the whole run"""
+        waves = stream.Prefetcher(self.sort.stream, blockranges)
+        for blocki, blockrange, wave in izip(blockis, blockranges, waves):
+            blockspikes, blockwavedata = self.searchblock(blockrange, wave)
+            self.saveckptblock(ckptpath, blocki, blockrange, blockspikes, blockwavedata)
+        self.logmetrics()
+
+    def get_paramhash(self):
+        """Return hash of all the parameters that determine the spikes found by detect(),
+        for checking that a checkpoint was made by an identical run"""
+        sort, stream = self.sort, self.sort.stream
+        params = (stream.fname, stream.sampfreq, stream.shcorrect, stream.filtmeth,
+                  getattr(stream, 'filtmode', None), tuple(sort.tw), list(self.chans),
+                  self.threshmethod, self.noisemethod, self.noisemult, self.fixedthreshuV,
+                  self.fixednoisewin, self.ppthreshmult, self.dt, tuple(self.trange),
+                  self.blocksize, self.blockexcess, self.inclr, self.lockrx,
+                  self.extractparamsondetect)
+        if self.extractparamsondetect:
+            params += (sort.extractor.XYmethod, sort.extractor.maxsigma)
+        return hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+
+    paramhash = property(get_paramhash)
+
+    def ckptfname(self, ckptpath, blocki):
+        """Return start of .spike and .wave filenames of block blocki in checkpoint
+        directory ckptpath"""
+        return os.path.join(ckptpath, 'block%d' % blocki)
+
+    def loadckpt(self, ckptpath, blockranges):
+        """Check checkpoint directory ckptpath for the checkpoint of an interrupted run over
+        blockranges with identical parameters. If there is one, restore that run's
+        thresholds, so that all blocks are searched the same way, and return indices of
+        blocks that have yet to be done. Otherwise, return None"""
+        manifestfname = os.path.join(ckptpath, 'manifest')
+        threshfname = os.path.join(ckptpath, 'thresh.npy')
+        try:
+            with open(manifestfname) as f:
+                lines = f.read().splitlines()
+        except IOError: # no checkpoint
+            return None
+        if not lines or lines[0] != self.paramhash:
+            if lines: # from a run with different parameters, useless
+                print('discarding detection checkpoint %r' % ckptpath)
+            return None
+        self.thresh, self.ppthresh = np.load(threshfname)
+        done = set()
+        # each remaining line records a done block as "blocki t0 t1":
+        for line in lines[1:]:
+            try:
+                blocki, t0, t1 = [ int(x) for x in line.split() ]
+            except ValueError: # incompletely written line
+                continue
+            fname = self.ckptfname(ckptpath, blocki)
+            if (blocki < len(blockranges) and [t0, t1] == list(blockranges[blocki])
+                and os.path.exists(fname + '.spike') and os.path.exists(fname + '.wave')):
+                done.add(blocki)
+        print('resuming detection from checkpoint %r, %d of %d blocks already done'
+              % (ckptpath, len(done), len(blockranges)))
+        return np.array([ blocki for blocki in range(len(blockranges)) if blocki not in done ],
+                        dtype=np.int64)
+
+    def newckpt(self, ckptpath):
+        """Start a new checkpoint in directory ckptpath, replacing any old one, with the
+        current thresholds and parameter hash"""
+        self.clearckpt(ckptpath)
+        if not os.path.isdir(ckptpath):
+            os.makedirs(ckptpath)
+        np.save(os.path.join(ckptpath, 'thresh.npy'), [self.thresh, self.ppthresh])
+        # only a complete manifest marks the checkpoint as valid, so write it last:
+        with open(os.path.join(ckptpath, 'manifest'), 'w') as f:
+            f.write(self.paramhash + '\n')
+
+    def saveckptblock(self, ckptpath, blocki, blockrange, spikes, wavedata):
+        """Save spikes and wavedata of block blocki to checkpoint directory ckptpath, and
+        record it as done in the checkpoint manifest"""
+        fname = self.ckptfname(ckptpath, blocki)
+        for ext, arr in [('.spike', spikes), ('.wave', wavedata)]:
+            tmpfname = fname + ext + '.tmp' # only rename once it's complete
+            with open(tmpfname, 'wb') as f:
+                np.save(f, arr)
+            os.rename(tmpfname, fname + ext)
+        # short appends are atomic, so processes can safely share the manifest:
+        with open(os.path.join(ckptpath, 'manifest'), 'a') as f:
+            f.write('%d %d %d\n' % (blocki, blockrange[0], blockrange[1]))
+
+    def clearckpt(self, ckptpath):
+        """Delete checkpoint files in ckptpath, and ckptpath itself if that leaves it empty.
+        Leave any other files alone"""
+        fnames = glob.glob(os.path.join(ckptpath, 'block*.spike*'))
+        fnames += glob.glob(os.path.join(ckptpath, 'block*.wave*'))
+        fnames += [ os.path.join(ckptpath, 'thresh.npy'), os.path.join(ckptpath, 'manifest') ]
+        for fname in fnames:
+            try: os.remove(fname)
+            except OSError: pass
+        try: os.rmdir(ckptpath)
+        except OSError: pass # doesn't exist, or isn't empty
+
+    def logmetrics(self):
+        """Log cumulative stream metrics of the current process, if enabled"""
+        metrics = self.sort.stream.metrics
+        if metrics.enabled:
+            info('%s: %r' % (ps().name, metrics))
+
+    def searchblock(self, blockrange, wave=None):
         """Search a block of data, return a struct array of valid spikes,
-        along with an array of their wavedata"""
+        along with an array of their wavedata. wave is the block's WaveForm, if it has
+        already been read from the stream"""
         #info('searchblock():')
         stream = self.sort.stream
         cutrange = blockrange.copy() # trange of spikes to keep
@@ -338,10 +671,12 @@ class Detector(object):
         if cutrange[0] != self.trange[0]: cutrange[0] += bx
         if cutrange[1] != self.trange[1]: cutrange[1] -= bx
         info('%s: blockrange: %s, cutrange: %s' % (ps().name, blockrange, cutrange))
-        tslice = time.time()
-        # get WaveForm of multichan data, including excess, ignores out of range data requests:
-        wave = stream(blockrange[0], blockrange[1])
-        print('%s: Stream slice took %.3f sec' % (ps().name, time.time()-tslice))
+        if wave is None:
+            tslice = time.time()
+            # get WaveForm of multichan data, including excess, ignores out of range data
+            # requests. Bypass the block cache, which is for small GUI reads:
+            wave = stream.read(blockrange[0], blockrange[1])
+            print('%s: Stream slice took %.3f sec' % (ps().name, time.time()-tslice))
         tres = stream.tres
 
         if self.threshmethod == 'Dynamic':
@@ -384,6 +719,92 @@ class Detector(object):
         and return only events that fall within cutrange. Search local spatiotemporal
         window around threshold-exceeding peak for biggest peak-to-peak sharpness.
         Finally, test that the sharpest peak and its neighbour exceed Vp and Vpp thresholds"""
+        tsharp = time.time()
+        sharp = util.sharpness2D(wave.data) # sharpness of all zero-crossing separated peaks
+        info('%s: sharpness2D() took %.3f sec' % (ps().name, time.time()-tsharp))
+        targthreshsharp = time.time()
+        # threshold-exceeding peak indices (2D, columns are [tis, cis])
+        peakis = util.argthreshsharp(wave.data, self.thresh, sharp)
+        info('%s: argthreshsharp() took %.3f sec' % (ps().name, time.time()-targthreshsharp))
+        if DEBUG: # only the Python version logs why each peak is or isn't a spike
+            return self.check_peaks_py(wave, cutrange, sharp, peakis)
+        return self.check_peaks(wave, cutrange, sharp, peakis)
+
+    def check_peaks(self, wave, cutrange, sharp, peakis):
+        """Check which threshold-exceeding peaks in peakis look like spikes, and return
+        spikes and wavedata arrays of those that fall within cutrange. Same as
+        check_peaks_py(), but the per-peak search is done by util.check_peaks() without the
+        GIL. Spatial fits on detect, if any, are called back from it"""
+        sort = self.sort
+        AD2uV = sort.converter.AD2uV
+        npeaks = len(peakis)
+        spikes = np.zeros(npeaks, self.SPIKEDTYPE) # nspikes will always be <= npeaks
+        wavedata = np.empty((npeaks, self.maxnchansperspike, self.maxnt), dtype=np.int16)
+        Vs = np.zeros((npeaks, 3), dtype=np.int64) # V0, V1 and Vpp of each spike, in AD
+        # holds time indices for each enabled chan until which each enabled chani is
+        # locked out, updated on every found spike
+        lockouts = np.zeros(self.nchans, dtype=np.int64)
+        # inclusion neighbourhood chanis of each chani, padded to the same length:
+        inclnbhd = np.zeros((self.nchans, self.maxnchansperspike), dtype=np.int64)
+        ninclchans = np.zeros(self.nchans, dtype=np.int64)
+        for chani, inclchanis in self.inclnbhdi.items():
+            inclnbhd[chani, :len(inclchanis)] = inclchanis
+            ninclchans[chani] = len(inclchanis)
+
+        fitspike = None
+        if self.extractparamsondetect:
+            weights2f = sort.extractor.weights2spatial
+            f = sort.extractor.f
+
+            def fitspike(spikei, t0i, t1i, inclchanis, incltis, inclchani):
+                """Save spatial fit params of spike, and return the indices into inclchanis
+                of the chans within lockrx*sx of its fit spatial location, up to a max of
+                self.inclr. Return None if the spike doesn't fit"""
+                inclwindow = wave.data[inclchanis, t0i:t1i]
+                ninclchans = len(inclchanis)
+                inclchans = self.chans[inclchanis]
+                # Get Vpp at each inclchan's tis, use as spatial weights:
+                w = np.float32(inclwindow[np.arange(ninclchans)[:, None], incltis])
+                w = abs(w).sum(axis=1)
+                x = self.siteloc[inclchanis, 0] # 1D array (row)
+                y = self.siteloc[inclchanis, 1]
+                params = weights2f(f, w, x, y, inclchani)
+                if params == None: # presumably a non-localizable many-channel noise event
+                    return None
+                s = spikes[spikei]
+                s['x0'], s['y0'], s['sx'], s['sy'] = params
+                x0, y0 = s['x0'], s['y0']
+                # lockout radius for this spike:
+                lockr = min(self.lockrx*s['sx'], self.inclr) # in um
+                ylockchaniis, = np.where(np.abs(y - y0) <= lockr) # convert bool arr to int
+                # test Euclid distance from x0, y0 for each ylockchani:
+                lockchaniis = ylockchaniis.copy()
+                for ylockchanii in ylockchaniis:
+                    if dist((x[ylockchanii], y[ylockchanii]), (x0, y0)) > lockr:
+                        lockchaniis = np.delete(lockchaniis, ylockchanii) # dist is too great
+                lockchans = inclchans[lockchaniis]
+                nlockchans = len(lockchans)
+                s['lockchans'][:nlockchans], s['nlockchans'] = lockchans, nlockchans
+                return lockchaniis
+
+        twi = sort.twi
+        nspikes = util.check_peaks(wave.data, sharp, np.float64(wave.ts), peakis,
+                                   self.thresh, self.ppthresh, inclnbhd, ninclchans,
+                                   np.int64(self.chans), lockouts, self.dti, twi[0], twi[1],
+                                   cutrange[0], cutrange[1], spikes, wavedata, Vs, fitspike)
+        # trim spikes and wavedata arrays down to size
+        spikes.resize(nspikes, refcheck=False)
+        wds = wavedata.shape
+        wavedata.resize((nspikes, wds[1], wds[2]), refcheck=False)
+        spikes['V0'], spikes['V1'] = AD2uV(Vs[:nspikes, :2].T) # in uV
+        # convert each Vpp on its own, scalar conversion can differ slightly from array:
+        spikes['Vpp'] = [ AD2uV(Vpp) for Vpp in Vs[:nspikes, 2] ] # in uV
+        return spikes, wavedata
+
+    def check_peaks_py(self, wave, cutrange, sharp, peakis):
+        """Check which threshold-exceeding peaks in peakis look like spikes, and return
+        spikes and wavedata arrays of those that fall within cutrange, one peak at a time
+        in Python. Slow, but logs why each peak is or isn't a spike when DEBUG is set"""
         sort = self.sort
         AD2uV = sort.converter.AD2uV
         if self.extractparamsondetect:
@@ -393,14 +814,6 @@ class Detector(object):
         # locked out, updated on every found spike
         lockouts = np.zeros(self.nchans, dtype=np.int64)
 
-        tsharp = time.time()
-        sharp = util.sharpness2D(wave.data) # sharpness of all zero-crossing separated peaks
-        info('%s: sharpness2D() took %.3f sec' % (ps().name, time.time()-tsharp))
-        targthreshsharp = time.time()
-        # threshold-exceeding peak indices (2D, columns are [tis, cis])
-        peakis = util.argthreshsharp(wave.data, self.thresh, sharp)
-        info('%s: argthreshsharp() took %.3f sec' % (ps().name, time.time()-targthreshsharp))
-
         maxti = len(wave.ts) - 1
         dti = self.dti
         twi = sort.twi
@@ -715,6 +1128,48 @@ class Detector(object):
         wavedata.resize((nspikes, wds[1], wds[2]), refcheck=False)
         return spikes, wavedata
 
+    def get_blocknbytes(self, bs):
+        """Estimate peak memory used by one detection process to search blocks of
+        duration bs (us), plus blockexcess at either end. Blocks are read with
+        stream.read(), which bypasses the block cache, so the cache doesn't count"""
+        stream = self.sort.stream
+        nchans = len(stream.chans) # stream returns all its enabled chans
+        rawsampfreq = getattr(stream, 'rawsampfreq', stream.sampfreq)
+        dt = (bs + 2*self.blockexcess) / 1000000 # sec
+        nbytes = nchans * dt * (rawsampfreq * RAWNBYTES + stream.sampfreq * RESAMPLEDNBYTES)
+        return intround(nbytes)
+
+    def autotune(self):
+        """Pick self.blocksize and the max number of processes for detect(), so that all
+        processes together fit within DETECTNBYTES of memory. Use as many cores as
+        possible, and blocks small enough to give each process at least NBLOCKSPERPROCESS
+        of them, but no smaller than MINAUTOBLOCKSIZE to keep blockexcess overlap low.
+        Note that in 'Dynamic' threshmethod, thresholds are calculated per block, and so
+        depend on blocksize. Return the max number of processes"""
+        ncores = mp.cpu_count()
+        # total duration of data to search:
+        tranges = np.asarray(self.sort.stream.tranges)
+        tranges = tranges.clip(self.trange[0], self.trange[1])
+        dt = (tranges[:, 1] - tranges[:, 0]).sum()
+        minnbytes = self.get_blocknbytes(MINAUTOBLOCKSIZE)
+        nprocesses = int(max(min(ncores, DETECTNBYTES // minnbytes), 1))
+        # biggest block that fits within each process' share of memory, given that memory
+        # use is linear in blocksize:
+        nbytes0 = self.get_blocknbytes(0)
+        nbytesperus = (minnbytes - nbytes0) / MINAUTOBLOCKSIZE
+        maxbs = (DETECTNBYTES / nprocesses - nbytes0) / nbytesperus
+        bs = dt / (nprocesses * NBLOCKSPERPROCESS)
+        bs = min(max(bs, MINAUTOBLOCKSIZE), MAXAUTOBLOCKSIZE, maxbs)
+        bs = int(bs // 1000 * 1000) # round down to nearest ms
+        if bs <= 0:
+            raise RuntimeError("DETECTNBYTES = %d is too small to search even a single "
+                               "block of %d chans" % (DETECTNBYTES, len(self.chans)))
+        self.blocksize = bs
+        info('autotune: blocksize = %d us, max %d of %d cores, est. %.1f MB per process, '
+             'DETECTNBYTES = %.1f MB' % (bs, nprocesses, ncores,
+             self.get_blocknbytes(bs) / 2**20, DETECTNBYTES / 2**20))
+        return nprocesses
+
     def get_blockranges(self, bs, bx):
         """Generate time ranges for slightly overlapping blocks of contiguous data that
         span self.trange, given blocksize and blockexcess"""
@@ -748,9 +1203,10 @@ class Detector(object):
         blockranges[0, 0], blockranges[-1, 1] = self.trange[0], self.trange[1]
         return np.asarray(blockranges)
 
-    def get_thresh(self):
+    def get_thresh(self, maxnprocesses=1):
         """Return array of thresholds in AD units, one per chan in self.chans,
-        according to threshmethod and noisemethod"""
+        according to threshmethod and noisemethod. In 'ChanFixed' mode, sampled blocks of
+        data are loaded by up to maxnprocesses processes at once"""
         self.fixedthresh = self.sort.converter.uV2AD(self.fixedthreshuV) # convert to AD units
         if self.threshmethod == 'GlobalFixed': # all chans have the same fixed threshold
             thresh = np.tile(self.fixedthresh, len(self.chans))
@@ -760,23 +1216,29 @@ class Detector(object):
             tload = time.time()
             print('loading data to calculate noise')
             if self.fixednoisewin >= abs(self.trange[1] - self.trange[0]):
-                # sample width exceeds search trange
-                blockranges = [self.trange] # use a single block of data, as defined by trange
+                # sample width exceeds search trange, use all of it, a block at a time:
+                blockranges = self.get_blockranges(self.blocksize, 0)
             else:
                 nblocks = intround(self.fixednoisewin / self.blocksize)
                 blockranges = RandomBlockRanges(self.trange, bs=self.blocksize, bx=0,
                                                 maxntranges=nblocks, replacement=False)
-            # preallocating memory doesn't seem to help here, all the time is in loading
-            # from stream:
-            data = []
-            for blockrange in blockranges:
-                wave = self.sort.stream(blockrange[0], blockrange[1], self.chans)
-                data.append(wave.data)
-            data = np.concatenate(data, axis=1) # int16 AD units
+            # sort blocks so that each process reads its group of them sequentially:
+            blockranges = np.asarray(list(blockranges))
+            blockranges = blockranges[blockranges[:, 0].argsort()]
+            nprocesses = min(maxnprocesses, len(blockranges))
+            if DEBUG or self.mpmethod == 'singleprocess' or nprocesses == 1:
+                stats = self.get_noisestats(blockranges)
+            else:
+                # each process reduces its group of blocks to per-chan noise stats, so only
+                # those and not the blocks themselves are sent back:
+                pool = mp.Pool(nprocesses, initializer, (self,))
+                groups = np.array_split(blockranges, nprocesses)
+                statss = pool.map(callgetnoisestats, groups, chunksize=1)
+                pool.close()
+                pool.join()
+                stats = [ sum(stat) for stat in zip(*statss) ]
             info('loading data to calc noise took %.3f sec' % (time.time()-tload))
-            tnoise = time.time()
-            noise = self.get_noise(data) # float AD units
-            info('get_noise took %.3f sec' % (time.time()-tnoise))
+            noise = self.get_noise_from_stats(stats) # float AD units
             thresh = noise * self.noisemult # float AD units
             thresh = np.int16(np.round(thresh)) # int16 AD units
             # clip so that all thresholds are at least fixedthresh
@@ -789,6 +1251,46 @@ class Detector(object):
             raise ValueError
         return thresh
 
+    def add_noisestats(self, data, stats=None):
+        """Add per-chan noise statistics of data to those in stats, according to
+        .noisemethod: a histogram of abs values for 'median', or number of points, sum and
+        sum of squares for 'stdev'. If stats is None, start new ones. Return stats"""
+        if self.noisemethod == 'median':
+            if stats is None:
+                stats = [None]
+            stats[0] = util.abshist_2Dshort(data, stats[0])
+        elif self.noisemethod == 'stdev':
+            if stats is None:
+                stats = [ np.zeros(len(data), dtype=np.int64) for i in range(3) ]
+            stats[0] += data.shape[1]
+            stats[1] += data.sum(axis=1, dtype=np.int64)
+            stats[2] += np.einsum('ij,ij->i', data, data, dtype=np.int64)
+        else:
+            raise ValueError
+        return stats
+
+    def get_noisestats(self, blockranges):
+        """Load blockranges of self.chans, reading ahead while reducing each one to noise
+        statistics. Return noise statistics of all of them together"""
+        stats = None
+        waves = stream.Prefetcher(self.sort.stream, blockranges, chans=self.chans)
+        for wave in waves:
+            stats = self.add_noisestats(wave.data, stats)
+        self.logmetrics()
+        return stats
+
+    def get_noise_from_stats(self, stats):
+        """Calculate noise per chan from noise statistics, using .noisemethod"""
+        if self.noisemethod == 'median':
+            hist, = stats
+            noise = util.median_hist(hist) / 0.6745 # see Quiroga2004
+        elif self.noisemethod == 'stdev':
+            n, s, ss = [ np.float64(stat) for stat in stats ]
+            noise = np.sqrt(ss/n - (s/n)**2)
+        else:
+            raise ValueError
+        return noise
+
     def get_noise(self, data):
         """Calculates noise over last dim in data (time), using .noisemethod"""
         #print('calculating noise')
@@ -797,8 +1299,8 @@ class Detector(object):
         if self.noisemethod == 'median':
             #noise = pool.map(self.get_median, data) # multithreads over rows in data
             #noise = np.median(np.abs(data), axis=-1) / 0.6745 # see Quiroga2004
-            # np.abs does a copy, so modifying the result in-place is safe:
-            noise = util.median_inplace_2Dshort(np.abs(data)) / 0.6745 # see Quiroga2004
+            # exact median of abs values from per-chan histograms, without copying data:
+            noise = util.median_hist(util.abshist_2Dshort(data)) / 0.6745 # see Quiroga2004
             #noise = np.mean(np.abs(data), axis=-1) / 0.6745 / 1.2
             #noise = util.mean_2Dshort(np.abs(data)) / 0.6745 # see Quiroga2004
         elif self.noisemethod == 'stdev':
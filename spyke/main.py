@@ -41,6 +41,7 @@ import time
 import datetime
 import gc
 import cPickle
+import multiprocessing as mp
 import random
 from copy import copy
 from struct import unpack
@@ -53,7 +54,7 @@ import core
 from core import toiter, tocontig, intround, MICRO, ClusterChange, SpykeToolWindow
 from core import DJS, g
 import stream
-from stream import SimpleStream, MultiStream
+from stream import SimpleStream, MultiStream, SurfStream, NSXStream
 import surf, nsx
 from sort import Sort, SortWindow, NSLISTWIDTH, MEANWAVEMAXSAMPLES
 from plot import SpikePanel, ChartPanel, LFPPanel
@@ -100,6 +101,16 @@ WINDOWUPDATEORDER = ['Spike', 'LFP', 'Chart'] # chart goes last cuz it's slowest
 # instead for speed:
 NDIRTYSIDSTHRESH = 200000
 
+# write spikes and wavedata straight to .spike and .wave files in sortpath during detection,
+# and keep them memory-mapped instead of in memory. Useful for very long recordings:
+OUTOFCOREDETECT = False
+# save each detected block to a checkpoint directory in sortpath, so that an interrupted
+# detection run can be resumed by rerunning it with identical parameters:
+CHECKPOINTDETECT = False
+# open .ns6 files as if they're still being recorded to, so that spikes can be detected in
+# them as they grow, see SpykeWindow.follow():
+FOLLOWNS6 = False
+
 
 class SpykeWindow(QtGui.QMainWindow):
     """spyke's main window, uses gui layout generated by QtDesigner"""
@@ -240,6 +251,10 @@ class SpykeWindow(QtGui.QMainWindow):
     def on_actionSaveParse_triggered(self):
         self.hpstream.pickle()
 
+    @QtCore.pyqtSlot()
+    def on_actionMaterializeStream_triggered(self):
+        self.MaterializeStream()
+
     @QtCore.pyqtSlot()
     def on_actionExportPtcsFiles_triggered(self):
         path = getExistingDirectory(self, caption="Export .ptcs file(s) to",
@@ -414,19 +429,7 @@ class SpykeWindow(QtGui.QMainWindow):
             try: os.mkdir(path)
             except OSError: pass # path already exists?
             fullfname = os.path.join(path, stream.srcfnameroot+ext)
-            s = stream
-            wave = s[s.t0:s.t1]
-            if format == 'binary':
-                chanpos = s.probe.siteloc_arr()
-                uVperAD = s.converter.AD2uV(1)
-                with open(fullfname, 'wb') as f:
-                    np.savez_compressed(f, data=wave.data, chans=wave.chans, t0=s.t0,
-                                        t1=s.t1, tres=s.tres, chanpos=chanpos,
-                                        uVperAD=uVperAD)
-            elif format == 'text':
-                np.savetxt(fullfname, wave.data, fmt='%d', delimiter=',') # data should be int
-            else:
-                raise ValueError('unknown format: %r' % format)
+            stream.export_lfp(fullfname, format=format)
             print(fullfname)
 
     @QtCore.pyqtSlot()
@@ -436,11 +439,10 @@ class SpykeWindow(QtGui.QMainWindow):
 
     def exportDat(self):
         """Export raw ephys data to .dat file, in (ti, chani) order"""
-        ext = self.hpstream.get_ext()
-        if ext == '.ns6':
-            self.hpstream.f.export_dat()
-        else:
-            raise NotImplementedError("Can't (yet) export raw ephys data from %s to .dat")
+        if not hasattr(self.hpstream, 'export_dat'): # e.g. SimpleStream
+            raise NotImplementedError("Can't (yet) export raw ephys data from %s to .dat"
+                                      % self.hpstream.ext)
+        self.hpstream.export_dat()
 
     def update_sort_version(self):
         """Update self.sort to latest version"""
@@ -825,6 +827,14 @@ class SpykeWindow(QtGui.QMainWindow):
         enable = self.ui.actionSampleAndHoldCorrect.isChecked()
         self.SetSHCorrect(enable)
 
+    @QtCore.pyqtSlot()
+    def on_actionStreamingFiltmode_triggered(self):
+        """Streaming filter mode menu event"""
+        if self.ui.actionStreamingFiltmode.isChecked():
+            self.SetFiltmode('streaming')
+        else:
+            self.SetFiltmode('padded')
+
     #def onFilePosLineEdit_textChanged(self, text): # updates immediately
     def on_filePosLineEdit_editingFinished(self): # updates on Enter/loss of focus
         text = str(self.ui.filePosLineEdit.text())
@@ -889,9 +899,31 @@ class SpykeWindow(QtGui.QMainWindow):
         self.get_detector() # update Sort's current detector with new one from widgets
         if sort.detector.extractparamsondetect:
             self.init_extractor() # init the Extractor
-        sort.spikes, sort.wavedata = sort.detector.detect() # struct array of spikes, 3D array
+        if CHECKPOINTDETECT:
+            ckptpath = join(self.sortpath, self.hpstream.fname + '.ckpt')
+        else:
+            ckptpath = None
+        if OUTOFCOREDETECT:
+            # name the sort and its .spike and .wave files in advance, the same way
+            # on_actionSaveSortAs_triggered() does:
+            fname = self.hpstream.fname.replace(' ', '_')
+            dt = str(datetime.datetime.now()) # get a detection timestamp
+            dt = dt.split('.')[0] # ditch the us
+            dt = dt.replace(' ', '_')
+            dt = dt.replace(':', '.')
+            fname = fname + '_' + dt
+            # memory-mapped struct array of spikes, 3D array:
+            sort.spikes, sort.wavedata = sort.detector.detect(join(self.sortpath, fname),
+                                                              ckptpath=ckptpath)
+            sort.fname = fname + '.sort'
+            sort.spikefname = fname + '.spike'
+            sort.wavefname = fname + '.wave'
+        else:
+            # struct array of spikes, 3D array:
+            sort.spikes, sort.wavedata = sort.detector.detect(ckptpath=ckptpath)
         sort.update_usids()
         sort.filtmeth = sort.stream.filtmeth # lock down filtmeth attrib
+        sort.filtmode = getattr(sort.stream, 'filtmode', None) # only NSXStreams have one
         sort.sampfreq = sort.stream.sampfreq # lock down sampfreq and shcorrect attribs
         sort.shcorrect = sort.stream.shcorrect
 
@@ -901,6 +933,68 @@ class SpykeWindow(QtGui.QMainWindow):
         if sort.nspikes > 0:
             self.on_plotButton_clicked()
 
+    def follow(self, interval=None):
+        """Detect spikes in data recorded to the open, still growing .ns6 file since the
+        last detection, and append them to the sort. If interval (sec) is given, keep doing
+        so every interval sec, until called again with interval=0. Call from the shell
+        window, after a first detection with the Detect button"""
+        if interval is not None:
+            try:
+                self.followtimer.stop()
+            except AttributeError: # first call
+                self.followtimer = QtCore.QTimer(self)
+                self.followtimer.timeout.connect(self.follow)
+            if interval > 0:
+                self.followtimer.start(intround(interval * 1000)) # ms
+            return
+        sort = self.sort
+        spikes, wavedata = sort.detector.follow()
+        sort.append_spikes(spikes, wavedata)
+        # show newly recorded data:
+        self.str2t['end'] = self.hpstream.t1
+        self.range = (self.hpstream.t0, self.hpstream.t1) # us
+        self.ui.filePosEndButton.setText(str(self.hpstream.t1))
+        self.ui.slider.setRange(self.range[0] // SLIDERTRES, self.range[1] // SLIDERTRES)
+        self.ui.progressBar.setFormat("%d spikes" % sort.nspikes)
+        if len(spikes) > 0 and 'Sort' in self.windows:
+            self.windows['Sort'].uslist.updateAll()
+
+    def redetect(self):
+        """Redetect spikes within just the Detect pane's time range, with the rest of its
+        current settings, and splice them into the sort in place of the spikes already
+        there. Clusters are left intact outside of the time range, and any left with no
+        spikes are deleted. Clears the undo/redo stack, and is not undoable. Call from the
+        shell window"""
+        sort = self.sort
+        olddet = sort.detector
+        self.get_detector() # new Detector from widgets, just for this time range
+        det = sort.detector
+        sort.detector = olddet # still describes the sort as a whole
+        if det.extractparamsondetect and not hasattr(sort, 'extractor'):
+            self.init_extractor()
+        spikes, wavedata = det.redetect()
+        sort.splice_spikes(det.trange, spikes, wavedata)
+        # the kept detector has to describe the spliced spikes too, which may use chans it
+        # didn't have enabled, or more chans per spike than it had room for:
+        olddet.chans = np.union1d(olddet.chans, det.chans)
+        olddet.calc_chans() # update dm and chan neighbourhoods to match
+        olddet.maxnchansperspike = sort.wavedata.shape[1]
+        olddet.SPIKEDTYPE = sort.spikes.dtype.descr
+        emptyclusters = [ sort.clusters[nid] for nid, neuron in sort.neurons.items()
+                          if neuron.nspikes == 0 ]
+        if emptyclusters:
+            self.DelClusters(emptyclusters)
+        # cluster changes in stack no longer applicable, reset cchanges:
+        del self.cchanges[:]
+        self.cci = -1
+        self.ui.progressBar.setFormat("%d spikes" % sort.nspikes)
+        if 'Sort' in self.windows:
+            sw = self.windows['Sort']
+            sw.nslist.neurons = sw.nslist.neurons # trigger nslist refresh
+            sw.uslist.updateAll()
+        print('replaced spikes within trange %r with %d redetected spikes'
+              % (det.trange, len(spikes)))
+
     def init_extractor(self):
         """Initialize Extractor"""
         #XYmethod = self.XY_extract_radio_box.GetStringSelection()
@@ -2163,6 +2257,29 @@ class SpykeWindow(QtGui.QMainWindow):
             critical(self, "Error", "%s is not a .srf, .ns6, .track, .tsf, .mat, .event*.zip "
                      "or .sort file" % fname)
 
+    def ParseTrackFiles(self, fns):
+        """Parse all .srf files in fns that don't yet have a .parse file, concurrently in a
+        pool of processes, one file per process, so that opening a track takes about as
+        long as parsing its slowest file. .ns6 files parse their headers on open, and don't
+        need this"""
+        srffns = [ fn for fn in fns if os.path.splitext(fn)[1] == '.srf'
+                   and not os.path.exists(join(self.streampath, fn + '.parse')) ]
+        nfiles = len(srffns)
+        if nfiles == 0:
+            return
+        t0 = time.time()
+        nprocesses = min(mp.cpu_count(), nfiles)
+        pool = mp.Pool(nprocesses)
+        args = [ (fn, self.streampath) for fn in srffns ]
+        try:
+            for i, fn in enumerate(pool.imap_unordered(surf.parsefile, args)):
+                print('parsed %r (%d of %d files)' % (fn, i+1, nfiles))
+        finally: # all results are in, or parsing failed, don't leave any workers behind
+            pool.terminate()
+            pool.join()
+        print('parsing %d files in %d processes took %.3f sec'
+              % (nfiles, nprocesses, time.time()-t0))
+
     def OpenStreamFile(self, fname):
         """Open a stream (.srf, .nsx, .track, or .tsf file) and update display accordingly.
         fname is assumed to be relative to self.streampath"""
@@ -2175,7 +2292,8 @@ class SpykeWindow(QtGui.QMainWindow):
             self.hpstream = f.hpstream # highpass record (spike) stream
             self.lpstream = f.lpstream # lowpassmultichan record (LFP) stream
         elif ext == '.ns6':
-            f = nsx.File(fname, self.streampath) # parses immediately
+            # parses immediately:
+            f = nsx.File(fname, self.streampath, follow=FOLLOWNS6)
             self.hpstream = f.hpstream # highpass record (spike) stream
             self.lpstream = f.lpstream # lowpassmultichan record (LFP) stream
             try:
@@ -2183,19 +2301,22 @@ class SpykeWindow(QtGui.QMainWindow):
             except AttributeError: # no sort exists, enable Filtering menu
                 self.EnableFilteringMenu(True) # for now only .ns6 requires filtering
         elif ext == '.track':
-            fs = []
+            fns = []
             with open(join(self.streampath, fname), 'r') as trackfile:
                 for line in trackfile: # one filename per line
                     if line.startswith('#'): # it's a comment line
                         continue # skip it
-                    fn = line.rstrip('\n')
-                    fext = os.path.splitext(fn)[1]
-                    if fext == '.srf':
-                        f = surf.File(fn, self.streampath)
-                        f.parse()
-                    elif fext == '.ns6':
-                        f = nsx.File(fn, self.streampath)
-                    fs.append(f) # build up list of open and parsed data file objects
+                    fns.append(line.rstrip('\n'))
+            self.ParseTrackFiles(fns)
+            fs = []
+            for fn in fns:
+                fext = os.path.splitext(fn)[1]
+                if fext == '.srf':
+                    f = surf.File(fn, self.streampath)
+                    f.parse() # should just unpickle from .parse file by now
+                elif fext == '.ns6':
+                    f = nsx.File(fn, self.streampath)
+                fs.append(f) # build up list of open and parsed data file objects
             self.hpstream = MultiStream(fs, fname, kind='highpass')
             self.lpstream = MultiStream(fs, fname, kind='lowpass')
             ext = fext # for setting *tw variables below
@@ -2221,6 +2342,8 @@ class SpykeWindow(QtGui.QMainWindow):
         self.updateRecentFiles(join(self.streampath, fname))
 
         self.ui.__dict__['actionFiltmeth%s' % self.hpstream.filtmeth ].setChecked(True)
+        self.ui.actionStreamingFiltmode.setChecked(
+            getattr(self.hpstream, 'filtmode', None) == 'streaming')
         self.ui.__dict__['action%dkHz' % (self.hpstream.sampfreq / 1000)].setChecked(True)
         self.ui.actionSampleAndHoldCorrect.setChecked(self.hpstream.shcorrect)
 
@@ -2644,8 +2767,9 @@ class SpykeWindow(QtGui.QMainWindow):
         # restore Sort's tw to self and to spike and sort windows, if applicable:
         #print('sort.tw is %r' % (sort.tw,))
         self.update_spiketw(sort.tw)
-        # restore filtering method:
+        # restore filtering method and mode:
         self.SetFiltmeth(sort.filtmeth)
+        self.SetFiltmode(getattr(sort, 'filtmode', None))
         # restore sampling variables:
         self.SetSampfreq(sort.sampfreq)
         self.SetSHCorrect(sort.shcorrect)
@@ -2822,9 +2946,12 @@ class SpykeWindow(QtGui.QMainWindow):
             self.dirtysids.clear() # no longer dirty
         print('saving spike file %r' % fname)
         t0 = time.time()
-        f = open(join(self.sortpath, fname), 'wb')
-        np.save(f, s.spikes)
-        f.close()
+        if core.ismemmapof(s.spikes, join(self.sortpath, fname)):
+            s.spikes.flush() # spikes were detected straight to this file
+        else:
+            f = open(join(self.sortpath, fname), 'wb')
+            np.save(f, s.spikes)
+            f.close()
         print('done saving spike file, took %.3f sec' % (time.time()-t0))
         s.spikefname = fname # used to indicate that the spikes have been saved
 
@@ -2840,7 +2967,10 @@ class SpykeWindow(QtGui.QMainWindow):
         t0 = time.time()
         if sids != None and len(sids) >= NDIRTYSIDSTHRESH:
             sids = None # resave all of them for speed
-        if sids is None: # write the whole file
+        if core.ismemmapof(s.wavedata, join(self.sortpath, fname)):
+            print('flushing wave file %r' % fname) # wavedata was detected straight to it
+            s.wavedata.flush()
+        elif sids is None: # write the whole file
             print('updating all %d spikes in wave file %r' % (s.nspikes, fname))
             f = open(join(self.sortpath, fname), 'wb')
             np.save(f, s.wavedata)
@@ -3100,6 +3230,23 @@ class SpykeWindow(QtGui.QMainWindow):
             if wintype in ['Spike', 'Chart', 'LFP', 'Sort']:
                 window.panel.show_ref(ref, enable=enable)
 
+    def MaterializeStream(self):
+        """Replace the open highpass stream with one served from a .npy sidecar file of its
+        fully preprocessed data of the currently enabled chans, writing the sidecar first
+        unless it already exists, see Stream.materialize(). Filtering and sampling are
+        fixed from then on"""
+        if type(self.hpstream) not in [SurfStream, NSXStream]: # e.g. MultiStream
+            raise NotImplementedError("Can't materialize %s stream"
+                                      % type(self.hpstream).__name__)
+        self.hpstream = self.hpstream.materialize()
+        try:
+            self.sort.stream = self.hpstream
+        except AttributeError: # no sort yet
+            pass
+        self.EnableFilteringMenu(False)
+        self.EnableSamplingMenu(False)
+        self.plot()
+
     def SetFiltmeth(self, filtmeth):
         """Set highpass filter method"""
         if self.hpstream != None:
@@ -3107,6 +3254,14 @@ class SpykeWindow(QtGui.QMainWindow):
             self.plot()
         self.ui.__dict__['actionFiltmeth%s' % filtmeth].setChecked(True)
 
+    def SetFiltmode(self, filtmode):
+        """Set highpass filter mode, 'padded' or 'streaming'. Only .nsx streams have one"""
+        if self.hpstream != None and hasattr(self.hpstream, 'filtmode'):
+            self.hpstream.filtmode = filtmode or core.DEFNSXFILTMODE
+            self.plot()
+        self.ui.actionStreamingFiltmode.setChecked(
+            getattr(self.hpstream, 'filtmode', None) == 'streaming')
+
     def SetSampfreq(self, sampfreq):
         """Set highpass stream sampling frequency, update widgets"""
         if self.hpstream != None:
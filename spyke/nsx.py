@@ -16,23 +16,21 @@ import cPickle
 from struct import Struct, unpack
 import datetime
 
-from core import NULL, rstripnonascii, intround
-from stream import NSXStream
+from core import NULL, rstripnonascii, intround, DATCHUNKNT
+from stream import NSXStream, blockcache
 
 
 class File(object):
-    """Open an .nsx file and expose its header fields and data as attribs"""
-    def __init__(self, fname, path):
+    """Open an .nsx file and expose its header fields and data as attribs. If follow is
+    True, the file may still be being recorded to, see update()"""
+    def __init__(self, fname, path, follow=False):
         self.fname = fname
         self.path = path
+        self.follow = follow
         self.filesize = os.stat(self.join(fname))[6] # in bytes
         self.open() # calls parse() and load()
 
-        self.datapacketoffset = self.datapacket.offset # save for unpickling
-        self.t0i, self.nt = self.datapacket.t0i, self.datapacket.nt # copy for convenience
-        self.t1i = self.t0i + self.nt - 1
-        self.t0 = self.t0i * self.fileheader.tres # us
-        self.t1 = self.t1i * self.fileheader.tres # us
+        self.datapacketoffset = self.datapackets[0].offset # save for unpickling
         self.hpstream = NSXStream(self, kind='highpass')
         self.lpstream = NSXStream(self, kind='lowpass')
 
@@ -56,8 +54,9 @@ class File(object):
         if self.is_open():
             # the only way to close a np.memmap is to close its underlying mmap and make sure
             # there aren't any remaining handles to it
-            self.datapacket._data._mmap.close()
-            del self.datapacket._data
+            for datapacket in self.datapackets:
+                datapacket._data._mmap.close()
+                del datapacket._data
             self.f.close()
 
     def is_open(self):
@@ -84,16 +83,82 @@ class File(object):
     def load(self):
         """Load the waveform data. Data are stored in packets. Normally, there is only one
         long contiguous data packet, but if there are pauses during the recording, the
-        data is broken up into multiple packets, with a time gap between each one. Need
-        to step over all chans, including aux chans, so pass nchanstotal instead of nchans"""
-        datapacket = DataPacket(self.f, self.fileheader.nchanstotal)
-        if self.f.tell() != self.filesize: # make sure we're at EOF
-            raise NotImplementedError("Can't handle pauses in recording yet")
-        self.datapacket = datapacket
+        data is broken up into multiple packets, with a time gap between each one. Each
+        packet is memory-mapped separately, and indexed by its first timepoint and its
+        number of timepoints. Need to step over all chans, including aux chans, so pass
+        nchanstotal instead of nchans"""
+        nchanstotal = self.fileheader.nchanstotal
+        follow = getattr(self, 'follow', False) # missing in files unpickled from old .sort
+        if follow: # file may have grown since it was last loaded
+            self.filesize = os.stat(self.join(self.fname))[6]
+            growingsize = self.filesize # last packet may still be growing
+        else:
+            growingsize = None
+        datapackets = []
+        while self.f.tell() < self.filesize:
+            datapacket = DataPacket(self.f, nchanstotal, growingsize)
+            # np.memmap doesn't advance the file pointer, so step over the data explicitly:
+            self.f.seek(datapacket.dataoffset + datapacket.nt*nchanstotal*2)
+            if datapacket.nt > 0: # skip empty packets
+                datapackets.append(datapacket)
+            if datapacket.growing: # anything after it is a partially written timepoint
+                break
+        if not follow and self.f.tell() != self.filesize: # make sure we're exactly at EOF
+            raise ValueError('last data packet in %r is truncated' % self.fname)
+        if len(datapackets) == 0:
+            raise ValueError('no data packets found in %r' % self.fname)
+        self.datapackets = datapackets
+        self.datapacket = datapackets[0] # first (normally only) data packet
+        # packet index, sorted by time. Do this here instead of in __init__ so that
+        # files unpickled from older .sort files get it too:
+        self.packett0is = np.int64([ datapacket.t0i for datapacket in datapackets ])
+        self.packetnts = np.int64([ datapacket.nt for datapacket in datapackets ])
+        assert (np.diff(self.packett0is) >= self.packetnts[:-1]).all() # no overlap
+        # contiguous time ranges, one per packet, in us:
+        tres = self.fileheader.tres
+        self.tranges = np.int64(np.column_stack([self.packett0is * tres,
+                                                 (self.packett0is+self.packetnts-1) * tres]))
+        # span all data packets, including any gaps between them:
+        self.t0i = self.packett0is[0]
+        self.t1i = self.packett0is[-1] + self.packetnts[-1] - 1
+        self.nt = self.t1i - self.t0i + 1
+        self.t0 = self.t0i * tres # us
+        self.t1 = self.t1i * tres # us
+
+    def update(self):
+        """Reload data packets of a file that's still being recorded to, so that they
+        include any data written since the file was last loaded, and extend the time ranges
+        of self and its streams accordingly. Return number of new timepoints"""
+        self.follow = True
+        nt = self.nt
+        # leave old memmaps to be closed once they're no longer in use, say by a
+        # Prefetcher thread:
+        self.f.seek(self.datapacketoffset)
+        self.load()
+        for stream in [self.hpstream, self.lpstream]:
+            stream.t1, stream.tranges = self.t1, self.tranges
+            blockcache.invalidate(stream) # last cached block may have been cut short
+            # so may the last filtered chunk, which was filtered against zeros past the old
+            # end of the file:
+            stream.__dict__.pop('_filtstate', None)
+            stream.__dict__.pop('_chunkstate', None)
+        return self.nt - nt
 
     def get_data(self):
+        """Return ephys data of all data packets, from self.t0i to self.t1i. Normally,
+        there's only one data packet, and this is a view into its memmap. Otherwise, data of
+        all packets are copied into a new array, and any gaps between them are filled with
+        zeros, same as in NSXStream.loadraw()"""
+        nchans = self.fileheader.nchans
         try:
-            return self.datapacket._data[:self.fileheader.nchans] # return only ephys data
+            datapackets = self.datapackets
+            if len(datapackets) == 1:
+                return datapackets[0]._data[:nchans]
+            data = np.zeros((nchans, self.nt), dtype=np.int16) # any gaps will have zeros
+            for datapacket in datapackets:
+                t0i = datapacket.t0i - self.t0i
+                data[:, t0i:t0i+datapacket.nt] = datapacket._data[:nchans]
+            return data
         except AttributeError:
             raise RuntimeError('waveform data not available, file is closed/mmap deleted?')
 
@@ -106,12 +171,15 @@ class File(object):
         except KeyError: pass
         try: del d['datapacket'] # avoid pickling datapacket._data mmap
         except KeyError: pass
+        try: del d['datapackets'] # ditto
+        except KeyError: pass
         return d
 
     def export_dat(self, dt=None):
-        """Export contiguous data packet to .dat file, in the original (ti, chani) order
-        using same base file name in the same folder. dt is duration to export from start
-        of recording, in sec"""
+        """Export data packets to .dat file, in the original (ti, chani) order using same
+        base file name in the same folder. Any gaps between data packets are filled with
+        zeros, so that timepoints in the .dat file stay evenly spaced. dt is duration to
+        export from start of recording, in sec"""
         if dt == None:
             nt = self.nt
             dtstr = ''
@@ -120,23 +188,46 @@ class File(object):
             dtstr = str(dt)
         assert self.is_open()
         nchanstotal = self.fileheader.nchanstotal
-        nbytes = nt * nchanstotal * 2 # number of bytes requested, 2 bytes per datapoint
-        offset = self.datapacket.dataoffset
-        self.f.seek(offset)
         datbasefname = os.path.splitext(self.fname)[0]
         fulldatfname = self.join('%s_%ss.dat' % (datbasefname, dtstr))
         print('writing raw ephys data to %r' % fulldatfname)
-        print('starting from dataoffset at %d bytes' % offset)
+        print('starting from dataoffset at %d bytes' % self.datapacket.dataoffset)
         with open(fulldatfname, 'wb') as datf:
-            datf.write(self.f.read(nbytes))
-        nbyteswritten = self.f.tell() - offset
-        print('%d bytes written' % nbyteswritten)
-        print('%d attempted, %d actual timepoints written' % (nt, nbyteswritten/nchanstotal/2))
+            ntwritten = self.write_dat(datf, nt)
+        print('%d bytes written' % (ntwritten*nchanstotal*2))
+        print('%d attempted, %d actual timepoints written' % (nt, ntwritten))
         print('voltage gain: %g uV/AD' % self.fileheader.AD2uVx)
         print('sample rate: %d Hz' % self.fileheader.sampfreq)
         print('total number of chans: %d' % nchanstotal)
         print('total number of ephys chans: %d' % self.fileheader.nchans)
 
+    def write_dat(self, datf, nt=None, chunknt=DATCHUNKNT):
+        """Write the first nt timepoints (defaults to all of them) of all chans to open
+        .dat file datf, in the original (ti, chani) order, zero-filling any gaps between data
+        packets. Data are copied at most chunknt timepoints at a time, so memory use doesn't
+        depend on packet size. Return number of timepoints written"""
+        if nt == None:
+            nt = self.nt
+        nchanstotal = self.fileheader.nchanstotal
+        ntwritten = 0 # number of timepoints written so far
+        for datapacket in self.datapackets:
+            ntgap = min(datapacket.t0i - self.t0i - ntwritten, nt - ntwritten)
+            while ntgap > 0: # zero-fill gap since end of previous packet
+                ntchunk = min(ntgap, chunknt)
+                datf.write(np.zeros(ntchunk*nchanstotal, dtype=np.int16).tostring())
+                ntwritten += ntchunk
+                ntgap -= ntchunk
+            ntpacket = min(datapacket.nt, nt - ntwritten)
+            if ntpacket <= 0:
+                break
+            self.f.seek(datapacket.dataoffset)
+            while ntpacket > 0:
+                ntchunk = min(ntpacket, chunknt)
+                datf.write(self.f.read(ntchunk*nchanstotal*2)) # 2 bytes per datapoint
+                ntwritten += ntchunk
+                ntpacket -= ntchunk
+        return ntwritten
+
 
 class FileHeader(object):
     """.nsx file header. Takes an open file, parses in from current file
@@ -226,7 +317,10 @@ class ChanHeader(object):
 class DataPacket(object):
     """.nsx data packet"""
     
-    def __init__(self, f, nchans):
+    def __init__(self, f, nchans, growingsize=None):
+        """If growingsize is given, the packet may still be being written to a file that is
+        currently growingsize bytes long. Its number of timepoints is then limited to those
+        that have been completely written so far"""
         self.offset = f.tell()
         self.nchans = nchans
         header, = unpack('B', f.read(1))
@@ -234,6 +328,13 @@ class DataPacket(object):
         # nsamples offset of first timepoint from t=0; number of timepoints:
         self.t0i, self.nt = unpack('II', f.read(8))
         self.dataoffset = f.tell()
+        self.growing = False
+        if growingsize is not None:
+            # number of timepoints field isn't necessarily updated until recording stops:
+            ntwritten = (growingsize - self.dataoffset) // (nchans*2)
+            if self.nt == 0 or self.nt > ntwritten:
+                self.nt = ntwritten
+                self.growing = True
 
         # load all data into memory using np.fromfile. Time is MSB, chan is LSB:
         #self._data = np.fromfile(f, dtype=np.int16, count=self.nt*nchans)
@@ -128,12 +128,14 @@ class Sort(object):
             return None
 
     def set_stream(self, stream=None):
-        """Check stream type and name and probe type, and restore filtmeth, sampfreq and
-        shcorrect to stream when binding/modifying stream to self"""
+        """Check stream type and name and probe type, and restore filtmeth, filtmode,
+        sampfreq and shcorrect to stream when binding/modifying stream to self"""
         oldstream = self.stream
         if stream != None and oldstream != None:
-            # does new stream type match old stream type?
-            assert type(stream) == type(oldstream)
+            # does new stream type match old stream type? For materialized streams,
+            # compare type of their source stream:
+            assert (getattr(stream, 'srctype', type(stream)) ==
+                    getattr(oldstream, 'srctype', type(oldstream)))
             # does new stream fname match old stream fname?
             assert stream.fname == oldstream.fname
             # does new stream probe type match old stream probe type?
@@ -144,6 +146,8 @@ class Sort(object):
                 stream.shcorrect = self.shcorrect
             except AttributeError:
                 pass # self.filtmeth/sampfreq/shcorrect aren't bound
+            if hasattr(self, 'filtmode') and hasattr(stream, 'filtmode'):
+                stream.filtmode = self.filtmode
         self._stream = stream # set it
         print('bound stream %r to sort %r' % (stream.fname, self.fname))
         # now that tres is known, calculate window timepoints wrt spike time:
@@ -207,6 +211,93 @@ class Sort(object):
         nids = self.spikes['nid']
         self.usids, = np.where(nids == 0) # 0 means unclustered
 
+    def append_spikes(self, spikes, wavedata):
+        """Append spikes and their wavedata, say newly detected in a still growing
+        recording, to the end of self.spikes and self.wavedata. Their ids should continue on
+        from the last spike's"""
+        assert len(spikes) == len(wavedata)
+        if len(spikes) == 0:
+            return
+        assert spikes['id'][0] == self.nspikes
+        self.spikes = np.concatenate([self.spikes, spikes])
+        self.wavedata = np.concatenate([self.wavedata, wavedata])
+        self.update_usids()
+        # .wave file, if any, is missing the new spikes, resave all of it next time:
+        try: del self.wavefname
+        except AttributeError: pass
+
+    def splice_spikes(self, trange, spikes, wavedata):
+        """Replace all spikes within trange with spikes and their wavedata, say from
+        redetection of just that window with different thresholds or chans. Spikes within
+        trange are removed from their neurons, and the new ones are left unsorted. Spikes
+        outside of trange keep their neurons, and neuron sids are remapped to the new
+        spike ids. Return the old to new spike id table, with -1 for removed spikes"""
+        assert len(spikes) == len(wavedata)
+        t0, t1 = trange
+        spikes, wavedata = self.conform_spikes(spikes, wavedata) # might widen self.spikes
+        oldspikes = self.spikes
+        nold = len(oldspikes)
+        sid0, sid1 = oldspikes['t'].searchsorted(t0), oldspikes['t'].searchsorted(t1, 'right')
+        dn = len(spikes) - (sid1 - sid0) # change in number of spikes
+        self.spikes = np.concatenate([oldspikes[:sid0], spikes, oldspikes[sid1:]])
+        self.wavedata = np.concatenate([self.wavedata[:sid0], wavedata,
+                                        self.wavedata[sid1:]])
+        self.spikes['id'][sid0:] = np.arange(sid0, nold+dn)
+        self.spikes['nid'][sid0:sid0+len(spikes)] = 0
+        # old to new spike id table:
+        old2new = np.arange(nold)
+        old2new[sid0:sid1] = -1
+        old2new[sid1:] += dn
+        for neuron in self.neurons.values():
+            sids = old2new[neuron.sids]
+            keep = sids >= 0
+            if not keep.all():
+                neuron.wave.data = None # trigger template mean update
+            neuron.sids = sids[keep]
+        self.update_usids()
+        self.X = {} # clear the dimension reduction cache, it's keyed by old sids
+        # .wave file, if any, is out of date, resave all of it next time:
+        try: del self.wavefname
+        except AttributeError: pass
+        return old2new
+
+    def conform_spikes(self, spikes, wavedata):
+        """Return spikes and wavedata converted to the dtype and shape of self.spikes and
+        self.wavedata, say if they were detected with a different max chans per spike. If
+        they have more chans than self has room for, widen self.spikes and self.wavedata
+        to make room. Raise a ValueError if they have a different number of timepoints"""
+        if wavedata.shape[2] != self.wavedata.shape[2]:
+            raise ValueError("spikes have %d timepoints, sort's have %d"
+                             % (wavedata.shape[2], self.wavedata.shape[2]))
+        if wavedata.shape[1] > self.wavedata.shape[1]:
+            self.spikes, self.wavedata = self.widen_spikes(self.spikes, self.wavedata,
+                                                           wavedata.shape[1])
+        if spikes.dtype == self.spikes.dtype and wavedata.shape[1:] == self.wavedata.shape[1:]:
+            return spikes, wavedata
+        return self.widen_spikes(spikes, wavedata, self.wavedata.shape[1],
+                                 dtype=self.spikes.dtype)
+
+    def widen_spikes(self, spikes, wavedata, nchans, dtype=None):
+        """Return copies of spikes and wavedata with room for nchans chans per spike.
+        Per-chan fields (chans, lockchans and tis) and the chan axis of wavedata are padded
+        out with zeros. Copy spikes to dtype, if given, instead of a widened copy of
+        spikes.dtype"""
+        if dtype is None:
+            dtype = [ (name, spikes.dtype[name].base, (nchans,) + spikes.dtype[name].shape[1:])
+                      if spikes.dtype[name].shape else (name, spikes.dtype[name])
+                      for name in spikes.dtype.names ]
+        newspikes = np.zeros(len(spikes), dtype=dtype)
+        for name in spikes.dtype.names:
+            field = spikes[name]
+            if field.ndim > 1: # chans, lockchans and tis, pad them out to more chans
+                newspikes[name][:, :field.shape[1]] = field
+            else:
+                newspikes[name] = field
+        newwavedata = np.zeros((len(wavedata), nchans) + wavedata.shape[2:],
+                               dtype=wavedata.dtype)
+        newwavedata[:, :wavedata.shape[1]] = wavedata
+        return newspikes, newwavedata
+
     def get_spikes_sortedby(self, attr='id'):
         """Return array of all spikes, sorted by attribute 'attr'"""
         vals = self.spikes[attr]
@@ -7,17 +7,258 @@ from __future__ import print_function
 __authors__ = ['Martin Spacek']
 
 import os
+import sys
 import time
+import hashlib
+import threading
+import Queue
+import zipfile
+import tempfile
+from StringIO import StringIO
+from collections import OrderedDict
+from datetime import timedelta
 import numpy as np
 
 import core
-from core import (WaveForm, EmptyClass, intround, intfloor, intceil, lrstrip, MU,
-                  hamming, filterord, WMLDR)
+from core import (WaveForm, EmptyClass, intround, intfloor, intceil, lrstrip, MU, td2usec,
+                  hamming, filterord, sosfilterord, WMLDR, chunkedWMLDR,
+                  polyphase_resample, freenbytes)
 from core import (DEFHPRESAMPLEX, DEFHPSRFSHCORRECT, DEFHPNSXSHCORRECT, DEFNSXFILTMETH,
-                  BWF0, BWORDER, NCHANSPERBOARD, KERNELSIZE, NSXXSPOINTS)
+                  DEFNSXFILTMODE, BWCHUNKSIZE, WMLDRCHUNKSIZE, WMLDROVERLAP,
+                  BWF0, BWORDER, NCHANSPERBOARD, KERNELSIZE, NSXXSPOINTS,
+                  BLOCKCACHEDT, BLOCKCACHENBYTES, MATERIALIZECHUNKDT, PREFETCHDEPTH,
+                  EXPORTCHUNKDT, SHMPATH)
 import probes
 
 
+class BlockCache(object):
+    """LRU cache of fixed duration time blocks of resampled, filtered int16 stream data,
+    shared by all streams. Blocks are keyed by stream fname and kind, sampfreq, shcorrect,
+    filtmeth, filtmode and block index, so a change in any of those parameters can never
+    return stale data. Each block holds all of the stream's enabled chans at the time it
+    was read. Least recently used blocks are evicted once the total size of cached data
+    exceeds maxnbytes. Requests that would need more than maxnbytes of blocks bypass the
+    cache altogether"""
+    def __init__(self, maxnbytes=BLOCKCACHENBYTES, blockdt=BLOCKCACHEDT):
+        self.maxnbytes = maxnbytes
+        self.blockdt = blockdt # us
+        self.clear()
+
+    def __repr__(self):
+        return ('<BlockCache: %d blocks, %d bytes, %d hits, %d misses, %d bypasses>'
+                % (len(self.blocks), self.nbytes, self.nhits, self.nmisses, self.nbypasses))
+
+    def clear(self):
+        """Remove all blocks, and reset hit/miss counters"""
+        self.blocks = OrderedDict() # in order of use, least recently used first
+        self.nbytes = 0
+        self.nhits = 0
+        self.nmisses = 0
+        self.nbypasses = 0
+
+    def streamkey(self, stream):
+        return stream.fname, getattr(stream, 'kind', None)
+
+    def invalidate(self, stream):
+        """Remove all blocks of stream, say on change of one of its parameters"""
+        try:
+            streamkey = self.streamkey(stream)
+        except AttributeError: # bare stream without a file, can't have any cached blocks
+            return
+        for key in [ key for key in self.blocks if key[:2] == streamkey ]:
+            self.nbytes -= self.blocks.pop(key).data.nbytes
+
+    def __call__(self, stream, start, stop, chans):
+        """Return WaveForm of stream from start to stop with just the specified chans,
+        reading and caching any blocks that aren't already cached"""
+        tres = stream.tres
+        nbt = self.get_nblockt(stream)
+        # only blocks that overlap the stream, in units of sample indices, offset by half a
+        # sample so that block edges fall between samples (see get()):
+        bi0 = max(intfloor((start/tres + 0.5) / nbt), intfloor((stream.t0/tres + 0.5) / nbt))
+        bi1 = min(intceil((stop/tres + 0.5) / nbt), intceil((stream.t1/tres + 0.5) / nbt))
+        nbytes = (bi1 - bi0) * nbt * stream.nchans * 2 # int16
+        if bi1 <= bi0 or nbytes > self.maxnbytes:
+            self.nbypasses += 1
+            return stream.read(start, stop, chans)
+        key = self.streamkey(stream) + (stream.sampfreq, stream.shcorrect,
+                                        getattr(stream, 'filtmeth', None),
+                                        getattr(stream, 'filtmode', None))
+        datas, tss = [], []
+        for bi in range(bi0, bi1):
+            wave = self.get(stream, key + (bi,), chans, nbt)
+            if len(chans) == len(wave.chans) and (chans == wave.chans).all():
+                datas.append(wave.data)
+            else:
+                # best not to assume that chans are sorted, often the case in LFP data:
+                chanis = [ int(np.where(chan == wave.chans)[0]) for chan in chans ]
+                datas.append(wave.data[chanis])
+            tss.append(wave.ts)
+        data = np.concatenate(datas, axis=1) # always a copy, cached blocks stay untouched
+        ts = np.concatenate(tss)
+        # timestamps of samples that fall exactly on start or stop may be off by a rounding
+        # error either way, give them a small tolerance so that start is always included
+        # and stop excluded:
+        eps = tres / 1000
+        lo, hi = ts.searchsorted([start - eps, stop - eps])
+        return WaveForm(data=data[:, lo:hi], ts=ts[lo:hi], chans=chans)
+
+    def get_nblockt(self, stream):
+        """Return number of timepoints per block of stream, the whole number closest to
+        self.blockdt"""
+        return max(intround(self.blockdt / stream.tres), 1)
+
+    def get(self, stream, key, chans, nbt):
+        """Return block WaveForm of stream with key, with at least the specified chans. Each
+        block holds nbt timepoints"""
+        blocks = self.blocks
+        wave = blocks.pop(key, None)
+        if wave is not None and set(chans).issubset(wave.chans):
+            self.nhits += 1
+            blocks[key] = wave # move to most recently used end
+            return wave
+        self.nmisses += 1
+        if wave is not None: # lacks some of chans, enabled chans have since changed
+            self.nbytes -= wave.data.nbytes
+        bi = key[-1]
+        # snap block edges to halfway between samples, so that rounding of float
+        # timestamps can't put a sample in both or neither of two adjacent blocks, and
+        # blocks always tile the same sample grid as a single read:
+        tres = stream.tres
+        wave = stream.read((bi*nbt - 0.5) * tres, ((bi+1)*nbt - 0.5) * tres, stream.chans)
+        wave.chans = np.asarray(wave.chans)
+        blocks[key] = wave
+        self.nbytes += wave.data.nbytes
+        while self.nbytes > self.maxnbytes and len(blocks) > 1:
+            self.nbytes -= blocks.popitem(last=False)[1].data.nbytes # evict LRU block
+        return wave
+
+blockcache = BlockCache() # the block cache of all streams in this process
+
+
+class StreamMetrics(object):
+    """Cumulative I/O and processing metrics of a stream: number of reads that bypassed
+    or missed the block cache, number of records (or data packets) touched and bytes loaded
+    from disk, time spent in each stage of a read, and time spent waiting for reads by a
+    Prefetcher to finish. Disabled by default, in which case
+    nothing is recorded. Toggle at runtime, e.g. from the shell window:
+
+    >>> self.hpstream.metrics.enable()
+    >>> self.hpstream.metrics
+
+    When streaming filtering, data are loaded as they're filtered, so loading time is
+    included in filtering time. Safe to update from multiple threads"""
+    stages = ['load', 'filter', 'resample', 'trim', 'wait']
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        """Get object state for pickling"""
+        d = self.__dict__.copy()
+        del d['lock'] # can't be pickled
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        times = ', '.join([ '%s %.3f' % (stage, self.times[stage])
+                            for stage in self.stages ])
+        return ('<StreamMetrics: %s, %d reads, %d records, %d bytes, sec: %s>'
+                % (['disabled', 'enabled'][self.enabled], self.ncalls, self.nrecords,
+                   self.nbytes, times))
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Zero all counters and times"""
+        self.ncalls = 0
+        self.nrecords = 0
+        self.nbytes = 0
+        self.times = dict.fromkeys(self.stages, 0.0) # sec
+
+    def add(self, ncalls=0, nrecords=0, nbytes=0):
+        """Add to counters, if enabled"""
+        if self.enabled:
+            with self.lock:
+                self.ncalls += ncalls
+                self.nrecords += nrecords
+                self.nbytes += nbytes
+
+    def addtime(self, stage, t0):
+        """Add time since t0 to stage, if enabled. Return current time, from which to time
+        the next stage"""
+        t = time.time()
+        if self.enabled:
+            with self.lock:
+                self.times[stage] += t - t0
+        return t
+
+
+class Prefetcher(object):
+    """Iterate over WaveForms of stream for a sequence of tranges, reading each one in a
+    background thread while the ones before it are being processed. At most depth
+    WaveForms are read ahead. Reading (loading, scaling, filtering and resampling) spends
+    much of its time in I/O and in numpy and scipy calls that release the GIL, so it
+    overlaps well with processing in the main thread. Assumes nothing else reads from
+    stream while iterating"""
+    def __init__(self, stream, tranges, chans=None, depth=PREFETCHDEPTH):
+        self.stream = stream
+        self.tranges = tranges
+        self.chans = chans
+        self.q = Queue.Queue(maxsize=depth)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True # don't hold up exit of process
+        self.thread.start()
+
+    def run(self):
+        """Read all tranges in order, queue up resulting WaveForms. On error, queue up the
+        exception's (type, value, traceback) tuple instead and quit, so that it can be
+        reraised in the consuming thread with its original traceback"""
+        try:
+            for t0, t1 in self.tranges:
+                if self.stopped:
+                    return
+                # bypass the block cache, which is for small GUI reads:
+                self.q.put(self.stream.read(t0, t1, self.chans))
+        except Exception:
+            self.q.put(sys.exc_info())
+
+    def __len__(self):
+        return len(self.tranges)
+
+    def __iter__(self):
+        try:
+            for i in range(len(self.tranges)):
+                tget = time.time()
+                wave = self.q.get()
+                if isinstance(wave, tuple): # exc_info of an error in the reading thread
+                    typ, val, tb = wave
+                    raise typ, val, tb
+                self.stream.metrics.addtime('wait', tget)
+                yield wave
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading ahead, discard any queued WaveForms"""
+        self.stopped = True
+        while True: # unblock the thread in case it's waiting on a full queue
+            try:
+                self.q.get_nowait()
+            except Queue.Empty:
+                break
+
+
 class FakeStream(object):
     def __init__(self):
         self.fname = ''
@@ -65,6 +306,19 @@ class Stream(object):
 
     nchans = property(get_nchans)
 
+    def get_metrics(self):
+        """Get StreamMetrics of self, create them on first access"""
+        try:
+            return self._metrics
+        except AttributeError: # also for streams unpickled from older .sort files
+            self._metrics = StreamMetrics()
+            return self._metrics
+
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+
+    metrics = property(get_metrics, set_metrics)
+
     def get_sampfreq(self):
         return self._sampfreq
 
@@ -75,6 +329,7 @@ class Stream(object):
             del self.kernels
         except AttributeError:
             pass
+        blockcache.invalidate(self)
         self.tres = 1 / self.sampfreq * 1e6 # float us
         #print('Stream.tres = %g' % self.tres)
 
@@ -93,6 +348,7 @@ class Stream(object):
             del self.kernels
         except AttributeError:
             pass
+        blockcache.invalidate(self)
 
     shcorrect = property(get_shcorrect, set_shcorrect)
 
@@ -109,6 +365,17 @@ class Stream(object):
             raise ValueError('unsupported slice step size: %s' % key.step)
         return self(key.start, key.stop, self.chans)
 
+    def __call__(self, start, stop, chans=None):
+        """Called when Stream object is called using (). start and stop indicate start and end
+        timepoints in us wrt t=0. Returns the corresponding WaveForm object with just the
+        specified chans, served from the block cache where possible"""
+        if chans is None:
+            chans = self.chans
+        if not set(chans).issubset(self.chans):
+            raise ValueError("requested chans %r are not a subset of available enabled "
+                             "chans %r in %s stream" % (chans, self.chans, self.kind))
+        return blockcache(self, start, stop, chans)
+
     def resample(self, rawdata, rawts, chans):
         """Return potentially sample-and-hold corrected and Nyquist interpolated
         data and timepoints. See Blanche & Swindale, 2006"""
@@ -151,41 +418,16 @@ class Stream(object):
         ts = np.linspace(tstart, tstart+(nt-1)*tres, nt)
         #print('len(ts) is %r' % len(ts))
         assert len(ts) == nt
-        # resampled data, leave as int32 for convolution, then convert to int16:
-        data = np.empty((nchans, nt), dtype=np.int32)
-        #print('data.shape = %r' % (data.shape,))
-        #tconvolve = time.time()
-        #tconvolvesum = 0
         # Only the chans that are actually needed are resampled and returned.
         # Assume that chans index into ADchans. Normally they should map 1 to 1, ie chan 0
         # taps off of ADchan 0, but for probes like pt16a_HS27 and pt16b_HS27, it seems
         # ADchans start at 4.
-        for chani, chan in enumerate(chans):
-            for point, kernel in enumerate(self.kernels[chan]):
-                """np.convolve(a, v, mode)
-                for mode='same', only the K middle values are returned starting at n = (M-1)/2
-                where K = len(a)-1 and M = len(v) - 1 and K >= M
-                for mode='valid', you get the middle len(a) - len(v) + 1 number of values"""
-                #tconvolveonce = time.time()
-                row = np.convolve(rawdata[chani], kernel, mode='same')
-                #tconvolvesum += (time.time()-tconvolveonce)
-                #print('len(rawdata[chani]) = %r' % len(rawdata[chani]))
-                #print('len(kernel) = %r' % len(kernel))
-                #print('len(row): %r' % len(row))
-                # interleave by assigning from point to end in steps of resamplex
-                # index to start filling data from for this kernel's points:
-                ti0 = (resamplex - point) % resamplex
-                # index of first data point to use from convolution result 'row':
-                rowti0 = int(point > 0)
-                # discard the first data point from interpolant's convolutions, but not for
-                # raw data's convolutions, since interpolated values have to be bounded on both
-                # sides by raw values?
-                data[chani, ti0::resamplex] = row[rowti0:]
-        #print('convolve loop took %.3f sec' % (time.time()-tconvolve))
-        #print('convolve calls took %.3f sec total' % (tconvolvesum))
-        #tundoscaling = time.time()
-        data >>= 16 # undo kernel scaling, shift 16 bits right in place, same as //= 2**16
-        #print('undo kernel scaling took %.3f sec total' % (time.time()-tundoscaling))
+        # kernels of all chans, (nchans, resamplex, N+1):
+        kernels = np.asarray([ self.kernels[chan] for chan in chans ])
+        # resample all chans and kernels at once, leave as int32, convert to int16 later:
+        #tresample = time.time()
+        data = polyphase_resample(rawdata, kernels)
+        #print('polyphase resample took %.3f sec' % (time.time()-tresample))
         return data, ts
 
     def get_kernels(self, resamplex, N, chans, ADchans=None):
@@ -239,9 +481,96 @@ class Stream(object):
             kernels[chan] = kernelrow
         return kernels
 
+    def get_materializedfname(self):
+        """Return name of .npy sidecar file of self's materialized data. It includes a hash
+        of the source file's name, size and modification time, and of all the parameters
+        that determine self's preprocessed data"""
+        srcfname = self.f.join(self.f.fname)
+        st = os.stat(srcfname)
+        params = (self.f.fname, st.st_size, st.st_mtime, self.kind, self.sampfreq,
+                  self.shcorrect, self.filtmeth, getattr(self, 'filtmode', None),
+                  list(self.chans), KERNELSIZE)
+        paramhash = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+        ext = {'highpass': '.hp.npy', 'lowpass': '.lp.npy'}[self.kind]
+        return self.f.fname + '.' + paramhash + ext
+
+    materializedfname = property(get_materializedfname)
+
+    def materialize(self, path=None, chunkdt=MATERIALIZECHUNKDT):
+        """Write self's fully preprocessed (scaled, filtered and resampled) int16 data of
+        all enabled chans to a .npy sidecar file in path (defaults to source file's path),
+        chunkdt us at a time, unless a sidecar with matching hash already exists. Return a
+        MaterializedStream that serves slices directly from the memory mapped sidecar"""
+        fname = os.path.join(path or self.f.path, self.materializedfname)
+        if not os.path.exists(fname):
+            t0 = time.time()
+            tmpfname = fname + '.tmp' # only rename to fname once it's complete
+            self.write_npy(tmpfname, chunkdt=chunkdt)
+            os.rename(tmpfname, fname)
+            print('materializing %s stream to %r took %.3f sec'
+                  % (self.kind, fname, time.time()-t0))
+        return MaterializedStream(self, fname)
+
+    def write_npy(self, fname, chunkdt=EXPORTCHUNKDT):
+        """Write self's preprocessed int16 data of all enabled chans from self.t0 to self.t1
+        to a (nchans, nt) .npy file, chunkdt us at a time through a memory map, so memory use
+        doesn't depend on the duration of self"""
+        chunkt0s = np.arange(self.t0, self.t1, chunkdt)
+        # timepoints of first and last chunk determine number of timepoints:
+        ts0 = self.read(chunkt0s[0], min(chunkt0s[0]+chunkdt, self.t1)).ts[0]
+        tsend = self.read(chunkt0s[-1], self.t1).ts[-1]
+        nt = intround((tsend - ts0) / self.tres) + 1
+        data = np.lib.format.open_memmap(fname, mode='w+', dtype=np.int16,
+                                         shape=(self.nchans, nt))
+        for chunkt0 in chunkt0s:
+            wave = self.read(chunkt0, min(chunkt0+chunkdt, self.t1))
+            if len(wave.ts) == 0:
+                continue
+            ti0 = intround((wave.ts[0] - ts0) / self.tres)
+            data[:, ti0:ti0+len(wave.ts)] = wave.data
+        del data # flush to disk
+
+    def export_lfp(self, fname, format='binary', chunkdt=EXPORTCHUNKDT):
+        """Export self's data to binary .lfp.zip file or text .lfp.csv file fname. Data are
+        first written chunkdt us at a time to a temporary .npy file, which is then either
+        compressed into the .zip file as its data.npy member, or written out to the .csv
+        file a limited number of values at a time, so memory use doesn't depend on the
+        duration of self. The .zip file can be loaded with np.load, just like one written
+        by np.savez_compressed"""
+        if format not in ['binary', 'text']:
+            raise ValueError('unknown format: %r' % format)
+        tmpfname = fname + '.tmp.npy'
+        self.write_npy(tmpfname, chunkdt=chunkdt)
+        try:
+            if format == 'binary':
+                arrays = {'chans': self.chans, 't0': self.t0, 't1': self.t1,
+                          'tres': self.tres, 'chanpos': self.probe.siteloc_arr(),
+                          'uVperAD': self.converter.AD2uV(1)}
+                with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+                    zf.write(tmpfname, 'data.npy') # compressed in chunks, not all at once
+                    for name, val in arrays.items():
+                        f = StringIO()
+                        np.lib.format.write_array(f, np.asanyarray(val))
+                        zf.writestr(name + '.npy', f.getvalue())
+            else: # format == 'text'
+                data = np.load(tmpfname, mmap_mode='r')
+                nt = data.shape[1]
+                ntchunk = max(intround(chunkdt / self.tres), 1)
+                with open(fname, 'w') as f:
+                    for row in data: # one line per chan, data should be int
+                        for ti0 in range(0, nt, ntchunk):
+                            f.write(','.join(row[ti0:ti0+ntchunk].astype(str)))
+                            if ti0 + ntchunk < nt:
+                                f.write(',')
+                        f.write('\n')
+                del data
+        finally:
+            os.remove(tmpfname)
+
 
 class NSXStream(Stream):
-    def __init__(self, f, kind='highpass', filtmeth=None, sampfreq=None, shcorrect=None):
+    def __init__(self, f, kind='highpass', filtmeth=None, sampfreq=None, shcorrect=None,
+                 filtmode=None):
         self.f = f
         self.kind = kind
         if kind == 'highpass':
@@ -251,6 +580,7 @@ class NSXStream(Stream):
         else: raise ValueError('Unknown stream kind %r' % kind)
 
         self.filtmeth = filtmeth or DEFNSXFILTMETH
+        self.filtmode = filtmode or DEFNSXFILTMODE
 
         self.converter = core.NSXConverter(f.fileheader.AD2uVx)
 
@@ -282,30 +612,35 @@ class NSXStream(Stream):
         self.chans = f.fileheader.chans
 
         self.t0, self.t1 = f.t0, f.t1
-        self.tranges = np.int64([[self.t0, self.t1]])
+        self.tranges = f.tranges # one contiguous time range per data packet
 
-    def __call__(self, start, stop, chans=None):
-        """Called when Stream object is called using (). start and stop indicate start and end
-        timepoints in us wrt t=0. Returns the corresponding WaveForm object with just the
-        specified chans"""
+    def update(self):
+        """Extend self to include any data recorded to its file since it was opened or
+        last updated. Return number of new raw timepoints"""
+        return self.f.update()
+
+    def read(self, start, stop, chans=None):
+        """Read, filter and resample data from start to stop, bypassing the block cache.
+        start and stop indicate start and end timepoints in us wrt t=0. Returns the
+        corresponding WaveForm object with just the specified chans"""
         if chans is None:
             chans = self.chans
-        if not set(chans).issubset(self.chans):
-            raise ValueError("requested chans %r are not a subset of available enabled "
-                             "chans %r in %s stream" % (chans, self.chans, self.kind))
-        nchans = len(chans)
-        chanis = self.f.fileheader.chans.searchsorted(chans)
 
         rawtres = self.rawtres
         resample = self.sampfreq != self.rawsampfreq or self.shcorrect == True
+        streamfilt = (self.filtmeth in ['BW', 'WMLDR'] and
+                      getattr(self, 'filtmode', DEFNSXFILTMODE) == 'streaming')
         # excess data in us at either end, to eliminate filtering and interpolation
-        # edge effects:
-        #print('NSXXSPOINTS: %d' % NSXXSPOINTS)
-        xs = intround(NSXXSPOINTS * rawtres)
+        # edge effects. When streaming, filtering doesn't depend on read boundaries, so
+        # only interpolation requires excess:
+        if streamfilt:
+            xs = KERNELSIZE * rawtres if resample else 0.0 # float us
+        else:
+            #print('NSXXSPOINTS: %d' % NSXXSPOINTS)
+            xs = intround(NSXXSPOINTS * rawtres)
         #print('xs: %d, rawtres: %g' % (xs, rawtres))
 
-        # stream limits, in us and in sample indices, wrt t=0 and sample=0:
-        t0, t1, nt = self.t0, self.t1, self.f.nt
+        # stream limits, in sample indices, wrt sample=0:
         t0i, t1i = self.f.t0i, self.f.t1i
         # get a slightly greater range of raw data (with xs) than might be needed:
         t0xsi = intfloor((start - xs) / rawtres) # round down to nearest mult of rawtres
@@ -321,46 +656,42 @@ class NSXStream(Stream):
         tsxs = np.linspace(t0xs, t0xs+(ntxs-1)*rawtres, ntxs)
         #print('ntxs: %d' % ntxs)
 
-        # init data as int32 so we have bitwidth to rescale and zero, then convert to int16
-        dataxs = np.zeros((nchans, ntxs), dtype=np.int32) # any gaps will have zeros
-
-        #tload = time.time()
-        # load up data+excess, same data for high and low pass, difference will only be in the
-        # filtering. It would be convenient to immediately subsample to get lowpass, but that's
-        # not a valid thing to do: you can only subsample after filtering.
-        # source indices:
-        st0i = max(t0xsi - t0i, 0)
-        st1i = min(t1xsi - t0i, nt)
-        assert st1i-st0i == ntxs
-        # destination indices:
-        dt0i = max(t0i - t0xsi, 0)
-        dt1i = min(t1i - t0xsi, ntxs)
-        dataxs[:, dt0i:dt1i] = self.f.data[chanis, st0i:st1i]
-        #print('data load took %.3f sec' % (time.time()-tload))
-
+        metrics = self.metrics
+        metrics.add(ncalls=1)
+        t = time.time()
         #print('filtmeth: %s' % self.filtmeth)
-        if self.filtmeth == None:
-            pass
-        elif self.filtmeth == 'BW':
-            # high-pass filter using butterworth filter:
-            dataxs, b, a = filterord(dataxs, sampfreq=self.rawsampfreq, f0=BWF0, f1=None,
-                                     order=BWORDER, rp=None, rs=None,
-                                     btype='highpass', ftype='butter')
-        elif self.filtmeth == 'WMLDR':
-            # high-pass filter using wavelet multi-level decomposition and reconstruction:
-            ## TODO: fix weird slow wobbling of amplitude as a function of exactly what
-            ## the WMLDR filtering time range happens to be. Setting a much bigger xs
-            ## helps, but only until you move xs amount of time away from the start of
-            ## the recording
-            dataxs = WMLDR(dataxs)
+        if streamfilt and self.filtmeth == 'BW':
+            # high-pass filter using butterworth filter, in fixed chunks aligned to sample=0:
+            dataxs = self.streamfilter(t0xsi, t1xsi, chans)
+        elif streamfilt: # self.filtmeth == 'WMLDR'
+            # high-pass filter using WMLDR, in fixed chunks aligned to sample=0:
+            dataxs = self.chunkfilter(t0xsi, t1xsi, chans)
         else:
-            raise ValueError('unknown filter method %s' % self.filtmeth)
+            dataxs = self.loadraw(t0xsi, t1xsi, chans)
+            t = metrics.addtime('load', t)
+            if self.filtmeth == None:
+                pass
+            elif self.filtmeth == 'BW':
+                # high-pass filter using butterworth filter:
+                dataxs, b, a = filterord(dataxs, sampfreq=self.rawsampfreq, f0=BWF0,
+                                         f1=None, order=BWORDER, rp=None, rs=None,
+                                         btype='highpass', ftype='butter')
+            elif self.filtmeth == 'WMLDR':
+                # high-pass filter using wavelet multi-level decomposition and
+                # reconstruction:
+                ## TODO: fix weird slow wobbling of amplitude as a function of exactly what
+                ## the WMLDR filtering time range happens to be. Setting a much bigger xs
+                ## helps, but only until you move xs amount of time away from the start of
+                ## the recording
+                dataxs = WMLDR(dataxs)
+            else:
+                raise ValueError('unknown filter method %s' % self.filtmeth)
+        t = metrics.addtime('filter', t)
 
         # do any resampling if necessary:
         if resample:
-            #tresample = time.time()
             dataxs, tsxs = self.resample(dataxs, tsxs, chans)
-            #print('resample took %.3f sec' % (time.time()-tresample))
+            t = metrics.addtime('resample', t)
 
         #nresampletxs = len(tsxs)
         #print('ntxs, nresampletxs: %d, %d' % (ntxs, nresampletxs))
@@ -375,9 +706,120 @@ class NSXStream(Stream):
 
         # should be safe to convert back down to int16 now:
         data = np.int16(data)
+        metrics.addtime('trim', t)
         return WaveForm(data=data, ts=ts, chans=chans)
 
 
+    def loadraw(self, t0i, t1i, chans):
+        """Return raw int32 data of chans from sample index t0i up to t1i, wrt sample=0.
+        Data are int32 so there's bitwidth to rescale and filter. Any gaps between data
+        packets are filled with zeros"""
+        chanis = self.f.fileheader.chans.searchsorted(chans)
+        data = np.zeros((len(chans), t1i-t0i), dtype=np.int32) # any gaps will have zeros
+        # load up raw data, same data for high and low pass, difference will only be in the
+        # filtering. It would be convenient to immediately subsample to get lowpass, but
+        # that's not a valid thing to do: you can only subsample after filtering.
+        # Find data packets that overlap t0i:t1i, there's normally only one:
+        packett0is = self.f.packett0is
+        p0 = max(packett0is.searchsorted(t0i, side='right') - 1, 0)
+        p1 = packett0is.searchsorted(t1i, side='left')
+        nrecords = nbytes = 0
+        for datapacket in self.f.datapackets[p0:p1]:
+            pt0i, pnt = datapacket.t0i, datapacket.nt
+            # source indices, wrt start of packet:
+            st0i = max(t0i - pt0i, 0)
+            st1i = min(t1i - pt0i, pnt)
+            if st1i <= st0i: # packet ends before t0i
+                continue
+            # destination indices:
+            dt0i = max(pt0i - t0i, 0)
+            dt1i = dt0i + st1i - st0i
+            data[:, dt0i:dt1i] = datapacket._data[chanis, st0i:st1i]
+            nrecords += 1
+            nbytes += len(chanis) * (st1i-st0i) * 2 # int16
+        self.metrics.add(nrecords=nrecords, nbytes=nbytes)
+        return data
+
+    def streamfilter(self, t0i, t1i, chans):
+        """Return butterworth highpass filtered data of chans from sample index t0i up to
+        t1i. This is chunked filtering with warm-up, not stateful filtering: data are
+        filtered in fixed chunks of BWCHUNKSIZE points aligned to sample=0, each one
+        independently, starting from zero filter state NSXXSPOINTS before the chunk, and no
+        filter state is carried from one chunk to the next. Every sample is therefore always
+        filtered within the same chunk, and gets bit-identical values no matter which slice,
+        process or read order requested it. Chunks filtered by the previous call are reused,
+        so sequential reads only filter each chunk once"""
+        chans = list(chans)
+        c0i = t0i // BWCHUNKSIZE * BWCHUNKSIZE # round down to start of chunk
+        c1i = max(-(-t1i // BWCHUNKSIZE) * BWCHUNKSIZE, c0i) # round up to end of chunk
+        try:
+            fchans, fc0i, fc1i, fdata = self._filtstate
+            if fchans != chans or not fc0i <= c0i <= fc1i:
+                raise AttributeError # start over
+        except AttributeError:
+            fc0i = fc1i = c0i
+            fdata = np.zeros((len(chans), 0))
+        if c1i > fc1i: # filter chunks that follow the ones filtered by the previous call
+            # data before start or after end of recording are zeros:
+            rawdata = self.loadraw(fc1i-NSXXSPOINTS, c1i, chans)
+            newdatas = [fdata[:, c0i-fc0i:]]
+            for ci in range(0, c1i-fc1i, BWCHUNKSIZE): # wrt fc1i
+                # warm up filter state on the NSXXSPOINTS that precede each chunk:
+                chunk = sosfilterord(rawdata[:, ci:ci+NSXXSPOINTS+BWCHUNKSIZE],
+                                     sampfreq=self.rawsampfreq, f0=BWF0, f1=None,
+                                     order=BWORDER, btype='highpass', ftype='butter')
+                newdatas.append(chunk[:, NSXXSPOINTS:])
+            fdata = np.concatenate(newdatas, axis=1)
+            fc0i, fc1i = c0i, c1i
+            self._filtstate = chans, fc0i, fc1i, fdata
+        return fdata[:, t0i-fc0i:t1i-fc0i]
+
+    def chunkfilter(self, t0i, t1i, chans):
+        """Return WMLDR highpass filtered data of chans from sample index t0i up to t1i.
+        Data are filtered in fixed chunks of WMLDRCHUNKSIZE points aligned to sample=0,
+        each with WMLDROVERLAP points of raw data on either side (see core.chunkedWMLDR).
+        Every sample is therefore always filtered within the same chunk, and gets the same
+        value, no matter which slice requested it. Chunks filtered by the previous call are
+        reused, so sequential reads only filter each chunk once"""
+        chans = list(chans)
+        c0i = t0i // WMLDRCHUNKSIZE * WMLDRCHUNKSIZE # round down to start of chunk
+        c1i = max(-(-t1i // WMLDRCHUNKSIZE) * WMLDRCHUNKSIZE, c0i) # round up to end of chunk
+        try:
+            fchans, fc0i, fc1i, fdata = self._chunkstate
+            if fchans != chans or not fc0i <= c0i <= fc1i:
+                raise AttributeError # start over
+        except AttributeError:
+            fc0i = fc1i = c0i
+            fdata = np.zeros((len(chans), 0))
+        if c1i > fc1i: # filter chunks that follow the ones filtered by the previous call
+            # data before start or after end of recording are zeros:
+            rawdata = self.loadraw(fc1i-WMLDROVERLAP, c1i+WMLDROVERLAP, chans)
+            newdata = chunkedWMLDR(rawdata, chunksize=WMLDRCHUNKSIZE, overlap=WMLDROVERLAP)
+            fdata = np.concatenate([fdata[:, c0i-fc0i:], newdata], axis=1)
+            fc0i, fc1i = c0i, c1i
+            self._chunkstate = chans, fc0i, fc1i, fdata
+        return fdata[:, t0i-fc0i:t1i-fc0i]
+
+    def __getstate__(self):
+        """Get object state for pickling"""
+        d = self.__dict__.copy()
+        # filtered chunks are only kept to speed up sequential reads:
+        d.pop('_filtstate', None)
+        d.pop('_chunkstate', None)
+        return d
+
+    def get_ndatchans(self):
+        """Get number of chans written to .dat file"""
+        return self.f.fileheader.nchanstotal
+
+    ndatchans = property(get_ndatchans)
+
+    def write_dat(self, datf, nt=None):
+        return self.f.write_dat(datf, nt)
+
+    def export_dat(self, dt=None):
+        self.f.export_dat(dt)
+
 class SurfStream(Stream):
     """Data stream object - provides stream interface to .srf files.
     Maps from timestamps to record index of stream data to retrieve the
@@ -473,15 +915,135 @@ class SurfStream(Stream):
     def pickle(self):
         self.f.pickle()
 
-    def __call__(self, start, stop, chans=None):
-        """Called when Stream object is called using (). start and stop indicate start and end
-        timepoints in us wrt t=0. Returns the corresponding WaveForm object with just the
-        specified chans"""
+    def get_ndatchans(self):
+        """Get number of chans written to .dat file"""
+        return self.nADchans
+
+    ndatchans = property(get_ndatchans)
+
+    def write_dat(self, datf, nt=None, chunkdt=EXPORTCHUNKDT):
+        """Write the first nt raw timepoints (defaults to all of them) of all AD chans to
+        open .dat file datf, in (ti, chani) order, zero-filling any gaps between tranges.
+        Data are offset and scaled as in loadhighpass, and are loaded chunkdt us at a time, so
+        memory use doesn't depend on the duration of self. Return number of timepoints
+        written"""
+        rawtres = self.rawtres
+        t0i = intround(self.t0 / rawtres)
+        ntmax = intround(self.t1 / rawtres) - t0i
+        if nt == None:
+            nt = ntmax
+        nt = min(nt, ntmax)
+        ntchunk = max(intround(chunkdt / rawtres), 1)
+        chanis = np.arange(self.nADchans)
+        if self.kind == 'highpass':
+            load = self.loadhighpass
+        else: # kind == 'lowpass'
+            load = self.loadlowpass
+        rts = self.records['TimeStamp']
+        for ti0 in range(0, nt, ntchunk):
+            t0xsi = t0i + ti0
+            ntxs = min(ntchunk, nt - ti0)
+            dataxs = np.zeros((self.nADchans, ntxs), dtype=np.int32) # gaps stay zero
+            # records that overlap this chunk, starting with the one just before it:
+            rec0i, rec1i = rts.searchsorted([t0xsi*rawtres, (t0xsi+ntxs)*rawtres])
+            records = self.records[max(rec0i-1, 0):rec1i]
+            if len(records) > 0:
+                load(dataxs, records, chanis, t0xsi)
+            datf.write(np.int16(dataxs.T).tostring()) # (ti, chani) order
+        return nt
+
+    def export_dat(self, dt=None, chunkdt=EXPORTCHUNKDT):
+        """Export raw ephys data of all AD chans to .dat file, in (ti, chani) order, using
+        same base file name in the same folder. Any gaps between tranges are filled with
+        zeros, so that timepoints in the .dat file stay evenly spaced. dt is duration to
+        export from start of recording, in sec"""
+        if dt == None:
+            nt = intround((self.t1 - self.t0) / self.rawtres)
+            dtstr = ''
+        else:
+            nt = intround(dt * self.rawsampfreq)
+            dtstr = str(dt)
+        datbasefname = os.path.splitext(self.fname)[0]
+        fulldatfname = self.f.join('%s_%ss.dat' % (datbasefname, dtstr))
+        print('writing raw ephys data to %r' % fulldatfname)
+        with open(fulldatfname, 'wb') as datf:
+            ntwritten = self.write_dat(datf, nt, chunkdt=chunkdt)
+        print('%d bytes written' % (ntwritten*self.ndatchans*2))
+        print('%d attempted, %d actual timepoints written' % (nt, ntwritten))
+        print('voltage gain: %g uV/AD' % self.converter.AD2uV(1))
+        print('sample rate: %d Hz' % self.rawsampfreq)
+        print('total number of chans: %d' % self.ndatchans)
+
+    def recordgroups(self, records, nt, t0xsi, ntxs):
+        """Split records, each nt samples long, into groups of records that are contiguous
+        in time and require the same range of samples to fill a destination array ntxs
+        samples long, whose first column corresponds to sample index t0xsi. Typically,
+        that's a partial first record, all of the middle records in full, and a partial last
+        record. For each group that overlaps the destination, yield its record index range,
+        its source sample index range within each record, and its destination sample index
+        range"""
+        rt0is = np.round(records['TimeStamp'] / self.rawtres).astype(np.int64)
+        # range of sample indices required from each record:
+        st0is = (t0xsi - rt0is).clip(0, nt)
+        st1is = (t0xsi + ntxs - rt0is).clip(0, nt)
+        splitis, = np.where((np.diff(rt0is) != nt) | (np.diff(st0is) != 0) |
+                            (np.diff(st1is) != 0))
+        g0is = np.concatenate([[0], splitis+1])
+        g1is = np.concatenate([splitis+1, [len(records)]])
+        for g0i, g1i in zip(g0is, g1is):
+            st0i, st1i = st0is[g0i], st1is[g0i] # source indices, same for all in group
+            if st0i == st1i: # group falls outside of destination
+                continue
+            # destination indices:
+            dt0i = rt0is[g0i] + st0i - t0xsi
+            dt1i = dt0i + (g1i-g0i)*(st1i-st0i)
+            yield g0i, g1i, st0i, st1i, dt0i, dt1i
+
+    def loadhighpass(self, dataxs, records, chanis, t0xsi):
+        """Load highpass data on row indices chanis from all records into int32 dataxs, whose
+        first column corresponds to sample index t0xsi. Data are offset to be centered around
+        0 and scaled to use the full 16 bit dynamic range. Only the required chans and
+        samples are read from the memory-mapped file, and any gaps in dataxs are left as is"""
+        nchans, ntxs = dataxs.shape
+        nt = records[0]['NumSamples'] // self.nADchans
+        for g0i, g1i, st0i, st1i, dt0i, dt1i in self.recordgroups(records, nt, t0xsi, ntxs):
+            # (nchans, nrecs, nt) view into dataxs, ordered as the records are:
+            dst = dataxs[:, dt0i:dt1i].reshape(nchans, g1i-g0i, st1i-st0i)
+            # gather the group's records from the memory-mapped file at once:
+            d = self.f.loadContinuousRecords(records[g0i:g1i], chanis, st0i, st1i)
+            self.metrics.add(nrecords=g1i-g0i, nbytes=d.nbytes)
+            # offset 12 bit unsigned data to be centered around 0, and convert to int32:
+            np.subtract(d.transpose(1, 0, 2), 2048, out=dst)
+            # bitshift left to scale 12 bit values to use full 16 bit dynamic range, same as
+            # * 2**(16-12) == 16. This provides more fidelity for interpolation, reduces uV
+            # per AD to about 0.02:
+            dst <<= 4
+
+    def loadlowpass(self, dataxs, records, chanis, t0xsi):
+        """Load lowpass data on row indices chanis from all lowpass multichan records into
+        int32 dataxs, whose first column corresponds to sample index t0xsi. Each lowpass
+        multichan record refers to a run of single chan lowpass records, one per chan.
+        Offsets of all the required (record, chan) pairs are computed up front, and their
+        data gathered from the memory-mapped file at once, for each group of contiguous
+        records. Data are offset and scaled as in loadhighpass"""
+        nchans, ntxs = dataxs.shape
+        # assume all lpmc records are same length:
+        nt = intround(records[0]['NumSamples'] / self.nADchans)
+        # (nrecs, nchans) indices into self.f.lowpassrecords:
+        lpreciss = records['lpreci'][:, None] + np.asarray(chanis)
+        for g0i, g1i, st0i, st1i, dt0i, dt1i in self.recordgroups(records, nt, t0xsi, ntxs):
+            dst = dataxs[:, dt0i:dt1i].reshape(nchans, g1i-g0i, st1i-st0i)
+            d = self.f.loadLowPassRecords(lpreciss[g0i:g1i], st0i, st1i)
+            self.metrics.add(nrecords=d.shape[0]*d.shape[1], nbytes=d.nbytes)
+            np.subtract(d.transpose(1, 0, 2), 2048, out=dst)
+            dst <<= 4
+
+    def read(self, start, stop, chans=None):
+        """Read, filter and resample data from start to stop, bypassing the block cache.
+        start and stop indicate start and end timepoints in us wrt t=0. Returns the
+        corresponding WaveForm object with just the specified chans"""
         if chans is None:
             chans = self.chans
-        if not set(chans).issubset(self.chans):
-            raise ValueError("requested chans %r are not a subset of available enabled "
-                             "chans %r in %s stream" % (chans, self.chans, self.kind))
         nchans = len(chans)
         rawtres = self.rawtres # float us
         resample = self.sampfreq != self.rawsampfreq or self.shcorrect == True
@@ -537,54 +1099,25 @@ class SurfStream(Stream):
 
         # load up data+excess, from all relevant records
         # TODO: fix code duplication
-        #tload = time.time()
+        metrics = self.metrics
+        metrics.add(ncalls=1)
+        t = time.time()
         if self.kind == 'highpass': # straightforward
             chanis = self.layout.ADchanlist.searchsorted(chans)
-            for record in records: # iterating over highpass records
-                d = self.f.loadContinuousRecord(record)[chanis] # record's data on chans
-                nt = d.shape[1]
-                t0i = intround(record['TimeStamp'] / rawtres)
-                t1i = t0i + nt
-                # source indices
-                st0i = max(t0xsi - t0i, 0)
-                st1i = min(t1xsi - t0i, nt)
-                # destination indices
-                dt0i = max(t0i - t0xsi, 0)
-                dt1i = min(t1i - t0xsi, ntxs)
-                dataxs[:, dt0i:dt1i] = d[:, st0i:st1i]
-        else: # kind == 'lowpass', need to load chans from subsequent records
+            if len(records) > 0:
+                self.loadhighpass(dataxs, records, chanis, t0xsi)
+        elif len(records) > 0: # kind == 'lowpass', load chans from subsequent records
             chanis = [ int(np.where(chan == self.layout.chans)[0]) for chan in chans ]
             """NOTE: if the above raises an error it may be because this particular
             combination of LFP chans was incorrectly parsed due to a bug in the .srf file,
             and a manual remapping needs to be added to Surf.File.fixLFPlabels()"""
-            # assume all lpmc records are same length:
-            nt = intround(records[0]['NumSamples'] / self.nADchans)
-            d = np.zeros((nchans, nt), dtype=np.int32)
-            for record in records: # iterating over lowpassmultichan records
-                for i, chani in enumerate(chanis):
-                    lprec = self.f.lowpassrecords[record['lpreci']+chani]
-                    d[i] = self.f.loadContinuousRecord(lprec)
-                t0i = intround(record['TimeStamp'] / rawtres)
-                t1i = t0i + nt
-                # source indices
-                st0i = max(t0xsi - t0i, 0)
-                st1i = min(t1xsi - t0i, nt)
-                # destination indices
-                dt0i = max(t0i - t0xsi, 0)
-                dt1i = min(t1i - t0xsi, ntxs)
-                dataxs[:, dt0i:dt1i] = d[:, st0i:st1i]
-        #print('record.load() took %.3f sec' % (time.time()-tload))
-
-        # bitshift left to scale 12 bit values to use full 16 bit dynamic range, same as
-        # * 2**(16-12) == 16. This provides more fidelity for interpolation, reduces uV per
-        # AD to about 0.02
-        dataxs <<= 4 # data is still int32 at this point
+            self.loadlowpass(dataxs, records, chanis, t0xsi)
+        t = metrics.addtime('load', t)
 
         # do any resampling if necessary:
         if resample:
-            #tresample = time.time()
             dataxs, tsxs = self.resample(dataxs, tsxs, chans)
-            #print('resample took %.3f sec' % (time.time()-tresample))
+            t = metrics.addtime('resample', t)
 
         # now trim down to just the requested time range:
         lo, hi = tsxs.searchsorted([start, stop])
@@ -593,6 +1126,7 @@ class SurfStream(Stream):
 
         # should be safe to convert back down to int16 now:
         data = np.int16(data)
+        metrics.addtime('trim', t)
         return WaveForm(data=data, ts=ts, chans=chans)
 
 
@@ -602,7 +1136,7 @@ class SimpleStream(Stream):
                  intgain, extgain, sampfreq=None, shcorrect=None, bitshift=4,
                  tsfversion=None):
         self._fname = fname
-        self.wavedata = wavedata
+        self.share(wavedata)
         self.filtmeth = None
         nchans, nt = wavedata.shape
         self.chans = np.arange(nchans) # this sets self.nchans
@@ -629,8 +1163,43 @@ class SimpleStream(Stream):
         self.t1 = nt * self.rawtres # float us
         self.tranges = np.int64([[self.t0, self.t1]]) # int us, 2D
 
+    def share(self, wavedata):
+        """Copy wavedata into a memory-mapped temporary file, in shared memory if possible.
+        Copies of self that are sent to detection processes leave wavedata behind, and
+        reattach to the same file in open(), instead of each getting its own copy of
+        wavedata"""
+        # writing to a memmap whose file system runs out of room dies with SIGBUS instead of
+        # raising an error, so use the first of shared memory and the temp dir that has room:
+        for path in [SHMPATH, tempfile.gettempdir()]:
+            if not os.path.isdir(path):
+                continue
+            nbytes = freenbytes(path)
+            if nbytes is None or nbytes >= wavedata.nbytes: # None means can't tell
+                break
+        else:
+            raise IOError("not enough free space in %s or %s to share %.1f MB of wavedata"
+                          % (SHMPATH, tempfile.gettempdir(), wavedata.nbytes / 2**20))
+        fd, wdfname = tempfile.mkstemp(prefix='spyke_', suffix='.wavedata', dir=path)
+        os.close(fd)
+        self.wavedata = np.memmap(wdfname, dtype=wavedata.dtype, mode='w+',
+                                  shape=wavedata.shape)
+        self.wavedata[:] = wavedata
+        self.wavedata.flush()
+        self.wdfname = wdfname
+        self.wddtype, self.wdshape = wavedata.dtype.str, wavedata.shape
+        self.ownswdf = True # only the original is responsible for deleting wdfname
+
     def open(self):
-        pass
+        """Reattach to shared wavedata, if it's missing, say after unpickling"""
+        if 'wavedata' in self.__dict__:
+            return
+        try:
+            wdfname = self.wdfname
+        except AttributeError: # unpickled from an older .sort file
+            return
+        if os.path.isfile(wdfname):
+            self.wavedata = np.memmap(wdfname, dtype=self.wddtype, mode='r',
+                                      shape=self.wdshape)
 
     def is_open(self):
         return True
@@ -638,6 +1207,13 @@ class SimpleStream(Stream):
     def close(self):
         pass
 
+    def __del__(self):
+        """Delete shared wavedata file, if self created it. Any processes still attached
+        to it keep their memory map until they're done with it"""
+        if self.__dict__.get('ownswdf'):
+            try: os.remove(self.wdfname)
+            except OSError: pass
+
     def get_fname(self):
         return self._fname
 
@@ -666,7 +1242,9 @@ class SimpleStream(Stream):
         """Get object state for pickling"""
         # copy it cuz we'll be making changes, this is fast because it's just a shallow copy
         d = self.__dict__.copy()
-        try: del d['wavedata'] # takes up way too much space
+        try: del d['wavedata'] # takes up way too much space, reattach to it in open()
+        except KeyError: pass
+        try: del d['ownswdf'] # copies don't own the wavedata file
         except KeyError: pass
         return d
 
@@ -731,6 +1309,142 @@ class SimpleStream(Stream):
         data = np.int16(data)
         return WaveForm(data=data, ts=ts, chans=chans)
 
+    read = __call__ # data are already in memory, no block cache to bypass
+
+
+class MaterializedStream(Stream):
+    """Stream interface to the fully preprocessed data of a source Surf or NSX stream,
+    materialized to an int16 .npy sidecar file by Stream.materialize(). Slices of all chans
+    are zero-copy views into the copy-on-write memory mapped sidecar, so there's no need for
+    the block cache. sampfreq, shcorrect and filtmeth are fixed by the sidecar, as are the
+    chans that can be enabled. Attributes specific to the source stream's file type, such
+    as layout, masterclockfreq and srcfnameroot, are taken from the source stream"""
+    def __init__(self, stream, fname):
+        self.npyfname = fname
+        self.srcstream = stream
+        self.srctype = type(stream) # for type checking by Sort.set_stream()
+        self.f = stream.f
+        self.kind = stream.kind
+        self.converter = stream.converter
+        self.probe = stream.probe
+        self.rawsampfreq = stream.rawsampfreq
+        self.rawtres = stream.rawtres
+        self._sampfreq = stream.sampfreq
+        self._shcorrect = stream.shcorrect
+        self._filtmeth = stream.filtmeth
+        self.tres = stream.tres
+        self.t0, self.t1 = stream.t0, stream.t1
+        self.tranges = stream.tranges
+        self.allchans = np.asarray(stream.chans) # chans in rows of the sidecar
+        self.chans = self.allchans
+        # first timepoint in sidecar, same as that written by Stream.materialize():
+        self.ts0 = stream.read(self.t0, self.t0+self.rawtres).ts[0]
+        assert self.data.shape[0] == len(self.allchans)
+
+    def __getstate__(self):
+        """Get object state for pickling"""
+        d = self.__dict__.copy()
+        d.pop('_data', None) # don't pickle the memmap, reopen it on demand
+        return d
+
+    def close(self):
+        self.__dict__.pop('_data', None)
+        self.f.close()
+
+    def get_data(self):
+        """Return memory mapped sidecar data, opening it if necessary"""
+        try:
+            return self._data
+        except AttributeError:
+            self._data = np.load(self.npyfname, mmap_mode='c') # copy-on-write
+            return self._data
+
+    data = property(get_data)
+
+    def set_sampfreq(self, sampfreq):
+        if sampfreq != self._sampfreq:
+            raise ValueError("can't change sampfreq of materialized stream, materialize "
+                             "source stream with new sampfreq instead")
+
+    sampfreq = property(Stream.get_sampfreq, set_sampfreq)
+
+    def set_shcorrect(self, shcorrect):
+        if shcorrect != self._shcorrect:
+            raise ValueError("can't change shcorrect of materialized stream, materialize "
+                             "source stream with new shcorrect instead")
+
+    shcorrect = property(Stream.get_shcorrect, set_shcorrect)
+
+    def get_filtmeth(self):
+        return self._filtmeth
+
+    def set_filtmeth(self, filtmeth):
+        if filtmeth != self._filtmeth:
+            raise ValueError("can't change filtmeth of materialized stream, materialize "
+                             "source stream with new filtmeth instead")
+
+    filtmeth = property(get_filtmeth, set_filtmeth)
+
+    def get_chans(self):
+        return self._chans
+
+    def set_chans(self, chans):
+        if not set(chans).issubset(self.allchans):
+            raise ValueError("can't enable chans %r of materialized stream, only chans %r "
+                             "were materialized" % (chans, self.allchans))
+        self._chans = chans
+
+    chans = property(get_chans, set_chans)
+
+    def get_layout(self):
+        return self.srcstream.layout
+
+    layout = property(get_layout)
+
+    def get_masterclockfreq(self):
+        return self.srcstream.masterclockfreq
+
+    masterclockfreq = property(get_masterclockfreq)
+
+    def get_srcfnameroot(self):
+        return self.srcstream.srcfnameroot
+
+    srcfnameroot = property(get_srcfnameroot)
+
+    def tsi(self, t):
+        """Return index of first timepoint in sidecar >= t"""
+        ti = intfloor((t - self.ts0) / self.tres)
+        if self.ts0 + ti*self.tres < t:
+            ti += 1
+        return min(max(ti, 0), self.data.shape[1])
+
+    def __call__(self, start, stop, chans=None):
+        """Called when Stream object is called using (). start and stop indicate start and end
+        timepoints in us wrt t=0. Returns the corresponding WaveForm object with just the
+        specified chans"""
+        if chans is None:
+            chans = self.chans
+        if not set(chans).issubset(self.chans):
+            raise ValueError("requested chans %r are not a subset of available enabled "
+                             "chans %r in %s stream" % (chans, self.chans, self.kind))
+        return self.read(start, stop, chans)
+
+    def read(self, start, stop, chans=None):
+        """Return WaveForm of sidecar data from start to stop with just the specified chans,
+        a zero-copy view if chans are all the chans in the sidecar"""
+        if chans is None:
+            chans = self.chans
+        lo = self.tsi(start)
+        hi = max(self.tsi(stop), lo)
+        ts = self.ts0 + np.arange(lo, hi) * self.tres
+        allchans = self.allchans
+        if len(chans) == len(allchans) and (chans == allchans).all():
+            data = self.data[:, lo:hi]
+        else:
+            chanis = [ int(np.where(chan == allchans)[0]) for chan in chans ]
+            data = self.data[chanis, lo:hi]
+        return WaveForm(data=data, ts=ts, chans=chans)
+
 
 class MultiStream(object):
     """A collection of multiple streams, all from the same track/insertion/series. This is
@@ -789,7 +1503,7 @@ class MultiStream(object):
         self.fnames = [f.fname for f in fs]
         self.rawsampfreq = streams[0].rawsampfreq # assume they're identical
         self.rawtres = streams[0].rawtres # float us, assume they're identical
-        contiguous = np.asarray([stream.contiguous for stream in streams])
+        contiguous = np.asarray([ len(stream.tranges) == 1 for stream in streams ])
         if not contiguous.all() and kind == 'highpass':
             # don't bother reporting again for lowpass
             fnames = [ s.fname for s, c in zip(streams, contiguous) if not c ]
@@ -803,11 +1517,13 @@ class MultiStream(object):
 
         # set sampfreq and shcorrect for all streams
         if kind == 'highpass':
-            self.sampfreq = sampfreq or DEFHPSRFSAMPFREQ # desired sampling frequency
+            # desired sampling frequency:
+            self.sampfreq = sampfreq or DEFHPRESAMPLEX * self.rawsampfreq
             self.shcorrect = shcorrect or DEFHPSRFSHCORRECT
         else: # kind == 'lowpass'
             self.sampfreq = sampfreq or self.rawsampfreq # don't resample by default
             self.shcorrect = shcorrect or False # don't s+h correct by default
+        self.metrics = StreamMetrics() # accumulate metrics of all streams in one place
 
     def is_open(self):
         return np.all([stream.is_open() for stream in self.streams])
@@ -826,6 +1542,21 @@ class MultiStream(object):
 
     dt = property(get_dt)
 
+    def get_metrics(self):
+        """Get StreamMetrics of self, shared by all of its streams"""
+        try:
+            return self._metrics
+        except AttributeError: # also for MultiStreams unpickled from older .sort files
+            self.metrics = StreamMetrics()
+            return self._metrics
+
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+        for stream in self.streams:
+            stream.metrics = metrics
+
+    metrics = property(get_metrics, set_metrics)
+
     def get_chans(self):
         return self.streams[0].chans # assume they're identical
 
@@ -846,6 +1577,7 @@ class MultiStream(object):
     def set_sampfreq(self, sampfreq):
         for stream in self.streams:
             stream.sampfreq = sampfreq
+        blockcache.invalidate(self)
 
     sampfreq = property(get_sampfreq, set_sampfreq)
 
@@ -860,6 +1592,7 @@ class MultiStream(object):
     def set_shcorrect(self, shcorrect):
         for stream in self.streams:
             stream.shcorrect = shcorrect
+        blockcache.invalidate(self)
 
     shcorrect = property(get_shcorrect, set_shcorrect)
     '''
@@ -874,6 +1607,42 @@ class MultiStream(object):
         for stream in self.streams:
             stream.pickle()
 
+    def export_dat(self, dt=None):
+        """Export raw ephys data of all streams in self to a single .dat file, in (ti,
+        chani) order, named after the track file and saved in the same folder as the first
+        stream's file. Streams are concatenated back to back, without any zero-filling of
+        the gaps between them, and each stream is written a chunk at a time. The starting
+        timepoint of each stream's data in the .dat file is printed out. dt is duration to
+        export from start of first stream, in sec"""
+        streams = self.streams
+        ndatchans = streams[0].ndatchans
+        if not np.all([ stream.ndatchans == ndatchans for stream in streams ]):
+            raise RuntimeError("not all files have the same number of chans")
+        if dt == None:
+            nt = None
+            dtstr = ''
+        else:
+            nt = intround(dt * self.rawsampfreq)
+            dtstr = str(dt)
+        datbasefname = os.path.splitext(self.fname)[0]
+        fulldatfname = streams[0].f.join('%s_%ss.dat' % (datbasefname, dtstr))
+        print('writing raw ephys data to %r' % fulldatfname)
+        ntwritten = 0 # number of timepoints written so far
+        with open(fulldatfname, 'wb') as datf:
+            for stream in streams:
+                if nt != None and ntwritten >= nt:
+                    break
+                print('%s starts at timepoint %d' % (stream.fname, ntwritten))
+                if nt == None:
+                    ntwritten += stream.write_dat(datf)
+                else:
+                    ntwritten += stream.write_dat(datf, nt - ntwritten)
+        print('%d bytes written' % (ntwritten*ndatchans*2))
+        print('%d actual timepoints written' % ntwritten)
+        print('voltage gain: %g uV/AD' % self.converter.AD2uV(1))
+        print('sample rate: %d Hz' % self.rawsampfreq)
+        print('total number of chans: %d' % ndatchans)
+
     def __getitem__(self, key):
         """Called when Stream object is indexed into using [] or with a slice object,
         indicating start and end timepoints in us. Returns the corresponding WaveForm
@@ -883,37 +1652,77 @@ class MultiStream(object):
         return self(key.start, key.stop, self.chans)
 
     def __call__(self, start, stop, chans=None):
-        """Figure out which stream(s) the slice spans (usually just one, sometimes 0 or
-        2), send the request to the stream(s), generate the appropriate timestamps, and
-        return the waveform"""
+        """Called when MultiStream object is called using (). Returns the WaveForm from
+        start to stop with just the specified chans, served from the block cache where
+        possible"""
         if chans is None:
             chans = self.chans
         if not set(chans).issubset(self.chans):
             raise ValueError("requested chans %r are not a subset of available enabled "
                              "chans %r in %s stream" % (chans, self.chans, self.kind))
+        return blockcache(self, start, stop, chans)
+
+    def read(self, start, stop, chans=None):
+        """Figure out which stream(s) the slice spans (usually just one, sometimes 0 or
+        more), send the request to the stream(s), generate the appropriate timestamps, and
+        return the waveform. Bypasses the block cache, both of self and of the streams.
+        Spanned streams are read concurrently, each in its own thread. Each stream's read
+        returns its own array, which the thread then copies into its slice of a single
+        preallocated output array"""
+        if chans is None:
+            chans = self.chans
         nchans = len(chans)
         start, stop = max(start, self.t0), min(stop, self.t1) # stay in bounds
-        streamis = []
-        ## TODO: this could probably be more efficient by not iterating over all streams:
-        for streami, trange in enumerate(self.streamtranges):
-            if (trange[0] <= start < trange[1]) or (trange[0] <= stop < trange[1]):
-                streamis.append(streami)
+        # streamtranges are sorted and don't overlap, so find all streams that end after
+        # start and begin before stop:
+        streami0 = self.streamtranges[:, 1].searchsorted(start, side='right')
+        streami1 = self.streamtranges[:, 0].searchsorted(stop, side='left')
+        streamis = range(streami0, streami1)
         tres = self.tres
-        ts = np.arange(start, stop, tres)
-        data = np.zeros((nchans, len(ts)), dtype=np.int16) # any gaps will have zeros
-        for streami in streamis:
-            stream = self.streams[streami]
-            abst0 = self.streamtranges[streami, 0] # absolute start time of stream
-            # find start and end offsets relative to abst0
-            relt0 = max(start - abst0, 0) # stay within stream's lower limit
-            relt1 = min(stop - abst0, stream.t1 - stream.t0) # stay within stream's upper limit
-            # source slice times:
-            st0 = relt0 + stream.t0
-            st1 = relt1 + stream.t0
-            sdata = stream(st0, st1, chans).data # source data
-            # destination time indices:
-            dt0i = (abst0 + relt0 - start) // tres # absolute index
-            dt1i = dt0i + sdata.shape[1]
-            data[:, dt0i:dt1i] = sdata
+        # timestamps are absolute multiples of tres, so they don't depend on start, say
+        # when the block cache reads from block edges halfway between samples. Timestamps
+        # that fall exactly on start or stop may be off by a rounding error, give them the
+        # same small tolerance as the block cache does:
+        ti0 = intceil(start / tres - 0.001)
+        ti1 = max(intceil(stop / tres - 0.001), ti0)
+        nt = ti1 - ti0
+        ts = np.arange(ti0, ti1) * tres
+        data = np.zeros((nchans, nt), dtype=np.int16) # any gaps will have zeros
+        errors = []
+
+        def readstream(streami):
+            try:
+                stream = self.streams[streami]
+                abst0, abst1 = self.streamtranges[streami] # absolute start and end of stream
+                # absolute time indices that fall within both the stream and start:stop:
+                dti0 = max(ti0, intceil(abst0 / tres - 0.001))
+                dti1 = min(ti1, intceil(abst1 / tres - 0.001))
+                if dti1 <= dti0:
+                    return
+                # source slice times, half a sample early, so that each destination
+                # timepoint gets the stream's sample that's nearest to it:
+                st0 = dti0 * tres - abst0 + stream.t0 - tres / 2
+                st1 = dti1 * tres - abst0 + stream.t0 - tres / 2
+                swave = stream.read(st0, st1, chans) # source data
+                if len(swave.ts) == 0:
+                    return
+                # destination time indices, wrt ti0:
+                dt0i = intround((swave.ts[0] - stream.t0 + abst0) / tres) - ti0
+                lo = max(dt0i, dti0 - ti0)
+                hi = min(dt0i + len(swave.ts), dti1 - ti0)
+                data[:, lo:hi] = swave.data[:, lo-dt0i:hi-dt0i]
+            except Exception as err:
+                errors.append(err)
+
+        if len(streamis) == 1:
+            readstream(streamis[0])
+        else:
+            threads = [ threading.Thread(target=readstream, args=(streami,))
+                        for streami in streamis ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
         return WaveForm(data=data, ts=ts, chans=chans)
-
@@ -20,9 +20,6 @@ import datetime
 from core import iterable, toiter, issorted, intround, NULL
 from stream import SurfStream
 
-DEFNHIGHPASSRECORDS = 50000
-DEFNLOWPASSRECORDS = 300000
-DEFNDIGITALSVALRECORDS = 600000
 CTSRECORDDTYPE = [('TimeStamp', '<i8'), ('Probe', '<i2'), ('NumSamples', '<i4'),
                   ('dataoffset', '<i8')]
 LPMCRECORDDTYPE = [('TimeStamp', '<i8'), ('Probe', '<i2'), ('NumSamples', '<i4'),
@@ -31,14 +28,26 @@ DIGITALSVALDTYPE = [('TimeStamp', np.int64), ('SVal', np.uint16)]
 # epoch for message and display record DateTime stamps:
 EPOCH = datetime.datetime(1899, 12, 30, 0, 0, 0)
 
-"""Create a couple of Struct objects with compiled format strings and call them as needed
-for the most common record types. Using np.fromfile to load one dtype record at a time
-without intermediate string isn't any faster. Without little endian < symbol, struct.unpack
-uses 4 byte native size and alignment"""
-ctsstruct = Struct('qqhhii')
-dsvalstruct = Struct('qqhhi')
-unpackctsrec = ctsstruct.unpack
-unpackdsvalrec = dsvalstruct.unpack
+"""Byte offsets of fields wrt the start (the 2 byte flag) of the most common record types,
+and their total lengths in bytes, not including any waveform data. Continuous (high and low
+pass) records are followed by NumSamples int16 samples of waveform data"""
+CTSTIMESTAMPOFFSET = 8
+CTSPROBEOFFSET = 16
+CTSNUMSAMPLESOFFSET = 24
+CTSRECORDLEN = 28
+DSVALTIMESTAMPOFFSET = 8
+DSVALSVALOFFSET = 16
+DSVALRECORDLEN = 24
+unpacknumsamples = Struct('<i').unpack_from
+
+"""Versioned .parse file format. A fixed size header of magic string, format version and
+length of the pickled header that follows it, then the raw record struct array blocks"""
+PARSEMAGIC = 'SPYKEPRS'
+PARSEVERSION = 1
+parseheaderstruct = Struct('<8sIQ')
+# File attribs not to save in .parse file:
+PARSESKIPATTRS = ['f', '_mmap', 'hpstream', 'lpstream', 'fname', 'parsefname', 'path',
+                  '_pickle_all_records']
 
 
 class DRDBError(ValueError):
@@ -63,9 +72,9 @@ class File(object):
         self._parseFileHeader()
         self.parsefname = fname + '.parse'
         # init struct ndarrays for high volume record types
-        self.highpassrecords = np.empty(DEFNHIGHPASSRECORDS, dtype=CTSRECORDDTYPE)
-        self.lowpassrecords = np.empty(DEFNLOWPASSRECORDS, dtype=CTSRECORDDTYPE)
-        self.digitalsvalrecords = np.empty(DEFNDIGITALSVALRECORDS, dtype=DIGITALSVALDTYPE)
+        self.highpassrecords = np.empty(0, dtype=CTSRECORDDTYPE)
+        self.lowpassrecords = np.empty(0, dtype=CTSRECORDDTYPE)
+        self.digitalsvalrecords = np.empty(0, dtype=DIGITALSVALDTYPE)
         self.nhighpassrecords = 0
         self.nlowpassrecords = 0
         self.ndigitalsvalrecords = 0
@@ -77,9 +86,19 @@ class File(object):
     def open(self):
         """(Re)open previously closed .srf file"""
         self.f = open(self.join(self.fname), 'rb')
+        # also map the whole file into memory, for loading waveform data from many records
+        # at once without any seeking. Numpy always assumes binary mode:
+        self._mmap = np.memmap(self.f, dtype=np.uint8, mode='r')
 
     def close(self):
         """Close the .srf file"""
+        # the only way to close a np.memmap is to close its underlying mmap and make sure
+        # there aren't any remaining handles to it
+        try:
+            self._mmap._mmap.close()
+            del self._mmap
+        except AttributeError: # self._mmap unbound
+            pass
         self.f.close()
 
     def is_open(self):
@@ -131,6 +150,8 @@ class File(object):
         d = self.__dict__.copy() # copy it cuz we'll be making changes
         if 'f' in d:
             del d['f'] # exclude open .srf file handle, if any
+        if '_mmap' in d:
+            del d['_mmap'] # exclude open mmap of .srf file, if any
         if not self._pickle_all_records:
             # these are hogs:
             keys = ['lowpassrecords', 'highpassrecords', 'lowpassmultichanrecords',
@@ -166,18 +187,19 @@ class File(object):
                 break
 
     def parse(self, force=False, save=True):
-        """Parse the .srf file, potentially unpickling parse info from
+        """Parse the .srf file, potentially recovering parse info from
         a .parse file. If doing a new parsing, optionally save parse info
         to a .parse file"""
         t0 = time.time()
-        try: # recover self pickled in .parse file
+        try: # recover parse info from .parse file
             if force: # force a new parsing
-                raise IOError # make the try fail, skip to the except block
+                raise IOError('forced new parsing')
             self.unpickle()
             print('unpickling took %.3f sec' % (time.time()-t0))
         # parsing is being forced, or .parse file doesn't exist, or something's
-        # wrong with it (perhaps class names have changed). Parse the .srf file
-        except:
+        # wrong with it. Parse the .srf file
+        except Exception as err:
+            print("Couldn't recover parse info: %s: %s" % (type(err).__name__, err))
             print('Parsing %r' % self.fname)
             self._parseDRDBS()
             #cProfile.runctx('self._parseRecords()', globals(), locals())
@@ -187,29 +209,31 @@ class File(object):
             self._trimRecords()
             self._buildLowpassMultiChanRecords()
             self._verifyParsing()
-
-            if hasattr(self, 'highpassrecords'):
-                # highpass record (spike) stream:
-                self.hpstream = SurfStream(self, kind='highpass')
-            else:
-                self.hpstream = None
-            if hasattr(self, 'lowpassmultichanrecords'):
-                # lowpassmultichan record (LFP) stream:
-                self.lpstream = SurfStream(self, kind='lowpass')
-            else:
-                self.lpstream = None
+            self._initStreams()
 
             if save:
                 tsave = time.time()
                 self.pickle()
                 print('pickling took %.3f sec' % (time.time()-tsave))
 
+    def _initStreams(self):
+        """Init high and low pass streams from parsed records"""
+        if hasattr(self, 'highpassrecords'):
+            # highpass record (spike) stream:
+            self.hpstream = SurfStream(self, kind='highpass')
+        else:
+            self.hpstream = None
+        if hasattr(self, 'lowpassmultichanrecords'):
+            # lowpassmultichan record (LFP) stream:
+            self.lpstream = SurfStream(self, kind='lowpass')
+        else:
+            self.lpstream = None
+
     def _parseRecords(self):
-        """Parse all the records in the file, but don't load any waveforms"""
-        # dict of parse methods for most common records that will be stored in structured arrays
-        FLAG2METHOD = {'PS' : self.parseHighPassRecord,
-                       'PC' : self.parseLowPassRecord,
-                       'VD' : self.parseDigitalSValRecord}
+        """Parse all the records in the file, but don't load any waveforms. Walk the
+        memory-mapped file from record to record, only noting the offsets of the most common
+        records, and parse the rest with their own parse methods. Then fill the struct
+        arrays of the most common records in bulk"""
         # dict of (record type, listname to store it in) tuples
         FLAG2REC = {'L'  : (LayoutRecord, 'layoutrecords'),
                     'MS' : (SurfMessageRecord, 'messagerecords'),
@@ -218,91 +242,128 @@ class File(object):
                     'D'  : (DisplayRecord, 'displayrecords'),
                     'VA' : (AnalogSValRecord, 'analogsvalrecords')}
         f = self.f
+        mm = self._mmap
+        buf = mm.data # raw bytes of mm, slicing gives strings
+        offset = f.tell()
+        hpoffsets, lpoffsets, dsvaloffsets = [], [], []
         while True:
+            # skip over the run of most common records starting at offset, if any:
+            offset = walkrecords(mm, offset, hpoffsets, lpoffsets, dsvaloffsets)
             # returns an empty string when EOF is reached
-            flag = f.read(2).rstrip(NULL) # TODO: should this strip NULL as defined above?
+            flag = buf[offset:offset+2].rstrip(NULL)
             if flag == '':
                 break
-            # put file pointer back to start of flag
-            f.seek(-2, 1) # TODO: unnecessary - doesn't this slow down parsing quite a bit?
-            if flag in FLAG2METHOD: # these are the most common
-                FLAG2METHOD[flag](f) # call the method
-            elif flag in FLAG2REC:
+            if flag in FLAG2REC:
                 rectype, reclistname = FLAG2REC[flag]
                 rec = rectype()
+                f.seek(offset)
                 rec.parse(f)
-                #wx.Yield() # allow wx GUI event processing during parsing
                 self._appendRecord(rec, reclistname)
+                offset = f.tell()
             else:
-                raise ValueError('Unexpected flag %r at offset %d' % (flag, f.tell()))
-            #self.percentParsed = f.tell() / self.filesize * 100
-
-    def parseContinuousRecord(self, f, r):
-        """Parse a continuous record (high or low pass).
-        Its length in the file in bytes is 26 + self.NumSamples*2, not including the
-        2 byte flag at the beginning"""
-        '''
-        junk, junk, r['TimeStamp'], r['Probe'], junk, junk, NumSamples =
-            unpack('<hiqhhii', f.read(26))
-        '''
-        #junk, r['TimeStamp'], r['Probe'], junk, junk, NumSamples = unpack('qqhhii', f.read(28))
-        junk, r['TimeStamp'], r['Probe'], junk, junk, NumSamples = unpackctsrec(f.read(28))
-        r['NumSamples'] = NumSamples
-        r['dataoffset'] = f.tell()
-        # skip the waveform data for now
-        f.seek(NumSamples*2, 1) # each sample is 2 bytes long
-
-    def parseHighPassRecord(self, f):
-        try:
-            r = self.highpassrecords[self.nhighpassrecords] # gives a np.void with named fields
-        except IndexError:
-            newsize = len(self.highpassrecords) + DEFNHIGHPASSRECORDS
-            self.highpassrecords.resize(newsize, refcheck=False)
-            r = self.highpassrecords[self.nhighpassrecords] # gives a np.void with named fields
-        # writes to the np.void, and therefore to the struct array:
-        self.parseContinuousRecord(f, r)
-        self.nhighpassrecords += 1
-
-    def parseLowPassRecord(self, f):
-        try:
-            r = self.lowpassrecords[self.nlowpassrecords] # gives a np.void with named fields
-        except IndexError:
-            newsize = len(self.lowpassrecords) + DEFNLOWPASSRECORDS
-            self.lowpassrecords.resize(newsize, refcheck=False)
-            r = self.lowpassrecords[self.nlowpassrecords] # gives a np.void with named fields
-        # writes to the np.void, and therefore to the struct array:
-        self.parseContinuousRecord(f, r)
-        self.nlowpassrecords += 1
-
-    def parseDigitalSValRecord(self, f):
-        """Parse a digital SVal record. Its length in the file in bytes is 22,
-        not including the 2 byte flag at the beginning"""
-        try:
-            # gives an np.void with named fields:
-            r = self.digitalsvalrecords[self.ndigitalsvalrecords]
-        except IndexError:
-            newsize = len(self.digitalsvalrecords) + DEFNDIGITALSVALRECORDS
-            self.digitalsvalrecords.resize(newsize, refcheck=False)
-            # gives an np.void with named fields:
-            r = self.digitalsvalrecords[self.ndigitalsvalrecords]
-        #junk, junk, r['TimeStamp'], r['SVal'], junk, junk = unpack('<hiqhhi', f.read(22))
-        #junk, r['TimeStamp'], r['SVal'], junk, junk = unpack('qqhhi', f.read(24))
-        junk, r['TimeStamp'], r['SVal'], junk, junk = unpackdsvalrec(f.read(24))
-        self.ndigitalsvalrecords += 1
-
-    def loadContinuousRecord(self, record):
-        """Load continuous waveform data from record"""
-        # TODO: add chans arg to pull out only certain chans, and maybe a ti arg
-        # to pull out less than the full set of sample points for this record
-        self.f.seek(record['dataoffset'])
-        # {ADC Waveform type; dynamic array of SHRT (signed 16 bit)} - converted to an ndarray
-        # stuct.unpack for this is very slow, load directly using numpy
-        data = np.fromfile(self.f, dtype=np.int16, count=record['NumSamples'])
-        data -= 2048 # offset 12 bit unsigned data to be centered around 0
+                raise ValueError('Unexpected flag %r at offset %d' % (flag, offset))
+        self.highpassrecords = self._gatherContinuousRecords(hpoffsets)
+        self.lowpassrecords = self._gatherContinuousRecords(lpoffsets)
+        self.digitalsvalrecords = self._gatherDigitalSValRecords(dsvaloffsets)
+        self.nhighpassrecords = len(self.highpassrecords)
+        self.nlowpassrecords = len(self.lowpassrecords)
+        self.ndigitalsvalrecords = len(self.digitalsvalrecords)
+
+    def _gather(self, offsets, dtype):
+        """Return an array of dtype values found at byte offsets into the memory-mapped file,
+        all in one go"""
+        mm = self._mmap
+        dtype = np.dtype(dtype)
+        # view of a dtype value starting at every byte in the file, which may be unaligned:
+        view = np.ndarray(shape=(len(mm)-dtype.itemsize+1,), dtype=dtype, buffer=mm,
+                          strides=(1,))
+        return view[offsets]
+
+    def _gatherContinuousRecords(self, offsets):
+        """Return struct array of continuous records starting at offsets"""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        records = np.empty(len(offsets), dtype=CTSRECORDDTYPE)
+        records['TimeStamp'] = self._gather(offsets+CTSTIMESTAMPOFFSET, '<i8')
+        records['Probe'] = self._gather(offsets+CTSPROBEOFFSET, '<i2')
+        records['NumSamples'] = self._gather(offsets+CTSNUMSAMPLESOFFSET, '<i4')
+        records['dataoffset'] = offsets + CTSRECORDLEN
+        return records
+
+    def _gatherDigitalSValRecords(self, offsets):
+        """Return struct array of digital SVal records starting at offsets"""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        records = np.empty(len(offsets), dtype=DIGITALSVALDTYPE)
+        records['TimeStamp'] = self._gather(offsets+DSVALTIMESTAMPOFFSET, '<i8')
+        records['SVal'] = self._gather(offsets+DSVALSVALOFFSET, '<u2')
+        return records
+
+    def loadContinuousRecord(self, record, chanis=None, ti0=None, ti1=None):
+        """Load continuous waveform data from record. Optionally, load only row indices
+        chanis, and only sample indices ti0 to ti1, of the record. Only the requested data are
+        copied out of the memory-mapped file, so cost scales with the amount requested"""
         nchans = self.layoutrecords[record['Probe']].nchans
-        data.shape = (nchans, -1) # reshape to have nchans rows, as indicated in layout
+        nt = record['NumSamples'] // nchans
+        # {ADC Waveform type; dynamic array of SHRT (signed 16 bit)} - (nchans, nt) view
+        # into the mmap, without any copying:
+        view = self._recordview(nchans, nt)[record['dataoffset']]
+        if chanis is None:
+            data = view[:, ti0:ti1].copy()
+        else:
+            data = view[chanis, ti0:ti1] # fancy indexing copies only the chanis rows
+        data -= 2048 # offset 12 bit unsigned data to be centered around 0
         return data
 
+    def loadContinuousRecords(self, records, chanis=None, ti0=None, ti1=None):
+        """Load continuous waveform data from multiple records in one go. Optionally, load
+        only row indices chanis, and only sample indices ti0 to ti1, of each record. All
+        records must have the same Probe and NumSamples. Return a (nrecords, nchans, nt) int16
+        array. Unlike loadContinuousRecord, the 12 bit unsigned data are *not* offset to be
+        centered around 0, so the caller can do that in a single pass over all the records,
+        together with any rescaling"""
+        probe, NumSamples = records[0]['Probe'], records[0]['NumSamples']
+        if not ((records['Probe'] == probe).all() and
+                (records['NumSamples'] == NumSamples).all()):
+            raise ValueError("records don't all have the same Probe and NumSamples")
+        nchans = self.layoutrecords[probe].nchans
+        nt = NumSamples // nchans
+        # slicing the strided view along time doesn't copy anything:
+        view = self._recordview(nchans, nt)[:, :, ti0:ti1]
+        # index into the strided view with all the records' dataoffsets at once. This
+        # fancy indexing copies only the requested records' data out of the mmap:
+        if chanis is None:
+            return view[records['dataoffset']]
+        else:
+            return view[records['dataoffset'][:, None], chanis]
+
+    def loadLowPassRecords(self, lpreciss, ti0=None, ti1=None):
+        """Load waveform data from single chan lowpass records at indices lpreciss into
+        self.lowpassrecords, in one go. Optionally, load only sample indices ti0 to ti1 of
+        each record. All records must have the same NumSamples. Return an int16 array of
+        shape lpreciss.shape + (nt,). As in loadContinuousRecords, data are *not* offset to
+        be centered around 0"""
+        lpreciss = np.asarray(lpreciss)
+        records = self.lowpassrecords[lpreciss.ravel()]
+        nt = records[0]['NumSamples']
+        if not (records['NumSamples'] == nt).all():
+            raise ValueError("lowpass records don't all have the same NumSamples")
+        # (file offset, ti) view, all records are single chan:
+        view = self._recordview(1, nt)[:, 0, ti0:ti1]
+        return view[records['dataoffset'].reshape(lpreciss.shape)]
+
+    def _recordview(self, nchans, nt):
+        """Return a (file offset, chan, ti) int16 strided view of the memory-mapped .srf file.
+        Indexing into the 0th dimension with a continuous record's dataoffset gives that
+        record's (nchans, nt) waveform data. Records can start at any byte offset, so the
+        view has a stride of 1 byte in the 0th dimension, and may be unaligned"""
+        try:
+            mm = self._mmap
+        except AttributeError:
+            raise RuntimeError('waveform data not available, file is closed/mmap deleted?')
+        nbytes = nchans * nt * 2 # record data length in bytes
+        noffsets = len(mm) - nbytes + 1 # number of possible record start offsets in file
+        return np.ndarray(shape=(noffsets, nchans, nt), dtype='<i2', buffer=mm,
+                          strides=(1, nt*2, 2))
+
     def _appendRecord(self, rec, reclistname):
         """Append record to reclistname"""
         if reclistname not in self.__dict__: # if not already an attrib
@@ -464,22 +525,78 @@ class File(object):
         return chans
 
     def pickle(self):
-        """Pickle self to a .parse file"""
+        """Save parse info to a versioned binary .parse index file. It starts with a small
+        header holding all parsed attribs other than the record struct arrays (file header,
+        DRDBs, layout, message and display records, etc.), pickled as builtin types only so
+        that moving or renaming classes can't break it. Then come the raw struct arrays, each
+        in its own block, to be memory-mapped on load"""
         print('Saving parse info to %r' % self.parsefname)
-        pf = open(self.join(self.parsefname), 'wb') # can also compress pickle with gzip
-        self._pickle_all_records = True # signal to __getstate__ to pickle all records
-        wasopen = self.is_open()
-        if wasopen: self.close()
-        # pickle self to .parse file, use most efficient (least human readable) protocol:
-        cPickle.dump(self, pf, protocol=-1)
-        pf.close()
-        if wasopen: self.open() # reopen it
-        self._pickle_all_records = False # reset to not pickle all records by default
+        attribs, arrays, blocks = {}, {}, []
+        offset = 0 # of each block wrt end of header
+        for name, val in self.__dict__.items():
+            if name in PARSESKIPATTRS:
+                continue
+            if isinstance(val, np.ndarray) and val.dtype.names != None: # struct array
+                arrays[name] = (val.dtype.descr, len(val), offset)
+                blocks.append(val)
+                offset += val.nbytes
+            else:
+                attribs[name] = obj2state(val)
+        header = cPickle.dumps({'attribs': attribs, 'arrays': arrays}, protocol=2)
+        # write to a temp file and rename it into place, instead of truncating a .parse
+        # file that the record struct arrays may still be memory-mapped from:
+        parsefname = self.join(self.parsefname)
+        tmpfname = parsefname + '.tmp'
+        with open(tmpfname, 'wb') as pf:
+            pf.write(parseheaderstruct.pack(PARSEMAGIC, PARSEVERSION, len(header)))
+            pf.write(header)
+            for block in blocks:
+                block.tofile(pf)
+        os.rename(tmpfname, parsefname)
         print('Saved parse info to %r' % self.parsefname)
 
     def unpickle(self):
-        """Unpickle self from a .parse file"""
+        """Recover parse info from a .parse file. Record struct arrays are memory-mapped
+        (copy-on-write), not loaded. Old style .parse files that are a pickle of the whole
+        File object are converted to the new format"""
         print('Trying to recover parse info from %r' % self.parsefname)
+        parsefname = self.join(self.parsefname)
+        with open(parsefname, 'rb') as pf:
+            magic, version, headerlen = parseheaderstruct.unpack(
+                pf.read(parseheaderstruct.size))
+            if magic != PARSEMAGIC:
+                pf.close()
+                self.unpickle_pickled()
+                self.pickle() # convert to new format, so it needn't be done again
+                return
+            if version > PARSEVERSION:
+                raise ValueError('.parse file version %d is newer than supported version %d'
+                                 % (version, PARSEVERSION))
+            header = cPickle.loads(pf.read(headerlen))
+        # future format changes should upgrade header of older versions here
+        blocksoffset = parseheaderstruct.size + headerlen
+        for name, state in header['attribs'].items():
+            # don't overwrite fnames, fnames in .track files have a leading '../'
+            if name not in ['fname', 'parsefname', 'path']:
+                setattr(self, name, state2obj(state))
+        # remove any high volume record struct arrays init'd in self.__init__ that were
+        # empty, and therefore not saved:
+        for name in ['highpassrecords', 'lowpassrecords', 'digitalsvalrecords']:
+            if name not in header['arrays']:
+                self.__dict__.pop(name, None)
+        for name, (descr, n, offset) in header['arrays'].items():
+            dtype = np.dtype(descr)
+            if n == 0: # can't memmap 0 bytes
+                arr = np.empty(0, dtype=dtype)
+            else:
+                arr = np.memmap(parsefname, dtype=dtype, mode='c',
+                                offset=blocksoffset+offset, shape=(n,))
+            setattr(self, name, arr)
+        self._initStreams()
+        print('Recovered parse info from %r' % self.parsefname)
+
+    def unpickle_pickled(self):
+        """Unpickle self from an old style .parse file, a pickle of the whole File object"""
         pf = open(self.join(self.parsefname), 'rb') # can also uncompress pickle with gzip
         #self = cPickle.load(pf) # NOTE: this doesn't work as intended
         other = cPickle.load(pf)
@@ -491,7 +608,7 @@ class File(object):
             if name == 'f': # there should never be an other.f attrib
                 raise ValueError("pickled srff in .parse shouldn't have an .f attrib!")
             # don't overwrite fnames, fnames in .track files have a leading '../'
-            if name not in ['fname', 'parsefname', 'path']:
+            if name not in ['fname', 'parsefname', 'path', '_pickle_all_records']:
                 setattr(self, name, getattr(other, name))
         # Though empty high volume records were removed before being saved to .parse,
         # when opening a .srf file anew, self is re-init'd (see SpykeWindow.OpenStreamFile)
@@ -499,7 +616,6 @@ class File(object):
         # self.__init__) and therefore needs to be checked for any that are empty
         # (digitalsvalrecords is the occasional example for recordings <= ptc15)
         self._trimRecords()
-        print('Recovered parse info from %r' % self.parsefname)
 
 
 class FileHeader(object):
@@ -934,6 +1050,37 @@ class StimulusHeader(object):
         self.checksum, = unpack('H', f.read(2))
 
 
+def walkrecords(mm, offset, hpoffsets, lpoffsets, dsvaloffsets):
+    """Walk the run of consecutive highpass ('PS'), lowpass ('PC') and digital SVal ('VD')
+    records in memory-mapped uint8 array mm, starting at byte offset. Append the offset of
+    each record to its list, and return the offset of the first record (or EOF) that isn't
+    one of these. Each record's length is known from its type and, for continuous records,
+    from its NumSamples, so there's no need to parse anything else"""
+    buf = mm.data # raw bytes of mm, slicing gives strings
+    nbytes = len(buf)
+    while offset < nbytes:
+        flag = buf[offset:offset+2]
+        if flag == 'PS':
+            hpoffsets.append(offset)
+        elif flag == 'PC':
+            lpoffsets.append(offset)
+        elif flag == 'VD':
+            dsvaloffsets.append(offset)
+            offset += DSVALRECORDLEN
+            continue
+        else:
+            break
+        NumSamples, = unpacknumsamples(buf, offset+CTSNUMSAMPLESOFFSET)
+        offset += CTSRECORDLEN + NumSamples*2 # each sample is 2 bytes long
+    return offset
+
+try: # use the much faster Cython version of walkrecords(), if it builds:
+    import pyximport
+    pyximport.install(build_in_temp=False, inplace=True)
+    from util import walksrfrecords as walkrecords # .pyx file
+except ImportError:
+    print('WARNING: falling back to slow pure Python .srf record walk')
+
 def get_record_timestamps(records):
     """Return timestamps of records iterable, used for sorting records in
     temporal order"""
@@ -948,3 +1095,57 @@ def get_record_timestamps(records):
     except AttributeError:
         ts = np.asarray([ record['TimeStamp'] for record in records ])
     return ts
+
+def obj2state(obj):
+    """Recursively convert obj to builtin (and numpy) types for saving in a .parse file.
+    Instances of surf classes become dicts holding their PARSECLASSES key and the state of
+    their __dict__"""
+    if type(obj) in PARSECLASSNAMES:
+        return {'__parseclass__': PARSECLASSNAMES[type(obj)],
+                '__dict__': obj2state(obj.__dict__)}
+    elif type(obj) == dict:
+        return dict([ (key, obj2state(val)) for key, val in obj.items() ])
+    elif type(obj) in [list, tuple]:
+        return type(obj)([ obj2state(val) for val in obj ])
+    else:
+        return obj
+
+def state2obj(state):
+    """Inverse of obj2state()"""
+    if type(state) == dict and '__parseclass__' in state:
+        cls = PARSECLASSES[state['__parseclass__']]
+        obj = cls.__new__(cls)
+        obj.__dict__.update(state2obj(state['__dict__']))
+        return obj
+    elif type(state) == dict:
+        return dict([ (key, state2obj(val)) for key, val in state.items() ])
+    elif type(state) in [list, tuple]:
+        return type(state)([ state2obj(val) for val in state ])
+    else:
+        return state
+
+# classes that can be saved in a .parse file. Keys are part of the file format, and mustn't
+# change even if a class is renamed:
+PARSECLASSES = {'FileHeader': FileHeader,
+                'TimeDate': TimeDate,
+                'DRDB': DRDB,
+                'RSFD': RSFD,
+                'LayoutRecord': LayoutRecord,
+                'ProbeWinLayout': ProbeWinLayout,
+                'EpochRecord': EpochRecord,
+                'AnalogSValRecord': AnalogSValRecord,
+                'SurfMessageRecord': SurfMessageRecord,
+                'UserMessageRecord': UserMessageRecord,
+                'DisplayRecord': DisplayRecord,
+                'StimulusHeader': StimulusHeader}
+PARSECLASSNAMES = dict([ (cls, name) for name, cls in PARSECLASSES.items() ])
+
+def parsefile(args):
+    """Parse .srf file fname in path (or recover its parse info from its .parse file),
+    making sure a .parse file is saved, and close it. Return fname. Used for parsing many
+    .srf files concurrently in a process pool, so args is a (fname, path) tuple"""
+    fname, path = args
+    f = File(fname, path)
+    f.parse()
+    f.close()
+    return fname
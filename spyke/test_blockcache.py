@@ -0,0 +1,56 @@
+"""Check that reads served from the block cache return exactly the same timestamps and data
+as uncached reads, for single and multi streams"""
+
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import numpy as np
+
+import probes
+import stream
+from stream import SimpleStream, MultiStream
+
+class DatedStream(SimpleStream):
+    """SimpleStream with a settable datetime, so that a few can be strung together into a
+    MultiStream"""
+    datetime = None
+
+class FakeFile(object):
+    def __init__(self, fname, wavedata, dt):
+        siteloc = probes.A1x32().siteloc_arr()
+        self.fname = fname
+        self.hpstream = DatedStream(fname, wavedata, siteloc, rawsampfreq=25000,
+                                    masterclockfreq=1000000, intgain=1, extgain=1,
+                                    sampfreq=50000, shcorrect=False, bitshift=0)
+        self.hpstream.datetime = datetime.datetime(2000, 1, 1) + dt
+
+def check(s, ranges):
+    for t0, t1 in ranges:
+        stream.blockcache.clear()
+        a = s.read(t0, t1)
+        b = s(t0, t1) # fills the cache
+        c = s(t0, t1) # served from the cache
+        for wave in [b, c]:
+            assert wave.data.shape == a.data.shape, (t0, t1, a.data.shape, wave.data.shape)
+            assert (wave.ts == a.ts).all(), (t0, t1, a.ts[:3], wave.ts[:3])
+            assert (wave.data == a.data).all(), (t0, t1)
+
+nchans, nt = 32, 250000 # 10 s per file
+ramp = np.int16(np.tile(np.arange(nt) % 2**15, (nchans, 1)))
+rng = np.random.RandomState(0)
+
+# single stream:
+f = FakeFile('a.tsf', ramp, datetime.timedelta(0))
+s = f.hpstream
+ranges = [(0, 250000), (200000, 200100), (123456, 987654)]
+ranges += [ tuple(sorted(rng.randint(s.t0, s.t1, 2))) for i in range(50) ]
+check(s, ranges)
+
+# multi stream, second file starts 1 s after the first one ends:
+fs = [f, FakeFile('b.tsf', ramp, datetime.timedelta(seconds=11))]
+ms = MultiStream(fs, 'ab.track', kind='highpass', sampfreq=50000, shcorrect=False)
+ranges = [(200000, 200100), (9900000, 11100000), (0, ms.t1)]
+ranges += [ tuple(sorted(rng.randint(ms.t0, ms.t1, 2))) for i in range(50) ]
+check(ms, ranges)
+print('cached reads are identical to uncached reads')
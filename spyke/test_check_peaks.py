@@ -0,0 +1,110 @@
+"""Check that util.check_peaks() finds exactly the same spikes as the Python per-peak loop
+in Detector.check_peaks_py() that it replaces, and compare their speed. Uses synthetic
+54 chan data by default, or blocks of real data from the .srf or .ns6 file given as the
+first command line argument"""
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import os
+import time
+import numpy as np
+
+from core import WaveForm, EmptyClass, Converter, intround
+import detect
+import util
+import probes
+
+def get_detector(stream, converter, probe, dt=350, inclr=150):
+    """Set up a Detector on all chans of stream, the same way Detector.detect() does"""
+    sort = EmptyClass()
+    sort.stream, sort.converter = stream, converter
+    sort.tw = -500, 1500 # us
+    twts = np.arange(sort.tw[0], sort.tw[1], stream.tres)
+    sort.twi = intround(twts[0] / stream.tres), intround(twts[-1] / stream.tres)
+    stream.probe = probe
+    det = detect.Detector(sort=sort)
+    det.chans = list(stream.chans)
+    det.nchans = len(det.chans)
+    det.inclr = inclr # um
+    det.lockrx = 1
+    det.extractparamsondetect = False
+    det.calc_chans()
+    det.SPIKEDTYPE = detect.calc_SPIKEDTYPE(det.maxnchansperspike)
+    det.maxnt = int(stream.sampfreq * (sort.tw[1] - sort.tw[0]) / 1000000)
+    det.dti = int(dt // stream.tres)
+    det.siteloc = np.asarray([ det.enabledSiteLoc[chan] for chan in det.chans ])
+    return det
+
+def compare(det, wave, cutrange):
+    """Check the peaks in wave both ways, assert that the results are identical"""
+    det.thresh = np.int16(np.round(det.get_noise(wave.data) * 4.5))
+    det.ppthresh = np.int16(np.round(det.thresh * 1.5))
+    sharp = util.sharpness2D(wave.data)
+    peakis = util.argthreshsharp(wave.data, det.thresh, sharp)
+    t0 = time.time()
+    spikes0, wavedata0 = det.check_peaks_py(wave, cutrange, sharp, peakis)
+    tpy = time.time() - t0
+    t0 = time.time()
+    spikes1, wavedata1 = det.check_peaks(wave, cutrange, sharp, peakis)
+    tcy = time.time() - t0
+    print('%d peaks, %d spikes, Python took %.3f sec, Cython took %.3f sec'
+          % (len(peakis), len(spikes0), tpy, tcy))
+    assert len(spikes0) == len(spikes1)
+    for name in spikes0.dtype.names:
+        assert (spikes0[name] == spikes1[name]).all(), name
+    # wavedata is only defined up to each spike's nchans and nt:
+    for s, wd0, wd1 in zip(spikes0, wavedata0, wavedata1):
+        nt = intround((s['t1'] - s['t0']) / wave.tres)
+        assert (wd0[:s['nchans'], :nt] == wd1[:s['nchans'], :nt]).all()
+
+detect.info = lambda msg: None # quiet
+
+if len(sys.argv) > 1: # blocks of real data
+    path, fname = os.path.split(os.path.abspath(sys.argv[1]))
+    if fname.endswith('.srf'):
+        import surf
+        f = surf.File(fname, path)
+        f.parse()
+    else:
+        import nsx
+        f = nsx.File(fname, path)
+    stream = f.hpstream
+    det = get_detector(stream, stream.converter, stream.probe)
+    det.noisemethod = 'median'
+    bs = 5000000 # us
+    for t0 in np.arange(stream.t0, stream.t1, bs)[:10]:
+        wave = stream(t0, t0+bs)
+        wave.tres = stream.tres
+        compare(det, wave, (t0, t0+bs))
+else: # synthetic data: noise plus biphasic spikes spread across neighbouring chans
+    rng = np.random.RandomState(0)
+    stream = EmptyClass()
+    stream.fname = ''
+    stream.chans = np.arange(54)
+    stream.tres = 20 # us
+    stream.sampfreq = 50000 # Hz
+    probe = probes.uMap54_1b()
+    det = get_detector(stream, Converter(8, 5000), probe)
+    det.noisemethod = 'median'
+    nt = 500000 # 10 s
+    data = rng.normal(scale=300, size=(len(stream.chans), nt))
+    spike = -np.sin(np.linspace(0, 2*np.pi, 25)) * np.exp(-np.linspace(0, 3, 25))
+    for ti in rng.randint(50, nt-50, 2000):
+        maxchan = rng.randint(len(stream.chans))
+        amp = rng.uniform(1000, 6000)
+        for chan in det.inclnbhdi[maxchan]:
+            scale = np.exp(-det.dm.data[maxchan, chan] / 60)
+            dti = rng.randint(-3, 4) # a bit of jitter between chans
+            data[chan, ti+dti:ti+dti+len(spike)] += amp * scale * spike
+    data = np.int16(data.clip(-2**15, 2**15-1))
+    ts = np.arange(nt) * stream.tres
+    wave = WaveForm(data=data, ts=ts, chans=stream.chans)
+    wave.tres = stream.tres
+    compare(det, wave, (ts[0], ts[-1])) # full range
+    compare(det, wave, (ts[1000], ts[-1000])) # only keep spikes in the middle
+    for dt in [100, 1000]: # in us, short and long search windows
+        det.dti = int(dt // stream.tres)
+        compare(det, wave, (ts[0], ts[-1]))
+print('util.check_peaks() results are identical to Detector.check_peaks_py()')
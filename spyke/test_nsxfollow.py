@@ -0,0 +1,64 @@
+"""Check that reads of a still growing .nsx file that span its old end return the same
+data after File.update() as reads of the fully written file, in every filter mode"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+import tempfile
+import numpy as np
+
+import nsx
+import stream
+
+def header(nchans, sampfreq):
+    """Return bytes of a minimal .nsx file header with nchans ephys chans"""
+    nbytes = 8 + 2 + 4 + 16 + 256 + 8 + 16 + 4 + nchans*66
+    hdr = b'NEURALCD' + struct.pack('BB', 2, 3) + struct.pack('I', nbytes)
+    hdr += b'raw'.ljust(16, b'\0') + b''.ljust(256, b'\0')
+    hdr += struct.pack('II', 1, sampfreq) + struct.pack('HHHHHHHH', 2020, 1, 1, 1, 0, 0, 0, 0)
+    hdr += struct.pack('I', nchans)
+    for chan in range(1, nchans+1):
+        hdr += b'CC' + struct.pack('H', chan) + ('chan%d' % chan).encode().ljust(16, b'\0')
+        hdr += struct.pack('BB', 0, 0) + struct.pack('hhhh', -32767, 32767, -8191, 8191)
+        hdr += b'uV'.ljust(16, b'\0') + struct.pack('IIH', 0, 0, 0) * 2
+    return hdr
+
+nchans, sampfreq, nt = 32, 30000, 300000
+data = np.int16(np.random.RandomState(0).normal(0, 50, (nchans, nt)))
+# single data packet, with its number of timepoints not yet updated, as while recording:
+src = header(nchans, sampfreq) + struct.pack('<BII', 1, 0, 0) + data.T.tostring()
+path = tempfile.mkdtemp()
+fullfname, growfname = 'full.ns6', 'grow.ns6'
+with open(os.path.join(path, fullfname), 'wb') as f:
+    f.write(src)
+cut = len(src) - 170000*nchans*2 # write all but the last 170000 timepoints to begin with
+try:
+    for filtmeth, filtmode in [('BW', 'padded'), ('BW', 'streaming'), ('WMLDR', 'streaming')]:
+        with open(os.path.join(path, growfname), 'wb') as f:
+            f.write(src[:cut])
+        grow = nsx.File(growfname, path, follow=True).hpstream
+        full = nsx.File(fullfname, path, follow=True).hpstream
+        for s in [grow, full]:
+            s.filtmeth, s.filtmode = filtmeth, filtmode
+        oldt1 = grow.t1
+        grow(oldt1 - 100000, oldt1) # chart window at the end of the file, fills the cache
+        grow.read(oldt1 - 500000, oldt1) # detection block at the end of the file
+        with open(os.path.join(path, growfname), 'ab') as f:
+            f.write(src[cut:])
+        assert grow.f.update() > 0 and grow.t1 == full.t1
+        for t0, t1 in [(oldt1 - 100000, oldt1 + 100000), (oldt1 - 500000, oldt1 + 500000)]:
+            for read in ['__call__', 'read']:
+                a = getattr(grow, read)(t0, t1)
+                b = getattr(full, read)(t0, t1)
+                assert (a.ts == b.ts).all() and (a.data == b.data).all(), \
+                       (filtmeth, filtmode, read, t0, t1)
+        stream.blockcache.clear()
+        grow.f.close()
+        full.f.close()
+finally:
+    for fname in [fullfname, growfname]:
+        os.remove(os.path.join(path, fname))
+    os.rmdir(path)
+print('reads across the old end of a growing .nsx file are up to date after update()')
@@ -0,0 +1,76 @@
+"""Benchmark batched polyphase resampling against the per-chan, per-kernel np.convolve
+resampling that Stream.resample used to do, check that it's substantially faster, and that
+they're bit-identical"""
+
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import time
+
+from core import polyphase_resample, KERNELSIZE
+from stream import Stream
+
+MINSPEEDUP = 1.3 # minimum ratio of np.convolve to polyphase resample time
+NTIMINGS = 3 # number of timings of each, take the fastest to reduce noise
+
+def besttime(f, *args, **kwargs):
+    """Return output and fastest of NTIMINGS run times of f"""
+    dts = []
+    for i in range(NTIMINGS):
+        t0 = time.time()
+        out = f(*args, **kwargs)
+        dts.append(time.time()-t0)
+    return out, min(dts)
+
+def convolve_resample(rawdata, kernels):
+    """Old Stream.resample convolution loop, one np.convolve call per chan per kernel"""
+    nchans, nrawts = rawdata.shape
+    resamplex = kernels.shape[1]
+    nt = nrawts*resamplex - resamplex + 1
+    data = np.empty((nchans, nt), dtype=np.int32)
+    for chani in range(nchans):
+        for point, kernel in enumerate(kernels[chani]):
+            row = np.convolve(rawdata[chani], kernel, mode='same')
+            ti0 = (resamplex - point) % resamplex
+            rowti0 = int(point > 0)
+            data[chani, ti0::resamplex] = row[rowti0:]
+    data >>= 16
+    return data
+
+# fake a 54 chan .srf highpass stream, s+h corrected and resampled 2x:
+stream = Stream()
+stream.chans = np.arange(54)
+stream.rawtres = 40 # us
+stream.masterclockfreq = 1000000
+stream.shcorrect = True
+resamplex = 2
+ADchans = stream.chans
+kernels = stream.get_kernels(resamplex, KERNELSIZE, stream.chans, ADchans=ADchans)
+kernels = np.asarray([ kernels[chan] for chan in stream.chans ])
+
+# 10 s of full scale 12 bit data, left shifted 4 bits like SurfStream does:
+nrawts = 250000
+rawdata = np.int16(np.random.randint(-2**11, 2**11, (stream.nchans, nrawts)) << 4)
+
+olddata, olddt = besttime(convolve_resample, rawdata, kernels)
+print('np.convolve resample took %.3f sec' % olddt)
+data, dt = besttime(polyphase_resample, rawdata, kernels)
+print('polyphase resample took %.3f sec, %.1fx faster' % (dt, olddt/dt))
+assert (data == olddata).all()
+assert olddt / dt >= MINSPEEDUP, 'polyphase resample is only %.1fx faster' % (olddt/dt)
+for blocksize in [2**8, 2**10, 2**14]:
+    for rowsize in [1, 8, 13, 32]:
+        data = polyphase_resample(rawdata, kernels, blocksize=blocksize, rowsize=rowsize)
+        assert (data == olddata).all(), (blocksize, rowsize)
+
+# short slices, like those of the spike and chart windows:
+for nrawts in [13, 14, 15, 16, 17, 25, 100, 1001]:
+    shortdata = rawdata[:, :nrawts]
+    assert (polyphase_resample(shortdata, kernels) ==
+            convolve_resample(shortdata, kernels)).all()
+
+# extreme values, kernel output overflows int16 range but must still wrap identically:
+rawdata = np.int16(np.random.choice([-2**15, 2**15-1], (stream.nchans, 10000)))
+assert (polyphase_resample(rawdata, kernels) == convolve_resample(rawdata, kernels)).all()
+print('polyphase resample is bit-identical to np.convolve resample')
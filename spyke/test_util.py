@@ -35,6 +35,22 @@ print('Cython mean took %.3f sec' % (time.time()-tcy))
 print('Cython mean: %r' % result)
 print('mydata: %r' % mydata)
 '''
+"""Histogram median tests, against median_inplace_2Dshort()"""
+data = np.int16(np.random.randint(-2**15+1, 2**15-1, 52*500001)) # np.abs(-2**15) overflows
+data.shape = 52, 500001
+tcy = time.time()
+hist = util.abshist_2Dshort(data) # no copy
+result = util.median_hist(hist)
+print('Cython histogram median took %.3f sec' % (time.time()-tcy))
+assert (result == util.median_inplace_2Dshort(np.abs(data))).all()
+for d in [data[:, :1000], data[:, :1001], data[:3, ::7]]: # even, odd and strided
+    assert (util.median_hist(util.abshist_2Dshort(d)) ==
+            util.median_inplace_2Dshort(np.abs(d))).all()
+# accumulate in blocks:
+hist = util.abshist_2Dshort(data[:, :200000])
+hist = util.abshist_2Dshort(data[:, 200000:], hist)
+assert (util.median_hist(hist) == result).all()
+print('Cython histogram median: %r' % result)
 '''
 """Test sharpness2D"""
 signal = np.array([[-3022, -3031, -2423, -1655, -1108,  -864,  -891,  -994,  -908,  -600,  -343,  -304,  -219,    89,   377,   342,   136,    74,   112,    -8,
@@ -17,6 +17,8 @@ cdef extern from "math.h":
     int abs(int x)
     float fabs(float x)
     double ceil(double x) nogil
+    double round(double x) nogil # rounds half away from zero, like Python's round()
+    double rint(double x) nogil # rounds half to even, like np.round()
 
 cdef extern from "limits.h":
     int INT_MAX
@@ -29,6 +31,7 @@ cdef extern from "stdio.h":
 
 cdef extern from "string.h":
     cdef void *memset(void *, int, size_t) nogil # sets n bytes in memory to constant
+    cdef void *memcpy(void *, const void *, size_t) nogil # copies n bytes
 
 
 cdef short select_short(short *a, int l, int r, int k):
@@ -79,6 +82,53 @@ def median_inplace_2Dshort(np.ndarray[int16_t, ndim=2, mode='c'] arr):
     return result
 
 
+NABSBINS = 2**15 + 1 # number of possible absolute values of int16 data, 0 to 32768
+
+def abshist_2Dshort(const int16_t[:, :] data, int64_t[:, ::1] hist=None):
+    """Count the absolute values in each row (chan) of int16 data into the same row of
+    hist, of shape (nchans, NABSBINS). Counts are added to any already in hist, so that
+    it can accumulate the counts of successive blocks of data. If hist is None, start a
+    new one. data can be strided, and isn't copied. Return hist"""
+    cdef Py_ssize_t nchans, nt, i, j
+    cdef int v
+    nchans = data.shape[0]
+    nt = data.shape[1]
+    if hist is None:
+        hist = np.zeros((nchans, NABSBINS), dtype=np.int64)
+    elif hist.shape[0] != nchans or hist.shape[1] != NABSBINS:
+        raise ValueError('hist should be of shape (%d, %d)' % (nchans, NABSBINS))
+    for i in prange(nchans, nogil=True, schedule='dynamic'): # each thread does whole chans
+        for j in range(nt):
+            v = data[i, j]
+            if v < 0:
+                v = -v
+            hist[i, v] += 1
+    return np.asarray(hist)
+
+
+def median_hist(const int64_t[:, ::1] hist):
+    """Return the median value of each row (chan) of hist, from abshist_2Dshort(). When
+    a row has an even number of counts, return the lower of the two middle values, same
+    as median_inplace_2Dshort(). Rows with no counts get a median of 0"""
+    cdef Py_ssize_t nchans, nbins, i, v
+    cdef int64_t k, n
+    nchans = hist.shape[0]
+    nbins = hist.shape[1]
+    cdef int32_t[::1] result = np.zeros(nchans, dtype=np.int32)
+    for i in prange(nchans, nogil=True, schedule='dynamic'):
+        k = 0
+        for v in range(nbins): # total count
+            k = k + hist[i, v]
+        k = (k - 1) // 2 # 0-based rank of median
+        n = 0 # running count
+        for v in range(nbins):
+            n = n + hist[i, v]
+            if n > k:
+                result[i] = v
+                break
+    return np.asarray(result)
+
+
 cdef double mean_short(short *a, int N):
     cdef Py_ssize_t i # recommended type for looping
     cdef double s=0.0
@@ -249,6 +299,322 @@ def argthreshsharp(np.ndarray[int16_t, ndim=2] signal,
 
     return peakis[:npeaks]
 
+
+cdef inline int64_t iabs64(int64_t x) nogil:
+    return -x if x < 0 else x
+
+
+cdef inline double dabs(double x) nogil:
+    return -x if x < 0 else x
+
+
+cdef inline bint peak_coming_up(const int32_t[:, :] peakis, Py_ssize_t peaki,
+                                int64_t ti, int64_t chani) nogil:
+    """Return whether (ti, chani) is in peakis after row peaki. Rows of peakis are sorted
+    by ti, so the search stops at the first later ti"""
+    cdef Py_ssize_t i, npeaks = peakis.shape[0]
+    for i in range(peaki+1, npeaks):
+        if peakis[i, 0] > ti:
+            return False
+        if peakis[i, 0] == ti and peakis[i, 1] == chani:
+            return True
+    return False
+
+
+def check_peaks(const int16_t[:, :] data,
+                const float32_t[:, :] sharp,
+                const float64_t[:] ts,
+                const int32_t[:, :] peakis,
+                const int16_t[:] thresh,
+                const int16_t[:] ppthresh,
+                const int64_t[:, :] inclnbhd,
+                const int64_t[:] ninclchans,
+                const int64_t[:] chans,
+                int64_t[:] lockouts,
+                int64_t dti, int64_t twi0, int64_t twi1,
+                float64_t cutt0, float64_t cutt1,
+                spikes, int16_t[:, :, :] wavedata, int64_t[:, :] Vs,
+                fitspike=None):
+    """Check which threshold-exceeding peaks in peakis look like spikes, same as
+    detect.Detector.check_peaks_py(), but all in C without the GIL. For each peak, check
+    lockouts, find sharpest peak and its biggest opposite adjacent peak on each chan of
+    the peak's inclusion neighbourhood (row of inclnbhd) within dti of it, pick the chan
+    with the biggest peak-to-peak sharpness as the maxchan, check Vp and Vpp thresholds,
+    find corresponding peaks on all other chans within the spike time window (twi0,
+    twi1), fill in the spike record and wavedata, and update lockouts in place. The
+    spikes struct array is filled through views of its fields. V0, V1 and Vpp of each
+    spike are saved in AD units to the columns of Vs, for conversion to uV by the caller.
+
+    If fitspike is given, it's called (with the GIL) for each spike that passes all
+    checks, with args (spikei, t0i, t1i, chanis, tis, inclchani), and should return the
+    indices into chanis of the chans to lock out, or None to reject the spike. Otherwise,
+    all chans of the neighbourhood are locked out. Return number of spikes found"""
+    cdef Py_ssize_t nt = data.shape[1]
+    cdef Py_ssize_t npeaks = peakis.shape[0]
+    cdef Py_ssize_t maxnchans = inclnbhd.shape[1]
+    cdef Py_ssize_t maxnt = wavedata.shape[2]
+    cdef int64_t maxti = nt - 1
+    cdef int64_t sdti = dti // 2
+    # spike record fields:
+    cdef int64_t[:] s_t = spikes['t']
+    cdef int64_t[:] s_t0 = spikes['t0']
+    cdef int64_t[:] s_t1 = spikes['t1']
+    cdef uint8_t[:, :, :] s_tis = spikes['tis']
+    cdef uint8_t[:] s_aligni = spikes['aligni']
+    cdef int16_t[:] s_dt = spikes['dt']
+    cdef uint8_t[:] s_chan = spikes['chan']
+    cdef uint8_t[:, :] s_chans = spikes['chans']
+    cdef uint8_t[:] s_nchans = spikes['nchans']
+    cdef uint8_t[:] s_chani = spikes['chani']
+    cdef uint8_t[:, :] s_lockchans = spikes['lockchans']
+    cdef uint8_t[:] s_nlockchans = spikes['nlockchans']
+    # per peak scratch arrays:
+    cdef float32_t[::1] ppsharp = np.zeros(maxnchans, dtype=np.float32)
+    cdef int64_t[::1] maxsharpis = np.zeros(maxnchans, dtype=np.int64)
+    cdef int64_t[:, ::1] adjpeakis = np.zeros((maxnchans, 2), dtype=np.int64)
+    cdef int64_t[::1] maxadjiis = np.zeros(maxnchans, dtype=np.int64)
+    cdef int64_t[:, ::1] tis = np.zeros((maxnchans, 2), dtype=np.int64)
+    cdef int64_t[::1] lockchaniis = np.zeros(maxnchans, dtype=np.int64)
+    cdef int64_t[::1] localpeakis = np.zeros(max(2*dti+1, twi1-twi0+1, 1), dtype=np.int64)
+    cdef bint extractparams = fitspike is not None
+    cdef bint continuepeaki, tie
+    cdef Py_ssize_t peaki, nspikes=0, nchans, nlocalpeaks, nlockchans, cii, ii, i
+    cdef Py_ssize_t maxcii, maxsharpii, maxadjii, peak0ii, peak1ii
+    cdef int64_t ti, chani, oldchani, t0i, t1i, oldt0i, chan, lockout, tlockoutchani
+    cdef int64_t maxsharpi, adjpi, peak0ti, peak1ti, dt0i, dt1i, ti0, ti1, nwt
+    cdef int64_t V0, V1, Vp, Vpp
+    cdef float32_t sharpi, maxsharp, adj0sharp, adj1sharp
+    cdef uint8_t aligni
+
+    assert peakis.shape[1] == 2
+    assert localpeakis.shape[0] >= 2*dti+1
+    with nogil:
+        for peaki in range(npeaks):
+            ti = peakis[peaki, 0]
+            chani = peakis[peaki, 1]
+            # is this threshold-exceeding peak locked out?
+            tlockoutchani = lockouts[chani]
+            if ti <= tlockoutchani:
+                continue # skip to next peak
+            nchans = ninclchans[chani]
+            # search window DT on either side of this peak, for checking sharpness:
+            t0i = max(ti-dti, 0)
+            t1i = min(ti+dti+1, nt) # end inclusive
+
+            # collect peak-to-peak sharpness of the non locked out peaks on all chans
+            continuepeaki = False
+            for cii in range(nchans):
+                chan = inclnbhd[chani, cii] # really a chani, index into lockouts
+                ppsharp[cii] = 0.0
+                maxsharpis[cii] = 0
+                adjpeakis[cii, 0] = 0
+                adjpeakis[cii, 1] = 0
+                maxadjiis[cii] = 0
+                nlocalpeaks = 0
+                for i in range(t1i-t0i):
+                    if sharp[chan, t0i+i] != 0.0 and t0i+i > lockouts[chan]:
+                        localpeakis[nlocalpeaks] = i
+                        nlocalpeaks += 1
+                if nlocalpeaks == 0:
+                    continue
+                maxsharpii = 0
+                maxsharp = dabs(sharp[chan, t0i+localpeakis[0]])
+                for ii in range(1, nlocalpeaks):
+                    sharpi = dabs(sharp[chan, t0i+localpeakis[ii]])
+                    if sharpi > maxsharp:
+                        maxsharp = sharpi
+                        maxsharpii = ii
+                maxsharpi = localpeakis[maxsharpii]
+                maxsharpis[cii] = maxsharpi
+                # one adjacent peak to left and right each, either or both may be
+                # identical to the max sharpness peak:
+                adjpeakis[cii, 0] = localpeakis[max(maxsharpii-1, 0)]
+                adjpeakis[cii, 1] = localpeakis[min(maxsharpii+1, nlocalpeaks-1)]
+                adj0sharp = sharp[chan, t0i+adjpeakis[cii, 0]]
+                adj1sharp = sharp[chan, t0i+adjpeakis[cii, 1]]
+                if sharp[chan, t0i+maxsharpi] < 0: # look for +ve adj peak
+                    maxadjii = adj1sharp > adj0sharp
+                else: # look for -ve adj peak
+                    maxadjii = adj1sharp < adj0sharp
+                maxadjiis[cii] = maxadjii
+                adjpi = adjpeakis[cii, maxadjii]
+                if maxsharpi != adjpi:
+                    ppsharp[cii] = sharp[chan, t0i+maxsharpi] - sharp[chan, t0i+adjpi]
+                else: # monophasic spike, set ppsharp == sharpness of single peak
+                    ppsharp[cii] = sharp[chan, t0i+maxsharpi]
+                    # ensure ppsharp of monophasic trigger chan >= Vppthresh**2/dt:
+                    if (chan == chani and dabs(ppsharp[cii]) <
+                        <float64_t>(<int64_t>ppthresh[chani]*ppthresh[chani]) / dti):
+                        continuepeaki = True
+                        break # out of cii loop
+            if continuepeaki:
+                continue # skip to next peak
+
+            # choose chan with biggest ppsharp as maxchan, and its sharpest peak as the
+            # primary peak:
+            oldchani = chani
+            maxcii = 0
+            for cii in range(1, nchans):
+                if dabs(ppsharp[cii]) > dabs(ppsharp[maxcii]):
+                    maxcii = cii
+            chani = inclnbhd[oldchani, maxcii]
+            maxsharpi = maxsharpis[maxcii]
+            if chani != oldchani or t0i+maxsharpi > ti:
+                # if the new peak is coming up, it's thresh exceeding, wait for it:
+                if peak_coming_up(peakis, peaki, t0i+maxsharpi, chani):
+                    continue # skip to next peak
+            if chani != oldchani:
+                tlockoutchani = lockouts[chani]
+            ti = t0i + maxsharpi
+            if ti <= tlockoutchani: # sharpest peak is locked out
+                continue # skip to next peak
+            if not (cutt0 <= ts[ti] <= cutt1):
+                continue # skip to next peak
+
+            # check that Vp threshold is exceeded by at least one of the two sharpest peaks
+            adjpi = adjpeakis[maxcii, maxadjiis[maxcii]]
+            V0 = data[chani, t0i+maxsharpi]
+            V1 = data[chani, t0i+adjpi]
+            Vp = max(iabs64(V0), iabs64(V1))
+            if Vp < thresh[chani]:
+                continue # skip to next peak
+            # check that the two sharpest peaks together exceed Vpp threshold:
+            Vpp = iabs64(V0 - V1) # Vs are of opposite sign, unless monophasic
+            if Vpp == 0: # monophasic spike
+                Vpp = Vp
+            if Vpp < ppthresh[chani]:
+                continue # skip to next peak
+
+            # align to -ve of the two sharpest peaks, cut new window:
+            aligni = sharp[chani, t0i+adjpi] < sharp[chani, t0i+maxsharpi]
+            if aligni:
+                ti = t0i + adjpi
+            else:
+                ti = t0i + maxsharpi
+            oldt0i = t0i
+            t0i = max(ti+twi0, 0)
+            t1i = min(ti+twi1+1, maxti) # end inclusive
+            nchans = ninclchans[chani]
+            for cii in range(nchans):
+                if inclnbhd[chani, cii] == chani:
+                    maxcii = cii
+                    break
+            # primary and 2ndary peak tis of maxchan, relative to new t0i:
+            peak0ti = maxsharpi + oldt0i - t0i
+            peak1ti = adjpi + oldt0i - t0i
+            tis[maxcii, 0] = peak0ti
+            tis[maxcii, 1] = peak1ti
+
+            # pick corresponding peaks on other chans according to how close they are to
+            # those on maxchan, regardless of their sign
+            for cii in range(nchans):
+                if cii == maxcii: # already set
+                    continue
+                chan = inclnbhd[chani, cii]
+                nlocalpeaks = 0
+                for i in range(t1i-t0i):
+                    if sharp[chan, t0i+i] != 0.0 and t0i+i > lockouts[chan]:
+                        localpeakis[nlocalpeaks] = i
+                        nlocalpeaks += 1
+                if nlocalpeaks == 0:
+                    tis[cii, 0] = peak0ti # use same tis as maxchan
+                    tis[cii, 1] = peak1ti
+                    continue
+                # find peak on this chan that's temporally closest to primary peak on
+                # maxchan. If two peaks are equally close, pick the sharpest one
+                tie = False
+                for ii in range(1, nlocalpeaks):
+                    if (iabs64(localpeakis[ii]-peak0ti) ==
+                        iabs64(localpeakis[ii-1]-peak0ti)):
+                        tie = True
+                        break
+                peak0ii = 0
+                if tie:
+                    maxsharp = dabs(sharp[chan, t0i+localpeakis[0]])
+                    for ii in range(1, nlocalpeaks):
+                        sharpi = dabs(sharp[chan, t0i+localpeakis[ii]])
+                        if sharpi > maxsharp:
+                            maxsharp = sharpi
+                            peak0ii = ii
+                else:
+                    for ii in range(1, nlocalpeaks):
+                        if (iabs64(localpeakis[ii]-peak0ti) <
+                            iabs64(localpeakis[peak0ii]-peak0ti)):
+                            peak0ii = ii
+                dt0i = iabs64(localpeakis[peak0ii]-peak0ti)
+                if dt0i > sdti: # too distant in time
+                    tis[cii, 0] = peak0ti # use same t0i as maxchan
+                else: # give it its own t0i
+                    tis[cii, 0] = localpeakis[peak0ii]
+                if nlocalpeaks == 1: # monophasic, set 2ndary peak same as primary
+                    tis[cii, 1] = tis[cii, 0]
+                    continue
+                if peak0ti <= peak1ti: # primary peak comes first (more common case)
+                    peak1ii = min(peak0ii+1, nlocalpeaks-1) # 2ndary peak is 1 to the right
+                else: # 2ndary peak comes first
+                    peak1ii = max(peak0ii-1, 0) # 2ndary peak is 1 to the left
+                dt1i = iabs64(localpeakis[peak1ii]-peak1ti)
+                if dt1i > sdti: # too distant in time
+                    tis[cii, 1] = peak1ti # use same t1i as maxchan
+                else:
+                    tis[cii, 1] = localpeakis[peak1ii]
+
+            if extractparams:
+                with gil:
+                    lockchaniiarr = fitspike(nspikes, t0i, t1i,
+                                             np.asarray(inclnbhd[chani, :nchans]),
+                                             np.asarray(tis[:nchans]), maxcii)
+                    if lockchaniiarr is None: # reject spike
+                        continue # skip to next peak
+                    nlockchans = len(lockchaniiarr)
+                    for i in range(nlockchans):
+                        lockchaniis[i] = lockchaniiarr[i]
+            else:
+                nlockchans = nchans
+                for cii in range(nchans):
+                    lockchaniis[cii] = cii
+                    s_lockchans[nspikes, cii] = chans[inclnbhd[chani, cii]]
+                s_nlockchans[nspikes] = nchans
+
+            # fill in spike record and wavedata:
+            nwt = t1i - t0i # isn't always full width if recording has gaps
+            s_t[nspikes] = <int64_t>round(ts[ti]) # nearest us
+            s_t0[nspikes] = <int64_t>round(ts[t0i])
+            s_t1[nspikes] = <int64_t>round(ts[t1i])
+            s_aligni[nspikes] = aligni
+            # time between peaks, rounded to nearest even us like np.round, indexed like
+            # a Python sequence of length nwt:
+            ti0 = tis[maxcii, 0] + nwt if tis[maxcii, 0] < 0 else tis[maxcii, 0]
+            ti1 = tis[maxcii, 1] + nwt if tis[maxcii, 1] < 0 else tis[maxcii, 1]
+            s_dt[nspikes] = <int16_t><int64_t>rint(dabs(ts[t0i+ti0] - ts[t0i+ti1]))
+            s_chan[nspikes] = chans[chani]
+            s_nchans[nspikes] = nchans
+            s_chani[nspikes] = maxcii
+            Vs[nspikes, 0] = V0
+            Vs[nspikes, 1] = V1
+            Vs[nspikes, 2] = Vpp
+            nwt = min(nwt, maxnt)
+            for cii in range(nchans):
+                chan = inclnbhd[chani, cii]
+                s_chans[nspikes, cii] = chans[chan]
+                s_tis[nspikes, cii, 0] = tis[cii, 0] # wrt t0i
+                s_tis[nspikes, cii, 1] = tis[cii, 1]
+                for i in range(nwt):
+                    wavedata[nspikes, cii, i] = data[chan, t0i+i]
+
+            # give each chan a distinct lockout, based on how each chan's sharpest peaks
+            # line up with those of the maxchan. On each chan, keep whichever lockout ends
+            # last:
+            for i in range(nlockchans):
+                cii = lockchaniis[i]
+                chan = inclnbhd[chani, cii]
+                lockout = t0i + max(tis[cii, 0], tis[cii, 1])
+                if lockout > lockouts[chan]:
+                    lockouts[chan] = lockout
+            nspikes += 1
+
+    return nspikes
+
 '''
 def argsharp(np.ndarray[float32_t, ndim=2] sharp):
     """Given sharpness array, return a temporally sorted n x 2 (ti, ci) array
@@ -624,3 +990,31 @@ def intersect1d_uint8(arrs):
             #print('new ncommon: %d' % ncommon)
             # don't inc i, new value at common[i] has just shifted into view
     return common[:ncommon]
+
+
+def walksrfrecords(const uint8_t[::1] mm, Py_ssize_t offset,
+                   list hpoffsets, list lpoffsets, list dsvaloffsets):
+    """Cython version of surf.walkrecords(). Walk the run of consecutive highpass ('PS'),
+    lowpass ('PC') and digital SVal ('VD') records in memory-mapped .srf file mm, starting
+    at byte offset. Append the offset of each record to its list, and return the offset of
+    the first record (or EOF) that isn't one of these"""
+    cdef Py_ssize_t nbytes = mm.shape[0]
+    cdef int32_t NumSamples # little endian, like the .srf file
+    cdef uint8_t flag0, flag1
+    while offset + 1 < nbytes:
+        flag0, flag1 = mm[offset], mm[offset+1]
+        if flag0 == c'V' and flag1 == c'D':
+            dsvaloffsets.append(offset)
+            offset += 24
+            continue
+        elif flag0 == c'P' and flag1 == c'S':
+            hpoffsets.append(offset)
+        elif flag0 == c'P' and flag1 == c'C':
+            lpoffsets.append(offset)
+        else:
+            break
+        if offset + 28 > nbytes:
+            raise ValueError('truncated continuous record at offset %d' % offset)
+        memcpy(&NumSamples, &mm[offset+24], 4)
+        offset += 28 + NumSamples*2 # each sample is 2 bytes long
+    return offset